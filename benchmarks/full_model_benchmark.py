@@ -0,0 +1,241 @@
+"""
+Throughput benchmark of FullModel on synthetic waveforms, such that no dataset has to be downloaded.
+For every config and input length it measures the training step (samples/s, step latency, peak memory and the time
+per module, see utils/hot_path_profiler.py) and every `forward_through_*` inference path.
+
+Example usage:
+    python -m benchmarks.full_model_benchmark --save ./benchmarks/baselines/main.json
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 10240 \
+        --compare ./benchmarks/baselines/main.json
+
+With `--activation_checkpointing`, the conv layers of all modules recompute their activations in the backward pass
+(see CNNEncoder). To see the memory/time trade-off, eg on longer crops, compare against a run without:
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 20480 64000 \
+        --save ./benchmarks/baselines/no_ckpt.json
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 20480 64000 \
+        --activation_checkpointing --compare ./benchmarks/baselines/no_ckpt.json
+
+With `--compile`, the training step of the IndependentModules runs as compiled graphs (see utils/compile_utils.py).
+The first step, which includes the compilation, is reported separately (`first_step_s`). Compiled vs eager:
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 8800 10240 20480 \
+        --save ./benchmarks/baselines/eager.json
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 8800 10240 20480 \
+        --compile --compare ./benchmarks/baselines/eager.json
+
+With `--predictor_rank r`, the InfoNCE heads of all modules are factorized (see InfoNCE_Loss.get_Wc_k).
+
+With `--subsample_windows n`, InfoNCE scores n windows per sequence at per-sample offsets (see
+InfoNCE_Loss.sample_windows), eg to see the cost of more positive pairs on LibriSpeech:
+    python -m benchmarks.full_model_benchmark --configs sim_audio_de_boer_distr_true --lengths 20480 --subsample_windows 4
+
+With `--compare`, the results are compared against a previously saved baseline; the exit code is 1 if any
+throughput dropped (or peak memory grew) by more than `--tolerance`.
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import sys
+import time
+
+import torch
+
+from config_code.config_classes import OptionsConfig
+from models.full_model import FullModel
+from utils.hot_path_profiler import enable_hot_path_profiler, disable_hot_path_profiler, profile_backward
+from utils.utils import set_seed
+
+DEFAULT_CONFIGS = [
+    "sim_audio_de_boer_distr_true",  # SIM
+    "sim_audio_de_boer_distr_false",  # GIM
+    "cpc_audio_de_boer_conventional",
+    "cpc_audio_de_boer_extra_layers",
+]
+DEFAULT_LENGTHS = [8800, 10240, 20480]  # De Boer (resampled), De Boer, LibriSpeech
+
+
+def load_options(config_name) -> OptionsConfig:
+    module = importlib.import_module(f"configs.{config_name}")
+    return module._get_options(experiment_name="benchmark")
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def _peak_memory_mb(device):
+    # memory of cpu tensors is not tracked by torch
+    return torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else None
+
+
+def _time(fn, device, nb_steps, warmup) -> (float, float):
+    """Mean latency (s) per call and peak memory (MB)."""
+    for _ in range(warmup):
+        fn()
+    _sync(device)
+    _reset_peak_memory(device)
+
+    start = time.perf_counter()
+    for _ in range(nb_steps):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - start) / nb_steps, _peak_memory_mb(device)
+
+
+def inference_paths(model: FullModel) -> dict:
+    """All `forward_through_*` paths that apply to the architecture of the model."""
+    nb_modules = len(model.fullmodel)
+    paths = {"forward_through_all_modules": model.forward_through_all_modules}
+    if model.opt.encoder_config.architecture.is_cpc:  # single module, intermediate layers
+        last_layer = len(model.opt.encoder_config.architecture.modules[0].kernel_sizes) - 1
+        paths["forward_through_layer"] = lambda x: model.forward_through_layer(x, 0, last_layer)
+    else:
+        paths["forward_through_all_cnn_modules"] = model.forward_through_all_cnn_modules
+        for idx in range(nb_modules - 1):  # skip the regressor
+            paths[f"forward_through_module_{idx}"] = lambda x, idx=idx: model.forward_through_module(x, idx)
+    return paths
+
+
+def benchmark(opt: OptionsConfig, audio_length, batch_size, nb_steps=10, warmup=2) -> dict:
+    device = opt.device
+    model = FullModel(opt, calc_accuracy=False).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=opt.encoder_config.learning_rate)
+    x = torch.randn(batch_size, 1, audio_length, device=device)
+
+    def train_step():
+        loss, _, _, _ = model(x)
+        loss = torch.mean(loss, 0)
+        model.zero_grad()
+        with profile_backward():
+            sum(loss).backward()
+        optimizer.step()
+
+    model.train()
+    # includes the compilation with `compile_modules`
+    first_step, _ = _time(train_step, device, 1, 0)
+    latency, peak_memory = _time(train_step, device, nb_steps, warmup)
+    result = {"train": {"samples_per_s": batch_size / latency, "step_latency_ms": 1000 * latency,
+                        "peak_memory_mb": peak_memory, "first_step_s": first_step}}
+
+    # per module breakdown, separately since the profiler synchronizes the device
+    profiler = enable_hot_path_profiler(device)
+    for _ in range(nb_steps):
+        train_step()
+    disable_hot_path_profiler()
+    result["train"]["modules_ms"] = {name: 1000 * stats["time"] / stats["count"]
+                                     for name, stats in sorted(profiler.summary().items())}
+
+    model.eval()
+    with torch.no_grad():
+        for name, path in inference_paths(model).items():
+            latency, peak_memory = _time(lambda: path(x), device, nb_steps, warmup)
+            result[name] = {"samples_per_s": batch_size / latency, "step_latency_ms": 1000 * latency,
+                            "peak_memory_mb": peak_memory}
+
+    del model, optimizer, x
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance) -> list:
+    """Returns the regressions: [(case, path, metric, baseline value, new value)]"""
+    regressions = []
+    for case, paths in results.items():
+        if case not in baseline:
+            continue
+        for path, metrics in paths.items():
+            base = baseline[case].get(path)
+            if base is None:
+                continue
+            if metrics["samples_per_s"] < (1 - tolerance) * base["samples_per_s"]:
+                regressions.append((case, path, "samples_per_s", base["samples_per_s"], metrics["samples_per_s"]))
+            if metrics["peak_memory_mb"] is not None and base["peak_memory_mb"] is not None and \
+                    metrics["peak_memory_mb"] > (1 + tolerance) * base["peak_memory_mb"]:
+                regressions.append((case, path, "peak_memory_mb", base["peak_memory_mb"], metrics["peak_memory_mb"]))
+    return regressions
+
+
+def _print_results(results: dict, baseline: dict = None):
+    print(f"\n{'case':<45} {'path':<35} {'samples/s':>10} {'latency (ms)':>13} {'peak mem (MB)':>14} {'vs base':>8}")
+    for case, paths in results.items():
+        for path, metrics in paths.items():
+            memory = metrics["peak_memory_mb"]
+            ratio = ""
+            if baseline is not None and path in baseline.get(case, {}):
+                ratio = f"{metrics['samples_per_s'] / baseline[case][path]['samples_per_s']:.2f}x"
+            print(f"{case:<45} {path:<35} {metrics['samples_per_s']:>10.1f} {metrics['step_latency_ms']:>13.1f} "
+                  f"{memory if memory is None else round(memory, 1)!s:>14} {ratio:>8}")
+        if "first_step_s" in paths["train"]:
+            print(f"{'':<45}   {'first step (incl. compile)':<33} {paths['train']['first_step_s']:>10.1f} s")
+        for module, ms in paths["train"]["modules_ms"].items():
+            print(f"{'':<45}   {module:<33} {ms:>10.1f} ms")
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Benchmark FullModel configurations on synthetic audio.")
+    parser.add_argument('--configs', type=str, nargs='+', default=DEFAULT_CONFIGS, help='Config files in configs/')
+    parser.add_argument('--lengths', type=int, nargs='+', default=DEFAULT_LENGTHS, help='Audio lengths (samples)')
+    parser.add_argument('--batch_size', type=int, default=None, help='Default: batch size of the config')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--activation_checkpointing', action='store_true', help='Recompute the conv activations')
+    parser.add_argument('--compile', action='store_true', help='torch.compile the IndependentModules')
+    parser.add_argument('--predictor_rank', type=int, default=0, help='Low-rank InfoNCE heads, 0: full heads')
+    parser.add_argument('--subsample_windows', type=int, default=0, help='InfoNCE windows per sequence')
+    parser.add_argument('--save', type=str, default=None, help='Store the results as json baseline')
+    parser.add_argument('--compare', type=str, default=None, help='Json baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown that counts as regression')
+    args = parser.parse_args()
+
+    results = {}
+    for config_name in args.configs:
+        opt = load_options(config_name)
+        set_seed(0)
+        if args.batch_size is not None:
+            opt.encoder_config.dataset.batch_size = args.batch_size
+        batch_size = opt.encoder_config.dataset.batch_size
+        opt.compile_modules = args.compile
+        opt.encoder_config.predictor_rank = args.predictor_rank
+        opt.encoder_config.subsample_windows = args.subsample_windows
+        for module in opt.encoder_config.architecture.modules:
+            module.activation_checkpointing = args.activation_checkpointing
+        for audio_length in args.lengths:
+            case = f"{config_name}/L={audio_length}/B={batch_size}"
+            print(f"Benchmarking {case} on {opt.device}...")
+            results[case] = benchmark(opt, audio_length, batch_size, args.steps, args.warmup)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+
+    _print_results(results, baseline)
+
+    if args.save is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"device": str(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")),
+                       "torch": torch.__version__, "time": str(datetime.datetime.now()),
+                       "results": results}, f, indent=4)
+        print(f"Saved results to {args.save}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for case, path, metric, old, new in regressions:
+            print(f"REGRESSION {case} {path} {metric}: {old:.1f} -> {new:.1f}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    _main()
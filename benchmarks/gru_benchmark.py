@@ -0,0 +1,82 @@
+"""
+Latency of the autoregressor on cpu: nn.GRU vs the hoisted GRU (`encoder_config.hoisted_gru`, see
+models/autoregressor.py), on random inputs of the shape of the regressor input (B x L x 512), so no model or dataset
+is needed. Also reports the max abs difference of the outputs (and of the gradients with `--backward`).
+
+Example usage:
+    python -m benchmarks.gru_benchmark --lengths 64 256 1024 4096 --batch_sizes 1 8
+    python -m benchmarks.gru_benchmark --lengths 4096 --chunk_size 1024 --backward
+
+The first call of the hoisted GRU compiles the recurrence (once per batch size), it is excluded from the timings.
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.full_model_benchmark import load_options
+from models.autoregressor import Autoregressor
+
+
+def _time(fn, nb_steps) -> float:
+    fn()  # warm-up (and compilation)
+    start = time.perf_counter()
+    for _ in range(nb_steps):
+        fn()
+    return (time.perf_counter() - start) / nb_steps
+
+
+def _forward_backward(model, x):
+    x = x.detach().requires_grad_()
+    output = model(x)
+    output.square().mean().backward()  # some loss, with gradients that depend on all outputs
+    grads = [x.grad] + [param.grad for param in model.parameters()]
+    model.zero_grad()
+    return output, grads
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="nn.GRU vs hoisted GRU of the autoregressor on cpu.")
+    parser.add_argument('--config', type=str, default="sim_audio_de_boer_distr_true")
+    parser.add_argument('--lengths', type=int, nargs='+', default=[64, 256, 1024, 4096], help='Nb of frames')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--input_size', type=int, default=512)
+    parser.add_argument('--hidden_dim', type=int, default=256)
+    parser.add_argument('--chunk_size', type=int, default=0, help='hoisted_gru_chunk_size, 0: all frames at once')
+    parser.add_argument('--backward', action='store_true', help='Time forward + backward instead of inference')
+    parser.add_argument('--steps', type=int, default=3)
+    args = parser.parse_args()
+
+    opt = load_options(args.config)
+    opt.device = torch.device("cpu")
+    torch.manual_seed(0)
+    reference = Autoregressor(opt, args.input_size, args.hidden_dim)
+    opt.encoder_config.hoisted_gru = True
+    opt.encoder_config.hoisted_gru_chunk_size = args.chunk_size
+    hoisted = Autoregressor(opt, args.input_size, args.hidden_dim)
+    hoisted.load_state_dict(reference.state_dict())
+
+    print(f"{'B':>3} {'L':>6} {'nn.GRU (ms)':>12} {'hoisted (ms)':>13} {'speed-up':>9} {'max |out err|':>14} "
+          f"{'max |grad err|':>15}")
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            x = torch.randn(batch_size, length, args.input_size)
+            if args.backward:
+                (out_ref, grads_ref), (out, grads) = _forward_backward(reference, x), _forward_backward(hoisted, x)
+                grad_error = max((grad - grad_ref).abs().max().item() for grad, grad_ref in zip(grads, grads_ref))
+                time_ref = _time(lambda: _forward_backward(reference, x), args.steps)
+                time_hoisted = _time(lambda: _forward_backward(hoisted, x), args.steps)
+            else:
+                with torch.no_grad():
+                    out_ref, out = reference(x), hoisted(x)
+                    time_ref = _time(lambda: reference(x), args.steps)
+                    time_hoisted = _time(lambda: hoisted(x), args.steps)
+                grad_error = float("nan")
+
+            print(f"{batch_size:>3} {length:>6} {1000 * time_ref:>12.1f} {1000 * time_hoisted:>13.1f} "
+                  f"{time_ref / time_hoisted:>8.2f}x {(out - out_ref).abs().max().item():>14.1e} {grad_error:>15.1e}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,110 @@
+"""
+Memory/time comparison of the two ways to get more negatives for InfoNCE_Loss: raising `negative_samples` (in-batch
+negatives, materialized as a (B*L) x C x negative_samples tensor) vs a memory bank of encodings of previous steps
+(`negative_bank_size`, scored with one matmul per prediction step). Runs forward + backward of the loss of a single
+module on random encodings, so no model or dataset is needed.
+
+Example usage (the defaults correspond to the first module of SIM on De Boer):
+    python -m benchmarks.info_nce_negatives_benchmark --negative_samples 10 100 1000 --bank_sizes 1024 4096 16384
+
+With `--negative_chunk_size`, the negatives of all cases are scored in chunks with an online log-sum-exp:
+    python -m benchmarks.info_nce_negatives_benchmark --negative_samples 10 100 1000 --negative_chunk_size 10
+
+Peak memory is measured on cuda. On cpu (not tracked by torch), the estimate of ArchitecturePlan is shown instead,
+which counts the negatives and scores that are kept for the backward pass.
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.full_model_benchmark import load_options, _sync, _reset_peak_memory, _peak_memory_mb
+from config_code.architecture_planner import BYTES_PER_FLOAT, INFO_NCE_SUBSAMPLE_WIN
+from models.loss_InfoNCE import InfoNCE_Loss
+from utils.utils import set_seed
+
+
+def estimated_memory_mb(encoder_config, frames, channels, prediction_step) -> float:
+    """Same estimate as the info_nce layer of ArchitecturePlan, for the whole batch."""
+    window = min(frames, INFO_NCE_SUBSAMPLE_WIN)
+    neg, bank, chunk = encoder_config.negative_samples, encoder_config.negative_bank_size, \
+        encoder_config.negative_chunk_size
+    if chunk > 0:
+        negatives_floats = 2 * neg * frames + (-(-neg // chunk) + -(-bank // chunk)) * window * prediction_step
+    else:
+        negatives_floats = channels * neg * frames + 2 * bank * window * prediction_step
+    floats = channels * prediction_step * window + negatives_floats
+    return encoder_config.dataset.batch_size * floats * BYTES_PER_FLOAT / 2 ** 20
+
+
+def benchmark(opt, frames, channels, prediction_step, negative_samples, bank_size, nb_steps, warmup) -> dict:
+    opt.encoder_config.negative_samples = negative_samples
+    opt.encoder_config.negative_bank_size = bank_size
+    device = opt.device
+    batch_size = opt.encoder_config.dataset.batch_size
+
+    loss_fn = InfoNCE_Loss(opt, hidden_dim=channels, enc_hidden=channels, calc_accuracy=False,
+                           prediction_step=prediction_step).to(device)
+    z = torch.randn(batch_size, frames, channels, device=device, requires_grad=True)
+    c = torch.randn(batch_size, frames, channels, device=device, requires_grad=True)
+
+    def step():
+        loss, _ = loss_fn.get_loss(z, c)
+        loss.backward()
+        return loss
+
+    for _ in range(warmup):  # also fills the bank
+        step()
+    _sync(device)
+    _reset_peak_memory(device)
+
+    start = time.perf_counter()
+    for _ in range(nb_steps):
+        loss = step()
+    _sync(device)
+    latency = (time.perf_counter() - start) / nb_steps
+
+    peak_memory = _peak_memory_mb(device)
+    return {"step_latency_ms": 1000 * latency, "loss": loss.item(),
+            "peak_memory_mb": peak_memory,
+            "estimated_memory_mb": estimated_memory_mb(opt.encoder_config, frames, channels, prediction_step)}
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="In-batch negatives vs memory bank for InfoNCE_Loss.")
+    parser.add_argument('--config', type=str, default="sim_audio_de_boer_distr_true")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=512, help='Length of the encodings, 512: first module, De Boer')
+    parser.add_argument('--negative_samples', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--bank_sizes', type=int, nargs='+', default=[1024, 4096, 16384])
+    parser.add_argument('--bank_negative_samples', type=int, default=10, help='In-batch negatives next to the bank')
+    parser.add_argument('--staleness', type=int, default=4)
+    parser.add_argument('--negative_chunk_size', type=int, default=0, help='0: all negatives at once')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=4)
+    args = parser.parse_args()
+
+    opt = load_options(args.config)
+    opt.encoder_config.dataset.batch_size = args.batch_size
+    opt.encoder_config.negative_bank_staleness = args.staleness
+    opt.encoder_config.negative_chunk_size = args.negative_chunk_size
+    module = opt.encoder_config.architecture.modules[0]
+    channels, prediction_step = module.cnn_hidden_dim, module.prediction_step
+
+    cases = [(neg, 0) for neg in args.negative_samples] + \
+            [(args.bank_negative_samples, bank) for bank in args.bank_sizes]
+
+    print(f"{'negatives':>10} {'bank':>7} {'latency (ms)':>13} {'peak mem (MB)':>14} {'est. mem (MB)':>14} {'loss':>8}")
+    for negative_samples, bank_size in cases:
+        set_seed(0)
+        result = benchmark(opt, args.frames, channels, prediction_step, negative_samples, bank_size,
+                           args.steps, args.warmup)
+        memory = result["peak_memory_mb"]
+        print(f"{negative_samples:>10} {bank_size:>7} {result['step_latency_ms']:>13.1f} "
+              f"{memory if memory is None else round(memory, 1)!s:>14} {result['estimated_memory_mb']:>14.1f} "
+              f"{result['loss']:>8.3f}")
+
+
+if __name__ == "__main__":
+    _main()
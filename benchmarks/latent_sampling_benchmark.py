@@ -0,0 +1,59 @@
+"""
+Cost of Monte-Carlo sampling of the latents: FullModel.sample_latents (one encoder pass, S samples drawn in one op and
+propagated as one batch through the higher modules) vs S separate calls of forward_through_module. Uses synthetic
+waveforms, so no dataset is needed.
+
+Example usage:
+    python -m benchmarks.latent_sampling_benchmark --nb_samples 1 4 16 --module_idx -1
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.full_model_benchmark import load_options, _sync
+from models.full_model import FullModel
+from utils.utils import set_seed
+
+
+def _time(fn, device, nb_steps) -> float:
+    fn()  # warm-up
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(nb_steps):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - start) / nb_steps
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Batched vs repeated Monte-Carlo sampling of the latents.")
+    parser.add_argument('--config', type=str, default="sim_audio_de_boer_distr_true")
+    parser.add_argument('--length', type=int, default=10240, help='Audio length (samples)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--nb_samples', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--module_idx', type=int, default=-1, help='-1: last cnn module')
+    parser.add_argument('--steps', type=int, default=3)
+    args = parser.parse_args()
+
+    opt = load_options(args.config)
+    set_seed(0)
+    device = opt.device
+    model = FullModel(opt).to(device).eval()
+    x = torch.randn(args.batch_size, 1, args.length, device=device)
+
+    print(f"{'S':>4} {'batched (ms)':>13} {'separate (ms)':>14} {'per sample batched':>19} "
+          f"{'per sample separate':>20} {'speed-up':>9}")
+    with torch.no_grad():
+        for nb_samples in args.nb_samples:
+            batched = _time(lambda: model.sample_latents(x, nb_samples, args.module_idx), device, args.steps)
+            separate = _time(lambda: [model.forward_through_module(x, args.module_idx) for _ in range(nb_samples)],
+                             device, args.steps)
+            print(f"{nb_samples:>4} {1000 * batched:>13.1f} {1000 * separate:>14.1f} "
+                  f"{1000 * batched / nb_samples:>19.1f} {1000 * separate / nb_samples:>20.1f} "
+                  f"{separate / batched:>8.2f}x")
+
+
+if __name__ == "__main__":
+    _main()
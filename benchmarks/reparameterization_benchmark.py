@@ -0,0 +1,125 @@
+"""
+Memory/time of the reparameterization + KLD of a SIM module: the default path (IndependentModule._reparameterize for
+c and z + _kld_loss) vs `fused_reparameterization`, with and without `reparameterization_recompute` (see
+models/fused_reparameterization.py). Runs forward + backward on random (mu, log_var) of shape B x L x C, so no model or
+dataset is needed.
+
+Example usage (the defaults correspond to the output of the first module of SIM on De Boer):
+    python -m benchmarks.reparameterization_benchmark --batch_size 8 --frames 511 --channels 512
+
+Memory is the size of the tensors kept for the backward pass, in units of one B x L x C activation (mu, log_var and
+the sample(s) included). Peak memory of the whole step is only measured on cuda.
+Before timing, the fused paths are checked against the default path with the same noise.
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.full_model_benchmark import _sync, _reset_peak_memory, _peak_memory_mb
+from models.fused_reparameterization import reparameterize_with_kld
+from models.independent_module import IndependentModule
+
+
+def default_path(mu, log_var):
+    c = IndependentModule._reparameterize(None, mu, log_var)
+    z = IndependentModule._reparameterize(None, mu, log_var)
+    return c, z, IndependentModule._kld_loss(mu, log_var)
+
+
+def fused_path(recompute):
+    def fn(mu, log_var):
+        sample, kld_loss = reparameterize_with_kld(mu, log_var, recompute=recompute)
+        return sample, sample, kld_loss
+
+    return fn
+
+
+def _loss(c, z, kld_loss):
+    # some function of the samples, such that the gradients through the samples are not trivial
+    return (c * z).mean() + kld_loss
+
+
+def saved_activations(fn, mu, log_var) -> float:
+    """
+    Size of the tensors saved for the backward pass, each storage counted once, in units of mu. Includes the tensors
+    saved by the consumer of c and z (the samples), which the encoder would keep alive anyway.
+    """
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        _loss(*fn(mu, log_var))
+    return sum(storages.values()) / (mu.numel() * mu.element_size())
+
+
+def check_gradients(fn, mu, log_var):
+    """Compares with the default path for the same noise: the single sample of the fused path is used for c and z."""
+    leaves = [tensor.detach().clone().requires_grad_() for tensor in (mu, log_var)]
+    torch.manual_seed(0)
+    c, _, kld_ref = default_path(*leaves)
+    _loss(c, c, kld_ref).backward()
+    grads_ref = [leaf.grad for leaf in leaves]
+
+    leaves = [tensor.detach().clone().requires_grad_() for tensor in (mu, log_var)]
+    torch.manual_seed(0)
+    sample, _, kld_loss = fn(*leaves)
+    _loss(sample, sample, kld_loss).backward()
+
+    errors = [(sample - c).abs().max(), (kld_loss - kld_ref).abs() / kld_ref.abs()] + \
+             [(leaf.grad - grad).abs().max() / grad.abs().max() for leaf, grad in zip(leaves, grads_ref)]
+    return [float(error.detach()) for error in errors]
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Memory/time of the reparameterization + KLD of a SIM module.")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=511)
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    # B x L x C, as permuted in IndependentModule._get_latent_params
+    mu = torch.randn(args.batch_size, args.channels, args.frames, device=device).permute(0, 2, 1)
+    log_var = (torch.randn(args.batch_size, args.channels, args.frames, device=device) - 1).permute(0, 2, 1)
+    activation_mb = mu.numel() * mu.element_size() / 2 ** 20
+    print(f"Activation: {tuple(mu.shape)}, {activation_mb:.1f} MB")
+
+    cases = [("default", default_path), ("fused", fused_path(False)), ("fused+recompute", fused_path(True))]
+    print(f"{'path':<16} {'max |c err|':>12} {'kld rel err':>12} {'d_mu rel err':>13} {'d_logvar rel err':>17} "
+          f"{'saved (x act.)':>15} {'peak (MB)':>10} {'fwd+bwd (ms)':>13}")
+    for name, fn in cases:
+        errors = check_gradients(fn, mu, log_var) if name != "default" else [0.0] * 4
+
+        leaves = [tensor.detach().clone().requires_grad_() for tensor in (mu, log_var)]
+        saved = saved_activations(fn, *leaves)
+
+        def step():
+            _loss(*fn(*leaves)).backward()
+            for leaf in leaves:
+                leaf.grad = None
+
+        step()  # warm-up
+        _reset_peak_memory(device)
+        _sync(device)
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            step()
+        _sync(device)
+        elapsed = (time.perf_counter() - start) / args.steps
+        peak = _peak_memory_mb(device)
+        peak = f"{peak:.1f}" if peak is not None else "-"
+
+        print(f"{name:<16} {errors[0]:>12.2e} {errors[1]:>12.2e} {errors[2]:>13.2e} {errors[3]:>17.2e} "
+              f"{saved:>15.1f} {peak:>10} {1000 * elapsed:>13.1f}")
+
+
+if __name__ == "__main__":
+    _main()
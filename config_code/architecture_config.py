@@ -1,13 +1,26 @@
 from typing import Optional, List, Union
 
 
+def conv_output_length(length, kernel_size, stride, padding=0) -> int:
+    return (length + 2 * padding - kernel_size) // stride + 1
+
+
+def conv_stack_lengths(length, kernel_sizes, strides, paddings) -> List[int]:
+    """[input length, length after layer 0, after layer 1, ...]"""
+    lengths = [length]
+    for kernel_size, stride, padding in zip(kernel_sizes, strides, paddings):
+        lengths.append(conv_output_length(lengths[-1], kernel_size, stride, padding))
+    return lengths
+
+
 class ModuleConfig:
     def __init__(self,
                  max_pool_k_size: Optional[int], max_pool_stride: Optional[int], kernel_sizes: list,
                  is_autoregressor: bool, prediction_step: int, predict_distributions: bool,
                  strides: list, padding: list, non_linearities: list, cnn_hidden_dim: int,
                  regressor_hidden_dim: Optional[int],
-                 is_cnn_and_autoregressor: Optional[bool] = False):  # for CPC
+                 is_cnn_and_autoregressor: Optional[bool] = False,  # for CPC
+                 activation_checkpointing: Optional[bool] = False):
         assert len(kernel_sizes) == len(strides) == len(padding)
 
         if is_autoregressor and not (is_cnn_and_autoregressor):
@@ -38,12 +51,16 @@ class ModuleConfig:
         self.is_autoregressor = is_autoregressor
         self.is_cnn_and_autoregressor = is_cnn_and_autoregressor  # relevant in CPC, where a single module has both cnn and autoregressor layers
 
+        # Recompute the activations of the conv layers during the backward pass instead of storing them (see
+        # CNNEncoder). Less memory for long inputs (eg several seconds of LibriSpeech), at the cost of a second forward.
+        self.activation_checkpointing = activation_checkpointing
+
     def __str__(self):
         return f"ModuleConfig(max_pool_k_size={self.max_pool_k_size}, max_pool_stride={self.max_pool_stride}, " \
                f"kernel_sizes={self.kernel_sizes}, strides={self.strides}, padding={self.padding}, " \
                f"cnn_hidden_dim={self.cnn_hidden_dim}, regressor_hidden_dim={self.regressor_hidden_dim}, " \
                f"prediction_step={self.prediction_step}, predict_distributions={self.predict_distributions}, " \
-               f"is_autoregressor={self.is_autoregressor}"
+               f"is_autoregressor={self.is_autoregressor}, activation_checkpointing={self.activation_checkpointing}"
 
     @staticmethod
     def get_modules_from_list(kernel_sizes, strides, paddings, cnn_hidden_dim, predict_distribution):
@@ -117,7 +134,7 @@ class VisionArchitectureConfig:
 
 class DecoderArchitectureConfig:
     def __init__(self, kernel_sizes: List[int], strides: List[int], paddings: List[int], output_paddings: List[int],
-                 input_dim: int, hidden_dim: int, output_dim: int, expected_nb_frames_latent_repr: int):
+                 input_dim: int, hidden_dim: int, output_dim: int):
         assert len(kernel_sizes) == len(strides) == len(paddings) == len(output_paddings)
         self.kernel_sizes = kernel_sizes
         self.strides = strides
@@ -127,7 +144,10 @@ class DecoderArchitectureConfig:
         self.hidden_dim = hidden_dim
         self.output_dim = output_dim
 
-        self.expected_nb_frames_latent_repr: int = expected_nb_frames_latent_repr  # eg 64, used for Gaussian Sampling
+    def nb_frames_latent_repr(self, audio_length) -> int:
+        """Nb of frames of the latent representation that is decoded to `audio_length` samples, eg 64 for 10240."""
+        # the decoder mirrors the encoder layers, so run the encoder layers (in reverse decoder order) forward
+        return conv_stack_lengths(audio_length, self.kernel_sizes[::-1], self.strides[::-1], self.paddings[::-1])[-1]
 
     def __str__(self):
         return (f"DecoderArchitectureConfig(kernel_sizes={self.kernel_sizes}, strides={self.strides}, "
@@ -0,0 +1,248 @@
+"""
+Static shape and cost planner for the audio encoder (ArchitectureConfig). Computes, without building the model, for
+every module and layer: the number of output frames, receptive field and hop size (in audio samples), the number of
+parameters, the FLOPs per sample and the memory of the activations stored for the backward pass.
+
+Also used to derive the frame counts and output paddings of the decoders (see SIMSetup), such that they are never
+hardcoded. Example, which also suggests the largest batch size that fits in 16GB:
+    python -m config_code.architecture_planner sim_audio_de_boer_distr_true --memory_budget_gb 16
+"""
+
+import argparse
+import importlib
+from typing import List, Optional
+
+from config_code.architecture_config import ArchitectureConfig, conv_output_length, conv_stack_lengths
+from config_code.config_classes import Dataset, DataSetConfig, EncoderConfig
+
+BYTES_PER_FLOAT = 4
+INFO_NCE_SUBSAMPLE_WIN = 128  # see InfoNCE_Loss
+
+
+def get_audio_length(dataset_config: DataSetConfig) -> int:
+    """Nb of samples of the audio crops returned by the datasets."""
+    if dataset_config.dataset == Dataset.DE_BOER:
+        return 55 * 160 if dataset_config.split_in_syllables else 64 * 160  # see DeBoerDataset.compute_audio_length
+    elif dataset_config.dataset in [Dataset.LIBRISPEECH, Dataset.LIBRISPEECH_SUBSET]:
+        return dataset_config.audio_length if dataset_config.audio_length is not None else 20480  # see LibriDataset
+    raise ValueError(f"Not an audio dataset: {dataset_config.dataset}")
+
+
+def conv_transpose_output_padding(in_length, target_length, kernel_size, stride, padding) -> int:
+    """Output padding such that a ConvTranspose1d maps `in_length` frames back to `target_length` frames."""
+    output_padding = target_length - ((in_length - 1) * stride - 2 * padding + kernel_size)
+    assert 0 <= output_padding < stride or (output_padding == 0 and stride == 1), \
+        f"Cannot map {in_length} to {target_length} frames with kernel {kernel_size}, stride {stride}"
+    return output_padding
+
+
+def decoder_output_paddings(length, kernel_sizes, strides, paddings) -> List[int]:
+    """
+    Output paddings of a decoder that mirrors the conv stack (decoder layer i inverts encoder layer n-1-i), such that
+    the decoder reconstructs exactly `length` samples.
+    """
+    lengths = conv_stack_lengths(length, kernel_sizes, strides, paddings)
+    output_paddings = [conv_transpose_output_padding(lengths[i + 1], lengths[i], kernel_sizes[i], strides[i], paddings[i])
+                       for i in range(len(kernel_sizes))]
+    return output_paddings[::-1]
+
+
+class LayerPlan:
+    def __init__(self, module_idx, layer_idx, kind, in_channels, out_channels, in_frames, out_frames,
+                 receptive_field, hop, params, flops, activation_floats):
+        self.module_idx = module_idx
+        self.layer_idx = layer_idx
+        self.kind = kind  # conv, max_pool, latent_head, autoregressor, info_nce
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.in_frames = in_frames
+        self.out_frames = out_frames
+        self.receptive_field = receptive_field  # in audio samples
+        self.hop = hop  # in audio samples
+        self.params = params
+        self.flops = flops  # forward pass, per sample
+        self.activation_floats = activation_floats  # stored for the backward pass, per sample
+
+    def __str__(self):
+        return (f"LayerPlan(module={self.module_idx}, layer={self.layer_idx}, kind={self.kind}, "
+                f"channels={self.in_channels}->{self.out_channels}, frames={self.in_frames}->{self.out_frames}, "
+                f"receptive_field={self.receptive_field}, hop={self.hop}, params={self.params}, flops={self.flops})")
+
+
+class ArchitecturePlan:
+    """
+    Shapes and costs of the encoder for inputs of `audio_length` samples. FLOPs count a multiply-add as 2 FLOPs, the
+    backward pass is estimated at twice the forward pass. Activation memory is an estimate of the tensors autograd
+    keeps alive per sample (conv/batchnorm/relu outputs, reparameterization, GRU states, InfoNCE predictions and
+    negatives); allocator overhead and workspace memory are not included.
+    """
+
+    def __init__(self, encoder_config: EncoderConfig, audio_length: int):
+        self.encoder_config = encoder_config
+        self.architecture: ArchitectureConfig = encoder_config.architecture
+        self.audio_length = audio_length
+        self.layers: List[LayerPlan] = []
+        self._plan()
+
+    def _plan(self):
+        frames, channels, receptive_field, hop = self.audio_length, 1, 1, 1
+        bn = self.encoder_config.use_batch_norm
+
+        for module_idx, module in enumerate(self.architecture.modules):
+            has_cnn = not module.is_autoregressor or module.is_cnn_and_autoregressor
+            if has_cnn:
+                for layer_idx, (kernel_size, stride, padding) in enumerate(
+                        zip(module.kernel_sizes, module.strides, module.padding)):
+                    out_frames = conv_output_length(frames, kernel_size, stride, padding)
+                    out_channels = module.cnn_hidden_dim
+                    receptive_field += (kernel_size - 1) * hop
+                    hop *= stride
+                    relu = module.non_linearities[layer_idx] if module.non_linearities else True
+                    params = channels * out_channels * kernel_size + out_channels + (2 * out_channels if bn and relu else 0)
+                    nb_stored = (1 + (1 if bn else 0) + 1) if relu else 1  # conv (+ batchnorm) + relu outputs
+                    self.layers.append(LayerPlan(
+                        module_idx, layer_idx, "conv", channels, out_channels, frames, out_frames, receptive_field,
+                        hop, params, 2 * channels * kernel_size * out_channels * out_frames,
+                        nb_stored * out_channels * out_frames))
+                    frames, channels = out_frames, out_channels
+
+                    if module.max_pool_k_size:
+                        out_frames = conv_output_length(frames, module.max_pool_k_size, module.max_pool_stride)
+                        receptive_field += (module.max_pool_k_size - 1) * hop
+                        hop *= module.max_pool_stride
+                        self.layers.append(LayerPlan(
+                            module_idx, layer_idx, "max_pool", channels, channels, frames, out_frames,
+                            receptive_field, hop, 0, channels * module.max_pool_k_size * out_frames,
+                            channels * out_frames))
+                        frames = out_frames
+
+                if module.activation_checkpointing:  # only the output of the conv layers is kept, see CNNEncoder
+                    convs = [layer for layer in self.module_layers(module_idx) if layer.kind in ["conv", "max_pool"]]
+                    for layer in convs:
+                        layer.activation_floats = 0
+                    convs[-1].activation_floats = channels * frames
+
+                # encoder_mu and encoder_var (1x1 convs), + sampling of c and z in SIM
+                predict_distributions = module.predict_distributions and not self.encoder_config.deterministic
+                nb_stored = 2  # mu, log_var
+                if predict_distributions and not self.encoder_config.fused_reparameterization:
+                    nb_stored += 4  # std, eps, c, z
+                elif predict_distributions:  # single sample for c and z (+ std, eps, unless recomputed)
+                    nb_stored += 1 if self.encoder_config.reparameterization_recompute else 3
+                self.layers.append(LayerPlan(
+                    module_idx, len(module.kernel_sizes), "latent_head", channels, channels, frames, frames,
+                    receptive_field, hop, 2 * (channels * channels + channels), 2 * 2 * channels * channels * frames,
+                    nb_stored * channels * frames))
+
+            loss_hidden = channels
+            if module.is_autoregressor:
+                hidden = module.regressor_hidden_dim
+                gates = 3 * (channels * hidden + hidden * hidden + 2 * hidden)
+                self.layers.append(LayerPlan(
+                    module_idx, len(module.kernel_sizes), "autoregressor", channels, hidden, frames, frames,
+                    receptive_field, hop, gates, 2 * (gates - 6 * hidden) * frames, 4 * hidden * frames))
+                loss_hidden = hidden
+
+            # InfoNCE: predictor on a subsampled window, negatives drawn from the full sequence, and scores against
+            # the memory bank (not counted as activations: the bank itself is a fixed buffer)
+            k = module.prediction_step
+            window = min(frames, INFO_NCE_SUBSAMPLE_WIN) if self.encoder_config.subsample else frames
+            windows = self.encoder_config.subsample_windows
+            if self.encoder_config.subsample and windows > 0 and frames > INFO_NCE_SUBSAMPLE_WIN:
+                window *= max(min(windows, frames // INFO_NCE_SUBSAMPLE_WIN), 1)  # positions of all windows
+            neg = self.encoder_config.negative_samples
+            bank = self.encoder_config.negative_bank_size
+            chunk = self.encoder_config.negative_chunk_size
+            if chunk > 0:  # indices of the negatives (int64) and the log-sum-exp of every chunk
+                nb_chunks = -(-neg // chunk) + -(-bank // chunk)
+                negatives_floats = 2 * neg * frames + nb_chunks * window * k
+            else:
+                negatives_floats = channels * neg * frames + 2 * bank * window * k
+            rank = self.encoder_config.predictor_rank
+            if rank > 0:  # shared projection to `rank` dims + a rank x channels transform per prediction step
+                predictor_params = loss_hidden * rank + k * rank * channels
+                predictor_floats = rank * window
+            else:
+                predictor_params = loss_hidden * channels * k
+                predictor_floats = 0
+            self.layers.append(LayerPlan(
+                module_idx, len(module.kernel_sizes) + 1, "info_nce", loss_hidden, channels * k, window, window,
+                receptive_field, hop, predictor_params,
+                2 * predictor_params * window + 2 * channels * (neg + 1 + bank) * window * k,
+                channels * k * window + predictor_floats + negatives_floats))
+
+    def module_layers(self, module_idx) -> List[LayerPlan]:
+        return [layer for layer in self.layers if layer.module_idx == module_idx]
+
+    def output_frames(self, module_idx, layer_idx: Optional[int] = -1) -> int:
+        """Frames at the output of the module (layer_idx=-1) or of a conv layer of the module."""
+        if layer_idx == -1:
+            return [layer for layer in self.module_layers(module_idx) if layer.kind != "info_nce"][-1].out_frames
+        convs = [layer for layer in self.module_layers(module_idx) if layer.kind in ["conv", "max_pool"]]
+        return [layer for layer in convs if layer.layer_idx == layer_idx][-1].out_frames
+
+    @property
+    def params(self) -> int:
+        return sum(layer.params for layer in self.layers)
+
+    @property
+    def flops_per_sample(self) -> int:
+        """Forward + backward"""
+        return 3 * sum(layer.flops for layer in self.layers)
+
+    @property
+    def activation_bytes_per_sample(self) -> int:
+        return BYTES_PER_FLOAT * sum(layer.activation_floats for layer in self.layers)
+
+    def training_memory_bytes(self, batch_size) -> int:
+        # parameters, gradients and the two Adam moments
+        return 4 * BYTES_PER_FLOAT * self.params + batch_size * self.activation_bytes_per_sample
+
+    def max_batch_size(self, memory_budget_bytes) -> int:
+        """Largest batch size of which the estimated training memory fits in the budget."""
+        free = memory_budget_bytes - 4 * BYTES_PER_FLOAT * self.params
+        return max(int(free // self.activation_bytes_per_sample), 0)
+
+    def summary_table(self) -> str:
+        lines = [f"{'module':>6} {'layer':>5} {'kind':<14} {'channels':>11} {'frames':>13} {'recept. field':>13} "
+                 f"{'hop':>5} {'params':>10} {'MFLOPs':>9} {'act. (MB)':>9}"]
+        for layer in self.layers:
+            lines.append(
+                f"{layer.module_idx:>6} {layer.layer_idx:>5} {layer.kind:<14} "
+                f"{f'{layer.in_channels}->{layer.out_channels}':>11} {f'{layer.in_frames}->{layer.out_frames}':>13} "
+                f"{layer.receptive_field:>13} {layer.hop:>5} {layer.params:>10} {layer.flops / 1e6:>9.1f} "
+                f"{BYTES_PER_FLOAT * layer.activation_floats / 2 ** 20:>9.2f}")
+        lines.append(f"Total: {self.params:,} params, {self.flops_per_sample / 1e9:.2f} GFLOPs per sample "
+                     f"(forward + backward), {self.activation_bytes_per_sample / 2 ** 20:.1f} MB activations per sample")
+        return "\n".join(lines)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Shapes and costs of the encoder of a config.")
+    parser.add_argument('config_file', type=str, help='eg: sim_audio_de_boer_distr_true')
+    parser.add_argument('--audio_length', type=int, default=None, help='Default: length of the dataset of the config')
+    parser.add_argument('--memory_budget_gb', type=float, default=None, help='Suggest the max batch size for this')
+    parser.add_argument('--activation_checkpointing', action='store_true', help='Enable it in all modules')
+    args = parser.parse_args()
+
+    opt = importlib.import_module(f"configs.{args.config_file}")._get_options(experiment_name="planner")
+    encoder_config = opt.encoder_config
+    if args.activation_checkpointing:
+        for module in encoder_config.architecture.modules:
+            module.activation_checkpointing = True
+    audio_length = args.audio_length if args.audio_length is not None else get_audio_length(encoder_config.dataset)
+
+    plan = ArchitecturePlan(encoder_config, audio_length)
+    print(f"Input: {audio_length} samples")
+    print(plan.summary_table())
+
+    batch_size = encoder_config.dataset.batch_size
+    print(f"Estimated training memory at batch size {batch_size}: "
+          f"{plan.training_memory_bytes(batch_size) / 2 ** 30:.2f} GB")
+    if args.memory_budget_gb is not None:
+        print(f"Largest batch size for {args.memory_budget_gb} GB: "
+              f"{plan.max_batch_size(args.memory_budget_gb * 2 ** 30)}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -39,13 +39,47 @@ class DataSetConfig:
     def __init__(self, dataset: Dataset, batch_size, labels: Optional[str] = None,
                  limit_train_batches: Optional[float] = 1.0, limit_validation_batches: Optional[float] = 1.0,
                  grayscale: Optional[bool] = False, split_in_syllables: Optional[bool] = False,
-                 num_workers: Optional[int] = 0):
+                 num_workers: Optional[int] = 0, crops_per_file: Optional[int] = 1,
+                 shuffle_buffer_size: Optional[int] = 1024, non_overlapping_crops: Optional[bool] = True,
+                 use_tar_shards: Optional[bool] = False, tar_shards_dir: Optional[str] = "LibriSpeech100_shards",
+                 decode_threads: Optional[int] = 4, resident: Optional[bool] = False,
+                 pin_memory: Optional[bool] = False, prefetch_factor: Optional[int] = 2,
+                 persistent_workers: Optional[bool] = True, batch_resample: Optional[bool] = False,
+                 audio_length: Optional[int] = None, drop_last: Optional[bool] = True):
         self.data_input_dir = './datasets/'
         self.dataset: Dataset = dataset
         self.split_in_syllables = split_in_syllables
         self.batch_size = batch_size
         self.batch_size_multiGPU = batch_size  # will be overwritten in model_utils.distribute_over_GPUs
         self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor  # only used if num_workers > 0, same for persistent_workers
+        self.persistent_workers = persistent_workers
+        # Drop the last incomplete batch of an epoch. Not needed for the encoder losses, which accept any batch size
+        self.drop_last = drop_last
+
+        # Only for librispeech: number of crops taken from each decoded file (1 = conventional map-style dataset).
+        # If > 1, the crops are mixed with crops from other files through a shuffle buffer of `shuffle_buffer_size`.
+        self.crops_per_file = crops_per_file
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.non_overlapping_crops = non_overlapping_crops
+
+        # Only for librispeech: length of the crops in samples (None: 20480). Longer crops, eg several seconds, may
+        # need `activation_checkpointing` in the ModuleConfigs to fit in memory.
+        self.audio_length = audio_length
+
+        # Only for librispeech: stream the files from uncompressed tar shards (see data/librispeech_shards.py),
+        # located in data_input_dir/tar_shards_dir/{train|test}. Files are decoded by `decode_threads` threads.
+        self.use_tar_shards = use_tar_shards
+        self.tar_shards_dir = tar_shards_dir
+        self.decode_threads = decode_threads
+
+        # Only for de_boer_sounds: load the whole split in a single tensor on the device (see data/resident_dataset.py)
+        self.resident = resident
+
+        # Only for de_boer_sounds: resample whole batches in the collate function (or once on the device if resident),
+        # instead of every clip separately in __getitem__
+        self.batch_resample = batch_resample
 
         if split_in_syllables:
             assert dataset in [Dataset.DE_BOER]
@@ -82,7 +116,16 @@ class EncoderConfig:
                  kld_weight, learning_rate, decay_rate,
                  train_w_noise, dataset: DataSetConfig,
                  deterministic: Optional[bool] = False,
-                 use_batch_norm: Optional[bool] = True
+                 use_batch_norm: Optional[bool] = True,
+                 negative_bank_size: Optional[int] = 0,
+                 negative_bank_staleness: Optional[int] = 1,
+                 negative_chunk_size: Optional[int] = 0,
+                 predictor_rank: Optional[int] = 0,
+                 subsample_windows: Optional[int] = 0,
+                 fused_reparameterization: Optional[bool] = False,
+                 reparameterization_recompute: Optional[bool] = False,
+                 hoisted_gru: Optional[bool] = False,
+                 hoisted_gru_chunk_size: Optional[int] = 0,
                  ):
         self.start_epoch = start_epoch
         self.num_epochs = num_epochs
@@ -96,6 +139,28 @@ class EncoderConfig:
         self.dataset = dataset
         self.use_batch_norm = use_batch_norm
 
+        # Additional negatives for InfoNCE from a FIFO memory bank of the encodings of the previous
+        # `negative_bank_staleness` steps, `negative_bank_size` encodings in total. 0: disabled (see InfoNCE_Loss)
+        self.negative_bank_size = negative_bank_size
+        self.negative_bank_staleness = negative_bank_staleness
+        # Score the negatives (in-batch and memory bank) in chunks of this size with an online log-sum-exp, such
+        # that the loss memory does not grow with the nb of negatives. 0: all at once (see InfoNCE_Loss)
+        self.negative_chunk_size = negative_chunk_size
+        # Factorized InfoNCE predictor: a projection to `predictor_rank` dims shared by all prediction steps, followed
+        # by a small rank x C transform per step. 0: a full C x (C * prediction_step) head (see InfoNCE_Loss)
+        self.predictor_rank = predictor_rank
+        # With `subsample`: nb of windows per sequence whose positive pairs are scored, each at its own offset drawn
+        # on the device (at most length // window). 0: a single window at the same offset for the whole batch
+        self.subsample_windows = subsample_windows
+        # SIM: a single sample for both c and z, drawn together with the KLD in one pass. With `reparameterization_recompute`,
+        # only mu, log_var and the sample are kept for the backward pass (see models/fused_reparameterization.py)
+        self.fused_reparameterization = fused_reparameterization
+        self.reparameterization_recompute = reparameterization_recompute
+        # On cpu: run the GRU of the autoregressor with the input projections of all frames in one matmul (per chunk
+        # of `hoisted_gru_chunk_size` frames, 0: all at once) and the recurrence compiled (see models/autoregressor.py)
+        self.hoisted_gru = hoisted_gru
+        self.hoisted_gru_chunk_size = hoisted_gru_chunk_size
+
         # Useful after training to get deterministic results. If True, the encoder will use mode of the posterior distribution
         self.deterministic = deterministic
 
@@ -105,7 +170,13 @@ class EncoderConfig:
                f"architecture={self.architecture}, kld_weight={self.kld_weight}, " \
                f"learning_rate={self.learning_rate}, decay_rate={self.decay_rate}, " \
                f"train_w_noise={self.train_w_noise}, dataset={self.dataset}, " \
-               f"deterministic={self.deterministic}, use_batch_norm={self.use_batch_norm})"
+               f"deterministic={self.deterministic}, use_batch_norm={self.use_batch_norm}, " \
+               f"negative_bank_size={self.negative_bank_size}, negative_bank_staleness={self.negative_bank_staleness}, " \
+               f"negative_chunk_size={self.negative_chunk_size}, predictor_rank={self.predictor_rank}, " \
+               f"subsample_windows={self.subsample_windows}, " \
+               f"fused_reparameterization={self.fused_reparameterization}, " \
+               f"reparameterization_recompute={self.reparameterization_recompute}, " \
+               f"hoisted_gru={self.hoisted_gru}, hoisted_gru_chunk_size={self.hoisted_gru_chunk_size})"
 
 
 class PostHocModel:  # Classifier or Decoder
@@ -204,6 +275,33 @@ class DecoderConfig(PostHocModel):
                 raise ValueError(f"A decoder architecture for module {module_idx} and layer {layer_idx} does not exist")
 
 
+class DistillationConfig:
+    """Knowledge distillation of a trained FullModel (teacher) into the FullModel of the config (student), see
+    encoder/distill.py"""
+
+    def __init__(self, teacher_config_file: str, teacher_save_dir: str, teacher_encoder_num: int,
+                 distill_weight: Optional[float] = 1.0, nce_weight: Optional[float] = 0.0,
+                 latency_batch_size: Optional[int] = 1, latency_steps: Optional[int] = 20):
+        # teacher: built from configs/<teacher_config_file>.py, weights of sim_logs/<teacher_save_dir>/model_<num>.ckpt
+        self.teacher_config_file = teacher_config_file
+        self.teacher_save_dir = teacher_save_dir
+        self.teacher_encoder_num = teacher_encoder_num
+
+        # loss of every student module: distill_weight * latent matching + nce_weight * InfoNCE + kld_weight * KLD
+        self.distill_weight = distill_weight
+        self.nce_weight = nce_weight
+
+        # latency of the report: inference (forward_through_all_modules) on cpu, batches of this size
+        self.latency_batch_size = latency_batch_size
+        self.latency_steps = latency_steps
+
+    def __str__(self):
+        return f"DistillationConfig(teacher_config_file={self.teacher_config_file}, " \
+               f"teacher_save_dir={self.teacher_save_dir}, teacher_encoder_num={self.teacher_encoder_num}, " \
+               f"distill_weight={self.distill_weight}, nce_weight={self.nce_weight}, " \
+               f"latency_batch_size={self.latency_batch_size}, latency_steps={self.latency_steps})"
+
+
 class OptionsConfig:
     def __init__(self, config_file, seed, validate, loss: Loss, encoder_config, experiment,
                  save_dir,
@@ -233,6 +331,17 @@ class OptionsConfig:
         self.log_path_latent = os.path.join(f'{root_logs}/{save_dir}', "latent_space")
 
         self.log_every_x_epochs = log_every_x_epochs
+        self.log_every_x_steps: int = 100  # training metrics are averaged on the device and logged every x steps
+        self.profile_hot_path: bool = False  # time/memory per module of forward, loss, backward (utils/hot_path_profiler)
+        # step-level checkpoints to resume mid-epoch (utils/resume_checkpoint.py). 0: only when receiving SIGTERM
+        self.checkpoint_every_x_steps: int = 0
+        self.checkpoint_on_sigterm: bool = True
+        self.resume_from_checkpoint: bool = True  # continue from <log_path>/resume.ckpt if it exists
+        # run the training step of every IndependentModule as one torch.compile'd graph (utils/compile_utils.py)
+        self.compile_modules: bool = False
+        # validate on snapshots of the weights in a worker process, without blocking training
+        # (validation/background_validation.py)
+        self.validate_in_background: bool = False
         self.model_path = f'{root_logs}/{save_dir}'
 
         self.encoder_config: EncoderConfig = encoder_config
@@ -240,9 +349,12 @@ class OptionsConfig:
         self.speakers_classifier_config: Optional[ClassifierConfig] = speakers_classifier_config
         self.syllables_classifier_config: Optional[ClassifierConfig] = syllables_classifier_config
         self.decoder_config: Optional[DecoderConfig] = decoder_config
+        # only set in the configs of students (eg sim_audio_de_boer_distr_true_student), see encoder/distill.py
+        self.distillation_config: Optional[DistillationConfig] = None
 
         self.vision_classifier_config: Optional[ClassifierConfig] = vision_classifier_config
         self.use_wandb = use_wandb
+        self.use_local_metrics: bool = False  # also write all metrics to <model_path>/metrics.jsonl (offline runs)
         self.train = train
 
         # None would be better but causes issue with param overrides
@@ -1,13 +1,15 @@
 from typing import Optional
 
 from config_code.architecture_config import ArchitectureConfig, ModuleConfig, DecoderArchitectureConfig
+from config_code.architecture_planner import get_audio_length, decoder_output_paddings
 from config_code.config_classes import EncoderConfig, DataSetConfig, Dataset, OptionsConfig, Loss, ClassifierConfig, \
     DecoderConfig, DecoderLoss
 
 
 class SIMSetup:
     def __init__(self, predict_distributions: bool, dataset: Dataset, config_file: str, is_cpc: bool,
-                 conventional_cpc: Optional[bool] = None):
+                 conventional_cpc: Optional[bool] = None, cnn_hidden_dim: Optional[int] = None,
+                 regressor_hidden_dim: Optional[int] = None):
 
         # `conventional_cpc` is without the additional layers. alternative is with the additional layers to have same # layers as in our proposal (due to reparametrization trick)
         if is_cpc:
@@ -15,7 +17,13 @@ class SIMSetup:
 
         self.config_file = config_file
 
+        # a narrower encoder than the default of get_layer_params, eg a student for distillation (see encoder/distill.py)
+        self.cnn_hidden_dim = cnn_hidden_dim
+        self.regressor_hidden_dim = regressor_hidden_dim
+
         kernel_sizes, strides, padding, cnn_hidden_dim, regressor_hidden_dim, prediction_step_k, max_pool_stride, max_pool_k_size = self.get_layer_params()
+        cnn_hidden_dim = self.cnn_hidden_dim or cnn_hidden_dim
+        regressor_hidden_dim = self.regressor_hidden_dim or regressor_hidden_dim
 
         if conventional_cpc or not (is_cpc):  # also for gim/sim
             non_linearities = [True] * len(kernel_sizes)
@@ -156,19 +164,20 @@ class SIMSetup:
         )
 
         nb_of_cnn_modules = 3  # 4th module is the autoregressor
+        decoder_dataset = DataSetConfig(
+            dataset=dataset,
+            split_in_syllables=False,
+            batch_size=64,
+            limit_train_batches=1.0,
+            limit_validation_batches=1.0,
+            num_workers=1
+        )
         self.DECODER_CONFIG = DecoderConfig(
             num_epochs=200,
             learning_rate=2e-4,
-            dataset=DataSetConfig(
-                dataset=dataset,
-                split_in_syllables=False,
-                batch_size=64,
-                limit_train_batches=1.0,
-                limit_validation_batches=1.0,
-                num_workers=1
-            ),
+            dataset=decoder_dataset,
             encoder_num=self.ENCODER_CONFIG.num_epochs - 1,
-            architectures=[self.construct_architecture_for_module(modul_idx)
+            architectures=[self.construct_architecture_for_module(modul_idx, get_audio_length(decoder_dataset))
                            for modul_idx in range(nb_of_cnn_modules)],
             decoder_loss=DecoderLoss.MSE_MEL
         )
@@ -205,26 +214,28 @@ class SIMSetup:
 
         return kernel_sizes, strides, padding, cnn_hidden_dim, regressor_hidden_dim, prediction_step_k, max_pool_stride, max_pool_k_size
 
-    def construct_architecture_for_module(self, modul_idx: int) -> DecoderArchitectureConfig:
+    def construct_architecture_for_module(self, modul_idx: int, audio_length: int) -> DecoderArchitectureConfig:
         # Regardless of SIM or CPC w/ conventional_cpc or extra layers, use the same architecture for the decoder:
         kernel_sizes, strides, paddings, cnn_hidden_dim, regressor_hidden_dim, prediction_step_k, max_pool_stride, max_pool_k_size = self.get_layer_params()
+        cnn_hidden_dim = self.cnn_hidden_dim or cnn_hidden_dim
 
         if modul_idx == 0:
             layers_till_idx = 3
-            expected_nb_frames_latent_repr = 511
         elif modul_idx == 1:
             layers_till_idx = 1
-            expected_nb_frames_latent_repr = 129
         elif modul_idx == 2:  # all layers (so final module)
             layers_till_idx = 0
-            expected_nb_frames_latent_repr = 64
         else:
             raise ValueError(f"Invalid module index: {modul_idx}")
 
+        # such that the decoder output has exactly `audio_length` samples, eg [1, 0, 1, 3, 4] for all 5 layers
+        nb_layers = len(kernel_sizes) - layers_till_idx
+        output_paddings = decoder_output_paddings(
+            audio_length, kernel_sizes[:nb_layers], strides[:nb_layers], paddings[:nb_layers])
+
         kernel_sizes = (kernel_sizes[::-1])[layers_till_idx:]
         strides = (strides[::-1])[layers_till_idx:]
         paddings = (paddings[::-1])[layers_till_idx:]
-        output_paddings = [1, 0, 1, 3, 4][layers_till_idx:]
 
         if modul_idx == 0:  # make the architecture a bit more complex by adding some layers
             assert len(kernel_sizes) == 2, "Only two layers are expected for the first module"
@@ -244,5 +255,4 @@ class SIMSetup:
             input_dim=cnn_hidden_dim,
             hidden_dim=cnn_hidden_dim,
             output_dim=1,
-            expected_nb_frames_latent_repr=expected_nb_frames_latent_repr  # used for Gaussian sampling
         )
@@ -0,0 +1,26 @@
+import os
+
+import torch
+from config_code.config_classes import OptionsConfig, Dataset, DistillationConfig
+from config_code.sim_setup import SIMSetup
+
+
+# Student of sim_audio_de_boer_distr_true for knowledge distillation (see encoder/distill.py): same layers, half the
+# channels of the cnn modules and the regressor.
+def _get_options(experiment_name) -> OptionsConfig:
+    config_file = os.path.basename(__file__)
+    sim_setup = SIMSetup(predict_distributions=True, dataset=Dataset.DE_BOER, config_file=config_file, is_cpc=False,
+                         cnn_hidden_dim=256, regressor_hidden_dim=128)
+    options = sim_setup.get_options(experiment_name)
+
+    options.distillation_config = DistillationConfig(
+        teacher_config_file="sim_audio_de_boer_distr_true",
+        teacher_save_dir="",  # experiment name of the teacher, eg --overrides distillation_config.teacher_save_dir=...
+        teacher_encoder_num=options.encoder_config.num_epochs - 1,
+    )
+
+    return options
+
+
+if __name__ == '__main__':
+    print(f"Cuda is available: {torch.cuda.is_available()}")
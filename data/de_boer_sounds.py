@@ -1,3 +1,4 @@
+import math
 import torch
 from torch.utils.data import Dataset
 import os
@@ -70,6 +71,13 @@ class DeBoerDataset(Dataset):
             audio_length = 64 * 160  # -> 10240 elements over 0.64 seconds
         return audio_length
 
+    def raw_audio_length(self):
+        """
+        Nb of samples (at the initial sample rate) needed to get `audio_length` samples after resampling. Includes a
+        margin of 64 samples such that the cropped samples are identical to resampling the full file and cropping after.
+        """
+        return math.ceil((self.audio_length + 64) * self.initial_sample_rate / self.target_sample_rate)
+
     def __getitem__(self, index):
         dir_id, filename = self.file_list[index]
         # eg: filename = bagigi_1_1_ba if split, else filename = bagigi_1
@@ -94,6 +102,12 @@ class DeBoerDataset(Dataset):
                 samplerate == self.initial_sample_rate
         ), "Watch out, samplerate is not consistent throughout the dataset!"
 
+        if self.opt.batch_resample:
+            # resampling is done afterwards on the whole batch (see data/batch_resample.py), only crop the raw audio
+            if not (self.split_into_syllables):
+                audio = audio[:, 0: self.raw_audio_length()]
+            return audio, filename, pronounced_syllable, full_word
+
         # resample: from 22050 to 16000
         audio = resample(audio,
                          curr_samplerate=self.initial_sample_rate,
@@ -2,10 +2,24 @@ import os
 import torch
 from torch.utils.data import dataset
 
-from data import de_boer_sounds, librispeech
+from data import de_boer_sounds, librispeech, librispeech_shards
+from data.resident_dataset import ResidentDataLoader
+from data.batch_resample import ResampleCollate, resample_batch
+from data.resumable_sampler import ResumableSampler
+from config_code.architecture_planner import get_audio_length
 from config_code.config_classes import DataSetConfig, Dataset
 
-def _dataloaders(dataset_options: DataSetConfig, specific_dir, train_sub_dir, test_sub_dir, shuffle):
+
+def _loader_kwargs(options: DataSetConfig) -> dict:
+    """DataLoader worker settings (see `data/loader_profiler.py` to find good values for the current machine)."""
+    kwargs = dict(num_workers=options.num_workers, pin_memory=options.pin_memory)
+    if options.num_workers > 0:  # only allowed in combination with workers
+        kwargs["prefetch_factor"] = options.prefetch_factor
+        kwargs["persistent_workers"] = options.persistent_workers
+    return kwargs
+
+
+def _dataloaders(dataset_options: DataSetConfig, specific_dir, train_sub_dir, test_sub_dir, shuffle, device):
     data_input_dir = dataset_options.data_input_dir
     train_dataset = de_boer_sounds.DeBoerDataset(
         dataset_options=dataset_options,
@@ -23,29 +37,50 @@ def _dataloaders(dataset_options: DataSetConfig, specific_dir, train_sub_dir, te
         directory=test_sub_dir,
     )
 
+    collate_fn = None
+    resample_transform = None
+    if dataset_options.batch_resample:  # datasets return the raw audio, resample whole batches instead
+        audio_length = None if train_dataset.split_into_syllables else train_dataset.audio_length
+        collate_fn = ResampleCollate(train_dataset.initial_sample_rate, train_dataset.target_sample_rate, audio_length)
+        resample_transform = lambda audio: resample_batch(
+            audio, train_dataset.initial_sample_rate, train_dataset.target_sample_rate, audio_length)
+
+    if dataset_options.resident:  # small dataset, keep it in memory and skip the DataLoader
+        train_loader = ResidentDataLoader(train_dataset, dataset_options.batch_size_multiGPU, shuffle=shuffle,
+                                          drop_last=dataset_options.drop_last, device=device,
+                                          transform=resample_transform)
+        test_loader = ResidentDataLoader(test_dataset, dataset_options.batch_size_multiGPU, shuffle=shuffle,
+                                         drop_last=dataset_options.drop_last, device=device,
+                                         transform=resample_transform)
+        return train_loader, train_dataset, test_loader, test_dataset
+
+    # resumable in the middle of an epoch, see data/resumable_sampler.py
+    train_sampler = ResumableSampler(train_dataset, shuffle=shuffle)
     train_loader = torch.utils.data.DataLoader(
         dataset=train_dataset,
         batch_size=dataset_options.batch_size_multiGPU,
-        shuffle=shuffle,
-        drop_last=True,
-        num_workers=dataset_options.num_workers,
-        persistent_workers=True
+        sampler=train_sampler,
+        generator=train_sampler.generator,
+        drop_last=dataset_options.drop_last,
+        collate_fn=collate_fn,
+        **_loader_kwargs(dataset_options)
     )
 
     test_loader = torch.utils.data.DataLoader(
         dataset=test_dataset,
         batch_size=dataset_options.batch_size_multiGPU,
         shuffle=shuffle,
-        drop_last=True,
-        num_workers=dataset_options.num_workers,
-        persistent_workers=True
+        drop_last=dataset_options.drop_last,
+        collate_fn=collate_fn,
+        **_loader_kwargs(dataset_options)
     )
 
     return train_loader, train_dataset, test_loader, test_dataset
 
 
-def _get_de_boer_sounds_data_loaders(d_config: DataSetConfig, shuffle=True):
-    ''' Retrieve dataloaders where audio signals are split into syllables '''
+def _get_de_boer_sounds_data_loaders(d_config: DataSetConfig, shuffle=True, device=None):
+    ''' Retrieve dataloaders where audio signals are split into syllables
+    device: where the resident loaders keep the dataset (opt.device), None: the first gpu if available '''
     print("Loading De Boer Sounds dataset...")
 
     split: bool = d_config.split_in_syllables
@@ -56,7 +91,7 @@ def _get_de_boer_sounds_data_loaders(d_config: DataSetConfig, shuffle=True):
         specific_directory = "reshuffledv2"
 
     print(f"using {specific_directory} directory")
-    return _dataloaders(d_config, specific_directory, "train", "test", shuffle)
+    return _dataloaders(d_config, specific_directory, "train", "test", shuffle, device)
 
 
 def _get_libri_dataloaders(options: DataSetConfig):
@@ -74,15 +109,37 @@ def _get_libri_dataloaders(options: DataSetConfig):
     libri_dir = "LibriSpeech/train-clean-100"
     labels_dir = "LibriSpeech100_labels_split" if options.dataset == Dataset.LIBRISPEECH else "LibriSpeech100_labels_split_subset"
 
-    train_dataset = librispeech.LibriDataset(
-        os.path.join(
-            options.data_input_dir,
-            libri_dir,
-        ),
-        os.path.join(
-            options.data_input_dir, f"{labels_dir}/train_split.txt"
-        ),
-    )
+    if options.use_tar_shards:
+        return _get_libri_shard_dataloaders(options)
+
+    audio_length = get_audio_length(options)
+
+    if options.crops_per_file > 1:
+        print(f"Taking {options.crops_per_file} crops per file (shuffle buffer: {options.shuffle_buffer_size})")
+        train_dataset = librispeech.LibriMultiCropDataset(
+            os.path.join(
+                options.data_input_dir,
+                libri_dir,
+            ),
+            os.path.join(
+                options.data_input_dir, f"{labels_dir}/train_split.txt"
+            ),
+            audio_length=audio_length,
+            crops_per_file=options.crops_per_file,
+            shuffle_buffer_size=options.shuffle_buffer_size,
+            non_overlapping_crops=options.non_overlapping_crops,
+        )
+    else:
+        train_dataset = librispeech.LibriDataset(
+            os.path.join(
+                options.data_input_dir,
+                libri_dir,
+            ),
+            os.path.join(
+                options.data_input_dir, f"{labels_dir}/train_split.txt"
+            ),
+            audio_length=audio_length,
+        )
 
     test_dataset = librispeech.LibriDataset(
         os.path.join(
@@ -92,23 +149,67 @@ def _get_libri_dataloaders(options: DataSetConfig):
         os.path.join(
             options.data_input_dir, f"{labels_dir}/test_split.txt"
         ),
+        audio_length=audio_length,
     )
 
     batch_size_multiGPU = options.batch_size_multiGPU
+    if options.crops_per_file == 1:
+        train_sampler = ResumableSampler(train_dataset)
+        sampler_kwargs = dict(sampler=train_sampler, generator=train_sampler.generator)
+    else:  # the multi-crop dataset shuffles itself (iterable dataset) per (seed, epoch), the generator seeds the crops
+        sampler_kwargs = dict(generator=torch.Generator())
     train_loader = torch.utils.data.DataLoader(
         dataset=train_dataset,
         batch_size=batch_size_multiGPU,
-        shuffle=True,
-        drop_last=True,
-        num_workers=options.num_workers,
+        drop_last=options.drop_last,
+        **sampler_kwargs,
+        **_loader_kwargs(options)
     )
 
     test_loader = torch.utils.data.DataLoader(
         dataset=test_dataset,
         batch_size=batch_size_multiGPU,
         shuffle=False,
-        drop_last=True,
-        num_workers=options.num_workers,
+        drop_last=options.drop_last,
+        **_loader_kwargs(options)
+    )
+
+    return train_loader, train_dataset, test_loader, test_dataset
+
+
+def _get_libri_shard_dataloaders(options: DataSetConfig):
+    """
+    Same as _get_libri_dataloaders, but streams the audio files from the tar shards in `options.tar_shards_dir`.
+    """
+    print(f"Streaming LibriSpeech from tar shards in {options.tar_shards_dir}...")
+
+    datasets = []
+    for split in ["train", "test"]:
+        datasets.append(librispeech_shards.LibriTarShardDataset(
+            os.path.join(options.data_input_dir, options.tar_shards_dir, split),
+            audio_length=get_audio_length(options),
+            crops_per_file=options.crops_per_file,
+            shuffle_buffer_size=options.shuffle_buffer_size,
+            non_overlapping_crops=options.non_overlapping_crops,
+            decode_threads=options.decode_threads,
+        ))
+    train_dataset, test_dataset = datasets
+
+    # shuffling is done by the datasets themselves (iterable datasets) per (seed, epoch), see set_loader_epoch. The
+    # generator seeds the workers, which draw the crops
+    train_loader = torch.utils.data.DataLoader(
+        dataset=train_dataset,
+        batch_size=options.batch_size_multiGPU,
+        drop_last=options.drop_last,
+        generator=torch.Generator(),
+        **_loader_kwargs(options)
+    )
+
+    test_loader = torch.utils.data.DataLoader(
+        dataset=test_dataset,
+        batch_size=options.batch_size_multiGPU,
+        drop_last=options.drop_last,
+        **_loader_kwargs(options)
     )
 
     return train_loader, train_dataset, test_loader, test_dataset
@@ -1,4 +1,4 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import os
 import os.path
 import torchaudio
@@ -45,7 +45,7 @@ class LibriDataset(Dataset):
         # self.mean = -1456218.7500
         # self.std = 135303504.0
 
-    def __getitem__(self, index):
+    def _load_audio(self, index):
         speaker_id, dir_id, sample_id = self.file_list[index]
         filename = f"{speaker_id}-{dir_id}-{sample_id}"
         audio, samplerate = self.loader(
@@ -56,6 +56,11 @@ class LibriDataset(Dataset):
             samplerate == 16000
         ), "Watch out, samplerate is not consistent throughout the dataset!"
 
+        return audio, filename, speaker_id
+
+    def __getitem__(self, index):
+        audio, filename, speaker_id = self._load_audio(index)
+
         # discard last part that is not a full 10ms
         max_length = audio.size(1) // 160 * 160
 
@@ -115,3 +120,118 @@ class LibriDataset(Dataset):
         audio = audio.float() # TODO
 
         return audio, filename
+
+
+def crop_start_indices(max_length, audio_length, nb_crops, non_overlapping=True):
+    """
+    Start indices of `nb_crops` crops, all multiples of 160 (10ms) and >= 160, similar to LibriDataset.__getitem__.
+    If non_overlapping and the utterance is long enough, the crops don't overlap: the remaining space (slack) is
+    randomly distributed over the gaps between the crops. Otherwise, each start is drawn independently.
+    """
+    nb_starts = (max_length - audio_length - 160) // 160  # same range as np.arange(160, max - len, 160)
+    slack = nb_starts - 1 - (nb_crops - 1) * (audio_length // 160)
+
+    if non_overlapping and audio_length % 160 == 0 and slack >= 0:
+        # stars and bars: K sorted offsets in [0, slack] -> crop i starts after the i previous crops
+        offsets = sorted(random.randint(0, slack) for _ in range(nb_crops))
+        return [160 + (offset + i * (audio_length // 160)) * 160 for i, offset in enumerate(offsets)]
+
+    return [random.choice(np.arange(160, max_length - audio_length - 0, 160)) for _ in range(nb_crops)]
+
+
+class EpochShuffledIterableDataset(IterableDataset):
+    """
+    Iterable dataset that shuffles itself every epoch with a permutation that only depends on (seed, epoch): identical
+    in all DataLoader workers and DDP ranks (the seed must be the same on all ranks), such that each reader can take a
+    distinct part of it. Set through `set_epoch` (see data/resumable_sampler.py.set_loader_epoch).
+    """
+
+    seed = 0
+    epoch = 0
+
+    def set_epoch(self, epoch, seed=None):
+        self.epoch = epoch
+        if seed is not None:
+            self.seed = seed
+
+    def epoch_permutation(self, n):
+        """
+        Permutation of range(n) of the current epoch. Advances the epoch, as persistent workers keep their own copy of
+        the dataset (made at the first epoch) and don't see `set_epoch`: they iterate once per epoch.
+        """
+        permutation = np.random.default_rng(self.seed + self.epoch).permutation(n)
+        self.epoch += 1
+        return permutation
+
+
+def shuffle_with_buffer(items, buffer_size):
+    """
+    Approximate shuffle of an iterable, only keeping `buffer_size` items in memory.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+
+        # replace a random element of the buffer by the new item
+        buffer_idx = random.randrange(len(buffer))
+        yield buffer[buffer_idx]
+        buffer[buffer_idx] = item
+
+    random.shuffle(buffer)
+    yield from buffer
+
+
+class LibriMultiCropDataset(LibriDataset, EpochShuffledIterableDataset):
+    """
+    Iterable version of LibriDataset that takes `crops_per_file` crops from every decoded utterance instead of a
+    single one. Decoding the flac file is the expensive part, so this gives K times more training samples per decode.
+    Crops of the same utterance are mixed with crops of other utterances through a shuffle buffer, such that a batch
+    doesn't consist of (mostly) the same speaker.
+    """
+
+    def __init__(
+        self,
+        root,
+        flist,
+        crops_per_file=4,
+        shuffle_buffer_size=1024,
+        non_overlapping_crops=True,
+        audio_length=20480,
+        flist_reader=default_flist_reader,
+        loader=default_loader,
+    ):
+        super(LibriMultiCropDataset, self).__init__(
+            root, flist, audio_length=audio_length, flist_reader=flist_reader, loader=loader
+        )
+        assert crops_per_file >= 1, "crops_per_file must be at least 1"
+        self.crops_per_file = crops_per_file
+        self.shuffle_buffer_size = max(shuffle_buffer_size, 1)
+        self.non_overlapping_crops = non_overlapping_crops
+
+    def _file_indices_for_worker(self):
+        indices = self.epoch_permutation(len(self.file_list))
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+        return indices
+
+    def _crops_of_file(self, index):
+        audio, filename, speaker_id = self._load_audio(index)
+
+        # discard last part that is not a full 10ms
+        max_length = audio.size(1) // 160 * 160
+
+        for start_idx in crop_start_indices(max_length, self.audio_length, self.crops_per_file,
+                                            self.non_overlapping_crops):
+            crop = audio[:, start_idx: start_idx + self.audio_length].float()
+            yield crop, filename, speaker_id, 0
+
+    def __iter__(self):
+        crops = (item for index in self._file_indices_for_worker() for item in self._crops_of_file(index))
+        return shuffle_with_buffer(crops, self.shuffle_buffer_size)
+
+    def __len__(self):
+        return len(self.file_list) * self.crops_per_file
@@ -0,0 +1,195 @@
+"""
+Streaming LibriSpeech dataset that reads the utterances sequentially from uncompressed tar shards, instead of opening
+tens of thousands of small flac files by path (which is slow on networked filesystems).
+
+The shards are created once from the extracted dataset:
+    python -m data.librispeech_shards ./datasets/LibriSpeech/train-clean-100 \
+        ./datasets/LibriSpeech100_labels_split/train_split.txt ./datasets/LibriSpeech100_shards/train
+    python -m data.librispeech_shards ./datasets/LibriSpeech/train-clean-100 \
+        ./datasets/LibriSpeech100_labels_split/test_split.txt ./datasets/LibriSpeech100_shards/test
+"""
+
+import argparse
+import glob
+import io
+import itertools
+import os
+import random
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchaudio
+from torch.utils.data import get_worker_info
+
+from data.librispeech import default_flist_reader, crop_start_indices, shuffle_with_buffer, EpochShuffledIterableDataset
+
+SHARD_INDEX_FILE = "shards.txt"  # lines of "<shard name> <nb of utterances>"
+
+
+def bytes_loader(data: bytes):
+    return torchaudio.load(io.BytesIO(data), format="flac")
+
+
+def _rank_and_world_size():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class LibriTarShardDataset(EpochShuffledIterableDataset):
+    """
+    Iterates over the utterances in the tar shards of `shards_dir`. Each (DDP rank, DataLoader worker) pair reads a
+    distinct subset of the shards from start to end, decodes the flac files in a thread pool and applies the same
+    random 160-aligned crop as LibriDataset. Returns the same items as LibriDataset: (audio, filename, speaker_id, 0).
+    """
+
+    def __init__(
+            self,
+            shards_dir,
+            audio_length=20480,
+            crops_per_file=1,
+            shuffle_buffer_size=1024,
+            non_overlapping_crops=True,
+            decode_threads=4,
+            loader=bytes_loader,
+    ):
+        self.shards_dir = shards_dir
+        self.audio_length = audio_length
+        self.crops_per_file = crops_per_file
+        self.shuffle_buffer_size = max(shuffle_buffer_size, 1)
+        self.non_overlapping_crops = non_overlapping_crops
+        self.decode_threads = decode_threads
+        self.loader = loader
+
+        self.shards, self.shard_sizes = self._read_shard_index()  # shard paths, nb of utterances of every shard
+        self.nb_utterances = sum(self.shard_sizes)
+        assert len(self.shards) > 0, f"No tar shards found in {shards_dir}"
+
+    def _read_shard_index(self):
+        index_path = os.path.join(self.shards_dir, SHARD_INDEX_FILE)
+        if not os.path.exists(index_path):  # no index: count the files of every shard (reads only the tar headers)
+            shards = sorted(glob.glob(os.path.join(self.shards_dir, "*.tar")))
+            return shards, [self._count_utterances(shard) for shard in shards]
+
+        shards, shard_sizes = [], []
+        with open(index_path, "r") as f:
+            for line in f.read().splitlines():
+                name, nb_files = line.split(" ")
+                shards.append(os.path.join(self.shards_dir, name))
+                shard_sizes.append(int(nb_files))
+        return shards, shard_sizes
+
+    @staticmethod
+    def _count_utterances(shard_path):
+        with tarfile.open(shard_path, mode="r") as tar:  # uncompressed: seeks from header to header
+            return sum(1 for member in tar.getmembers() if member.isfile() and member.name.endswith(".flac"))
+
+    def _shards_for_worker(self):
+        """
+        Shards of this (rank, worker) pair and the nb of utterances it may read from them. The shard order of the epoch
+        only depends on (seed, epoch), see EpochShuffledIterableDataset. Every reader gets the same nb of shards (the
+        surplus shards of the epoch are skipped) and reads as many utterances as the reader with the smallest shards,
+        such that all ranks yield the same nb of batches (otherwise DDP hangs at the end of the epoch).
+        """
+        order = self.epoch_permutation(len(self.shards))
+
+        rank, world_size = _rank_and_world_size()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        reader_id = rank * num_workers + worker_id
+        nb_readers = world_size * num_workers
+        assert len(order) >= nb_readers, \
+            f"Less shards ({len(order)}) than readers ({nb_readers} = ranks x workers), re-pack with smaller shards"
+        order = order[:len(order) // nb_readers * nb_readers]
+
+        nb_utterances = min(sum(self.shard_sizes[i] for i in order[reader::nb_readers]) for reader in range(nb_readers))
+        return [self.shards[i] for i in order[reader_id::nb_readers]], nb_utterances
+
+    @staticmethod
+    def _read_shard(shard_path):
+        """Sequentially read the raw bytes of all flac files in the shard."""
+        with tarfile.open(shard_path, mode="r|") as tar:  # stream mode: no seeking
+            for member in tar:
+                if member.isfile() and member.name.endswith(".flac"):
+                    filename = os.path.basename(member.name)[:-len(".flac")]
+                    yield filename, tar.extractfile(member).read()
+
+    def _decode(self, filename, data):
+        audio, samplerate = self.loader(data)
+        assert (
+                samplerate == 16000
+        ), "Watch out, samplerate is not consistent throughout the dataset!"
+        return filename, audio
+
+    def _decoded_utterances(self, shards):
+        # Keep a bounded number of files in flight, such that reading (io) and decoding overlap
+        with ThreadPoolExecutor(max_workers=self.decode_threads) as pool:
+            in_flight = deque()
+            for shard in shards:
+                for filename, data in self._read_shard(shard):
+                    in_flight.append(pool.submit(self._decode, filename, data))
+                    if len(in_flight) >= 2 * self.decode_threads:
+                        yield in_flight.popleft().result()
+
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    def _crops(self, shards):
+        for filename, audio in self._decoded_utterances(shards):
+            speaker_id = filename.split("-")[0]
+
+            # discard last part that is not a full 10ms
+            max_length = audio.size(1) // 160 * 160
+
+            for start_idx in crop_start_indices(max_length, self.audio_length, self.crops_per_file,
+                                                self.non_overlapping_crops):
+                crop = audio[:, start_idx: start_idx + self.audio_length].float()
+                yield crop, filename, speaker_id, 0
+
+    def __iter__(self):
+        shards, nb_utterances = self._shards_for_worker()
+        crops = shuffle_with_buffer(self._crops(shards), self.shuffle_buffer_size)
+        return itertools.islice(crops, nb_utterances * self.crops_per_file)
+
+    def __len__(self):
+        # upper bound: the surplus shards and utterances of an epoch are skipped, see _shards_for_worker
+        _, world_size = _rank_and_world_size()
+        return self.nb_utterances * self.crops_per_file // world_size
+
+
+def repack(libri_dir, flist, output_dir, files_per_shard=1000, seed=0):
+    """
+    Pack the flac files of `flist` in uncompressed tar shards of `files_per_shard` files each. The files are shuffled
+    once, such that each shard contains a mix of speakers.
+    """
+    item_list, _ = default_flist_reader(flist)
+    random.Random(seed).shuffle(item_list)
+
+    os.makedirs(output_dir, exist_ok=True)
+    index_lines = []
+    for shard_idx, start in enumerate(range(0, len(item_list), files_per_shard)):
+        name = f"shard-{shard_idx:05d}.tar"
+        items = item_list[start: start + files_per_shard]
+        with tarfile.open(os.path.join(output_dir, name), mode="w") as tar:
+            for speaker_id, dir_id, sample_id in items:
+                filename = f"{speaker_id}-{dir_id}-{sample_id}.flac"
+                tar.add(os.path.join(libri_dir, speaker_id, dir_id, filename), arcname=filename)
+        index_lines.append(f"{name} {len(items)}")
+        print(f"Written {name} ({len(items)} files)")
+
+    with open(os.path.join(output_dir, SHARD_INDEX_FILE), "w") as f:
+        f.write("\n".join(index_lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-pack LibriSpeech flac files into uncompressed tar shards.")
+    parser.add_argument('libri_dir', type=str, help='eg: ./datasets/LibriSpeech/train-clean-100')
+    parser.add_argument('flist', type=str, help='eg: ./datasets/LibriSpeech100_labels_split/train_split.txt')
+    parser.add_argument('output_dir', type=str, help='eg: ./datasets/LibriSpeech100_shards/train')
+    parser.add_argument('--files_per_shard', type=int, default=1000)
+    args = parser.parse_args()
+
+    repack(args.libri_dir, args.flist, args.output_dir, args.files_per_shard)
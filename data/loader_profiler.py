@@ -0,0 +1,165 @@
+"""
+Input-pipeline instrumentation and DataLoader autotuning.
+
+`LoaderProfiler` measures, for every training step, how long the loop waited for the next batch (data wait) versus
+how long it spent on the step itself (compute). A high data-wait fraction means the GPU/CPU is starved by the loader.
+
+The autotune command sweeps num_workers, prefetch_factor and pin_memory for the dataset of a given config and stores
+the fastest settings in the log directory of the run (`loader_settings.json`). They are applied automatically by
+`encoder/train.py` for runs in that log directory. Example:
+    python -m data.loader_profiler temp sim_audio_libri_distr_true --overrides encoder_config.dataset.dataset=1
+"""
+
+import itertools
+import json
+import os
+import time
+
+import torch
+
+from config_code.config_classes import OptionsConfig, DataSetConfig
+
+LOADER_SETTINGS_FILE = "loader_settings.json"
+TUNED_ATTRIBUTES = ["num_workers", "prefetch_factor", "pin_memory"]
+
+
+class LoaderProfiler:
+    """
+    Wraps an iterable data loader. Usage:
+        profiler = LoaderProfiler()
+        for step, batch in enumerate(profiler.wrap(train_loader)):
+            ...
+        print(profiler.summary())
+    """
+
+    def __init__(self):
+        self.data_wait = []  # seconds per step
+        self.compute = []
+
+    def reset(self):
+        self.data_wait = []
+        self.compute = []
+
+    def wrap(self, loader):
+        iterator = iter(loader)
+        step_end = None
+        while True:
+            request_time = time.perf_counter()
+            if step_end is not None:  # time between handing out the previous batch and requesting the next one
+                self.compute.append(request_time - step_end)
+
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+
+            step_end = time.perf_counter()
+            self.data_wait.append(step_end - request_time)
+            yield batch
+
+    def last_step(self) -> (float, float):
+        data_wait = self.data_wait[-1] if self.data_wait else 0.0
+        compute = self.compute[-1] if self.compute else 0.0
+        return data_wait, compute
+
+    def summary(self) -> dict:
+        total_wait = sum(self.data_wait)
+        total_compute = sum(self.compute)
+        total = total_wait + total_compute
+        nb_steps = max(len(self.data_wait), 1)
+        return {
+            "data_wait_total": total_wait,
+            "compute_total": total_compute,
+            "data_wait_per_step": total_wait / nb_steps,
+            "compute_per_step": total_compute / max(len(self.compute), 1),
+            "data_wait_fraction": total_wait / total if total > 0 else 0.0,
+        }
+
+    def __str__(self):
+        s = self.summary()
+        return (f"Data wait: {s['data_wait_total']:.1f}s ({100 * s['data_wait_fraction']:.1f}%), "
+                f"compute: {s['compute_total']:.1f}s, "
+                f"per step: {1000 * s['data_wait_per_step']:.1f}ms wait / {1000 * s['compute_per_step']:.1f}ms compute")
+
+
+def _measure_throughput(dataset_config: DataSetConfig, device, nb_batches) -> float:
+    """Samples per second of the train loader, including the transfer to `device`."""
+    from data import get_dataloader
+
+    train_loader, _, _, _ = get_dataloader.get_dataloader(dataset_config)
+    iterator = iter(train_loader)
+    next(iterator)  # exclude worker start-up
+
+    starttime = time.perf_counter()
+    nb_samples = 0
+    for _, (audio, *_) in zip(range(nb_batches), iterator):
+        audio = audio.to(device, non_blocking=dataset_config.pin_memory)
+        nb_samples += audio.size(0)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    duration = time.perf_counter() - starttime
+
+    del iterator, train_loader  # stop the workers
+    return nb_samples / duration
+
+
+def autotune(opt: OptionsConfig, nb_batches=50, max_workers=None) -> dict:
+    """
+    Sweep the loader settings of the encoder dataset and return the fastest ones (also set on `opt`).
+    """
+    dataset_config = opt.encoder_config.dataset
+    max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+    workers = sorted({0, 1} | {w for w in [2, 4, 8, 16, 32] if w <= max_workers})
+    prefetch_factors = [2, 4, 8]
+    pin_memory = [False, True] if opt.device.type == "cuda" else [False]
+
+    results = []
+    for nb_workers, prefetch, pin in itertools.product(workers, prefetch_factors, pin_memory):
+        if nb_workers == 0 and prefetch != prefetch_factors[0]:  # prefetch_factor is ignored without workers
+            continue
+
+        settings = {"num_workers": nb_workers, "prefetch_factor": prefetch, "pin_memory": pin}
+        for attr, value in settings.items():
+            setattr(dataset_config, attr, value)
+
+        samples_per_sec = _measure_throughput(dataset_config, opt.device, nb_batches)
+        print(f"{settings}: {samples_per_sec:.1f} samples/s")
+        results.append((samples_per_sec, settings))
+
+    best_samples_per_sec, best = max(results, key=lambda r: r[0])
+    print(f"Best loader settings: {best} ({best_samples_per_sec:.1f} samples/s)")
+    for attr, value in best.items():
+        setattr(dataset_config, attr, value)
+    return best
+
+
+def save_loader_settings(opt: OptionsConfig, settings: dict):
+    path = os.path.join(opt.log_path, LOADER_SETTINGS_FILE)
+    with open(path, "w") as f:
+        json.dump(settings, f, indent=4)
+    print(f"Saved loader settings to {path}")
+
+
+def apply_loader_settings(opt: OptionsConfig, dataset_config: DataSetConfig):
+    """Overwrite the loader settings of `dataset_config` with the autotuned ones of this run, if they exist."""
+    path = os.path.join(opt.log_path, LOADER_SETTINGS_FILE)
+    if not os.path.exists(path):
+        return
+
+    with open(path, "r") as f:
+        settings = json.load(f)
+    for attr in TUNED_ATTRIBUTES:
+        if attr in settings:
+            setattr(dataset_config, attr, settings[attr])
+    print(f"Using autotuned loader settings from {path}: {settings}")
+
+
+if __name__ == "__main__":
+    from options import get_options
+    from arg_parser import arg_parser
+
+    options = get_options()
+    arg_parser.create_log_path(options)
+
+    best_settings = autotune(options)
+    save_loader_settings(options, best_settings)
@@ -0,0 +1,57 @@
+"""
+Sampler whose order only depends on (seed, epoch), and that can start in the middle of an epoch. Used for the training
+loaders such that a run that was stopped mid-epoch (see utils/resume_checkpoint.py) continues with exactly the batches
+it would have seen, without loading the batches that were already consumed.
+"""
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+    def __init__(self, data_source, shuffle=True, seed=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else int(torch.randint(2 ** 31, ()).item())
+
+        # also passed to the DataLoader, which draws the base seed of its workers from it
+        self.generator = torch.Generator()
+        self.epoch = 0
+        self.start_index = 0
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start_index=0):
+        """Order of epoch `epoch`, skipping its first `start_index` items."""
+        self.epoch = epoch
+        self.start_index = start_index
+        self.generator.manual_seed(self.seed + epoch)
+
+    def __iter__(self):
+        nb_items = len(self.data_source)
+        order = torch.randperm(nb_items, generator=self.generator) if self.shuffle else torch.arange(nb_items)
+        return iter(order[self.start_index:].tolist())
+
+    def __len__(self):
+        return max(len(self.data_source) - self.start_index, 0)
+
+
+def set_loader_epoch(loader, epoch, seed, start_batch=0) -> int:
+    """
+    Prepare `loader` for epoch `epoch`, starting at batch `start_batch`. Returns the number of batches that must still
+    be skipped by iterating over them: 0 if the loader has a ResumableSampler, otherwise (iterable datasets, which
+    shuffle themselves) `start_batch`. For the latter, the order of the files of the dataset (see
+    data/librispeech.py.EpochShuffledIterableDataset) and the seed of the workers are reset to (seed, epoch), such that
+    the skipped batches come from the same files as before.
+    """
+    sampler = getattr(loader, "sampler", None)
+    if isinstance(sampler, ResumableSampler):
+        sampler.seed = seed
+        sampler.set_epoch(epoch, start_batch * loader.batch_size)
+        return 0
+
+    dataset = getattr(loader, "dataset", None)
+    if hasattr(dataset, "set_epoch"):
+        dataset.set_epoch(epoch, seed)
+    if getattr(loader, "generator", None) is not None:
+        loader.generator.manual_seed(seed + epoch)
+    return start_batch
@@ -2,13 +2,15 @@ from typing import Dict
 
 import lightning as L
 import torch
-from lightning.pytorch.loggers import WandbLogger
+from lightning.pytorch.loggers import WandbLogger, Logger
+from lightning.pytorch.utilities import rank_zero_only
 from wandb import Audio
 
 from config_code.config_classes import OptionsConfig, Dataset
 from data import get_dataloader
 from decoder.interpolation_contribution_score import InterpolationContributionScore
 from decoder.lit_decoder import LitDecoder
+from utils.local_metrics import get_local_metrics_writer
 from utils.utils import get_audio_decoder_key
 
 
@@ -91,6 +93,30 @@ class CustomCallback(L.Callback):
                                     columns=["idx", "score"])
 
 
+class LocalMetricsLogger(Logger):
+    """Lightning logger that writes the `self.log` metrics of the LitDecoder to the local metrics file of the run."""
+
+    def __init__(self, opt: OptionsConfig):
+        super().__init__()
+        self.writer = get_local_metrics_writer(opt)
+
+    @property
+    def name(self):
+        return "local_metrics"
+
+    @property
+    def version(self):
+        return 0
+
+    @rank_zero_only
+    def log_hyperparams(self, params, *args, **kwargs):
+        pass
+
+    @rank_zero_only
+    def log_metrics(self, metrics: Dict[str, float], step=None):
+        self.writer.log(metrics, step)
+
+
 if __name__ == "__main__":
     import numpy as np
 
@@ -2,7 +2,8 @@ from typing import Dict
 import numpy as np
 import torch
 from data import get_dataloader
-from config_code.config_classes import OptionsConfig, Dataset
+from config_code.architecture_planner import get_audio_length
+from config_code.config_classes import OptionsConfig
 from decoder.lit_decoder import LitDecoder
 
 
@@ -10,18 +11,8 @@ class InterpolationContributionScore:
     def __init__(self, opt: OptionsConfig, nb_dims: int, lit_decoder: LitDecoder):
         self.opt = opt
         self.nb_dims = nb_dims
-        self.latent_nb_frames = (
-            opt.decoder_config.retrieve_correct_decoder_architecture()).expected_nb_frames_latent_repr
-        # latent_nb_frames is based on De_boer dataset, so overwrite it if librispeech
-        if opt.decoder_config.dataset.dataset in [Dataset.LIBRISPEECH, Dataset.LIBRISPEECH_SUBSET]:
-            if self.latent_nb_frames == 511:  # values based on encoder module that is selected
-                self.latent_nb_frames = 1023
-            elif self.latent_nb_frames == 129:
-                self.latent_nb_frames = 257
-            elif self.latent_nb_frames == 64:
-                self.latent_nb_frames = 128
-            else:
-                raise ValueError(f"latent_nb_frames: {self.latent_nb_frames}")
+        self.latent_nb_frames = opt.decoder_config.retrieve_correct_decoder_architecture().nb_frames_latent_repr(
+            get_audio_length(opt.decoder_config.dataset))  # eg 64 for De Boer, 128 for LibriSpeech (final module)
 
         self.lit_decoder = lit_decoder
 
@@ -2,7 +2,8 @@ import lightning as L
 import torch
 from torch import optim
 
-from config_code.config_classes import DecoderLoss, DecoderConfig, Dataset
+from config_code.architecture_planner import get_audio_length
+from config_code.config_classes import DecoderLoss, DecoderConfig
 from decoder.decoder_losses import MSE_Loss, SpectralLoss, MSE_AND_SPECTRAL_LOSS, FFTLoss, MSE_AND_FFT_LOSS, MEL_LOSS, \
     MSE_AND_MEL_LOSS, MEL_LOSS
 from decoder.decoderr import Decoder
@@ -26,9 +27,8 @@ class LitDecoder(L.LightningModule):
         self.save_hyperparameters(ignore=["decoder", "encoder", "opt"])
 
         # used to do a sanity check later
-        self.expected_nb_frames_latent_repr = \
-            self.dec_opt.retrieve_correct_decoder_architecture().expected_nb_frames_latent_repr
-        # only supported on de_boer dataset
+        self.expected_nb_frames_latent_repr = self.dec_opt.retrieve_correct_decoder_architecture() \
+            .nb_frames_latent_repr(get_audio_length(self.dec_opt.dataset))
 
     def encode(self, x):
         full_model: FullModel = self.encoder.module
@@ -42,13 +42,11 @@ class LitDecoder(L.LightningModule):
             else:  # specific layer of specified module
                 z = full_model.forward_through_layer(x, modul_idx, layer_idx)
 
-        # Sanity check. Sanity check is only
+        # Sanity check
         _, _, nb_frames = z.shape
-        if self.dec_opt.dataset.dataset == Dataset.DE_BOER:
-            # check only supported on de_boer dataset
-            assert (nb_frames == self.expected_nb_frames_latent_repr), \
-                (f"Expected {self.expected_nb_frames_latent_repr} frames, got {nb_frames} frames. "
-                 f"Reconsider decoder_config.encoder_module and decoder_config.encoder_layer provided in config.")
+        assert (nb_frames == self.expected_nb_frames_latent_repr), \
+            (f"Expected {self.expected_nb_frames_latent_repr} frames, got {nb_frames} frames. "
+             f"Reconsider decoder_config.encoder_module and decoder_config.encoder_layer provided in config.")
 
         return z.detach()
 
@@ -10,9 +10,10 @@ from lightning.pytorch.loggers import WandbLogger
 
 from arg_parser import arg_parser
 from config_code.architecture_config import DecoderArchitectureConfig
+from config_code.architecture_planner import get_audio_length
 from config_code.config_classes import OptionsConfig, ModelType, Dataset, DecoderLoss, DecoderConfig
 from data import get_dataloader
-from decoder.callbacks import CustomCallback
+from decoder.callbacks import CustomCallback, LocalMetricsLogger
 from decoder.decoderr import Decoder
 from decoder.lit_decoder import LitDecoder
 from decoder.my_data_module import MyDataModule
@@ -52,6 +53,7 @@ def main(model_type: ModelType = ModelType.ONLY_DOWNSTREAM_TASK):
     arg_parser.create_log_path(opt, key)
 
     wandb_logger = WandbLogger() if opt.use_wandb else None
+    loggers = [l for l in [wandb_logger, LocalMetricsLogger(opt) if opt.use_local_metrics else None] if l is not None]
 
     context_model, _ = load_audio_model.load_model_and_optimizer(
         opt,
@@ -77,7 +79,7 @@ def main(model_type: ModelType = ModelType.ONLY_DOWNSTREAM_TASK):
                      decoder_config.decoder_loss)
 
     z_dim = architecture.input_dim
-    nb_frames = architecture.expected_nb_frames_latent_repr
+    nb_frames = architecture.nb_frames_latent_repr(get_audio_length(decoder_config.dataset))
     callback = CustomCallback(opt, z_dim=z_dim, wandb_logger=wandb_logger, nb_frames=nb_frames,
                               plot_ever_n_epoch=5, loss_enum=loss_fun) # if opt.use_wandb else None
 
@@ -85,7 +87,7 @@ def main(model_type: ModelType = ModelType.ONLY_DOWNSTREAM_TASK):
                         max_epochs=decoder_config.num_epochs,
                         accelerator="gpu", devices="1",
                         log_every_n_steps=10,  # arbitrary number to avoid warning
-                        logger=wandb_logger, callbacks=[callback] if callback is not None else [],
+                        logger=loggers if loggers else None, callbacks=[callback] if callback is not None else [],
                         )
 
     if opt.train:
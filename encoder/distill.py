@@ -0,0 +1,254 @@
+"""
+Knowledge distillation of a trained FullModel (teacher) into a narrower or shallower FullModel (student), see
+models/distillation.py. The student is built from the config (eg sim_audio_de_boer_distr_true_student: half the
+channels), the teacher from `distillation_config.teacher_config_file` with the weights of
+sim_logs/<teacher_save_dir>/model_<teacher_encoder_num>.ckpt. Every student module learns to predict the latents of
+the teacher module at the same frame rate, optionally together with its InfoNCE objective
+(`distillation_config.nce_weight`).
+
+Example usage:
+    python -m encoder.distill distill_half sim_audio_de_boer_distr_true_student --overrides distillation_config.teacher_save_dir=final_bart/bart_full_audio_distribs_distr=true_kld=0 encoder_config.num_epochs=100 use_wandb=False
+Only the report, for a student that was already trained:
+    python -m encoder.distill distill_half sim_audio_de_boer_distr_true_student --overrides distillation_config.teacher_save_dir=final_bart/bart_full_audio_distribs_distr=true_kld=0 syllables_classifier_config.encoder_num=99 train=False use_wandb=False
+
+The student is saved as model_<epoch>.ckpt in its log directory, as by encoder/train.py, such that the classifiers and
+decoders can be trained on it with the student config. After training, both models are evaluated with the linear
+probe of the dataset (syllables for De Boer, speakers for LibriSpeech, on the output of the regressor as in
+linear_classifiers/), and the accuracies are reported next to the inference size and cpu latency of both models, in
+<log_path>/distillation_report.json.
+"""
+
+import copy
+import importlib
+import json
+import os
+import time
+from typing import Tuple
+
+import torch
+import wandb
+
+from arg_parser import arg_parser
+from config_code.architecture_planner import get_audio_length
+from config_code.config_classes import OptionsConfig, ModelType, Dataset, ClassifierConfig
+from data import get_dataloader
+from linear_classifiers import logistic_regression, logistic_regression_speaker
+from models.distillation import Distiller, inference_size, measure_latency
+from models.full_model import FullModel
+from models.loss_supervised_speaker import Speaker_Loss
+from models.loss_supervised_syllables import Syllables_Loss
+from options import get_options
+from utils import logger, model_utils
+from utils.local_metrics import log_metrics, local_metrics_sink
+from utils.metrics_accumulator import MetricsAccumulator, wandb_sink
+from utils.utils import set_seed, initialize_wandb, get_nb_classes
+
+
+def load_teacher(opt: OptionsConfig) -> Tuple[torch.nn.DataParallel, OptionsConfig]:
+    config = opt.distillation_config
+    assert config.teacher_save_dir != "", \
+        "Set distillation_config.teacher_save_dir, the experiment name of the teacher, eg with --overrides"
+
+    module = importlib.import_module(f"configs.{config.teacher_config_file}")
+    teacher_opt: OptionsConfig = module._get_options(experiment_name=config.teacher_save_dir)
+    teacher_opt.device = opt.device
+    teacher, _ = model_utils.distribute_over_GPUs(teacher_opt, FullModel(teacher_opt, calc_accuracy=True), num_GPU=1)
+
+    model_path = os.path.join(teacher_opt.model_path, f"model_{config.teacher_encoder_num}.ckpt")
+    print("Loading the teacher from ", model_path)
+    teacher.load_state_dict(torch.load(model_path, map_location=opt.device.type))
+    return teacher.eval(), teacher_opt
+
+
+def validate(opt: OptionsConfig, distiller: Distiller, test_loader) -> list:
+    """Average loss per student module on the validation set"""
+    total_step = max(int(len(test_loader) * opt.encoder_config.dataset.limit_validation_batches), 1)
+    distiller.eval()
+    loss_sum, nb_steps = 0, 0
+    with torch.no_grad():
+        for step, (audio, _, _, _) in enumerate(test_loader):
+            if step >= total_step:
+                break
+            loss, _, _, _, _ = distiller(audio.to(opt.device))
+            loss_sum, nb_steps = loss_sum + loss[0], nb_steps + 1
+    distiller.train()
+    return (loss_sum / max(nb_steps, 1)).tolist()
+
+
+def train(opt: OptionsConfig, logs: logger.Logger, distiller: Distiller, student, optimizer, train_loader,
+          test_loader):
+    total_step = int(len(train_loader) * opt.encoder_config.dataset.limit_train_batches)
+    print_idx = opt.log_every_x_steps
+    nb_modules = len(opt.encoder_config.architecture.modules)
+    start_epoch, num_epochs = opt.encoder_config.start_epoch, opt.encoder_config.num_epochs
+
+    metric_names = ["loss", "nce", "kld", "distill", "accuracy"]
+    sinks = ([wandb_sink] if opt.use_wandb else []) + ([local_metrics_sink(opt)] if opt.use_local_metrics else [])
+    metrics = MetricsAccumulator(metric_names, nb_modules, opt.device, sinks=sinks)
+    epoch_metrics = MetricsAccumulator(metric_names, nb_modules, opt.device)
+    global_step = 0
+    starttime = time.time()
+
+    distiller.train()
+    for epoch in range(start_epoch, num_epochs + start_epoch):
+        for step, (audio, _, _, _) in enumerate(train_loader):
+            if step % print_idx == 0:
+                print(f"Epoch [{epoch + 1}/{num_epochs + start_epoch}], Step [{step}/{total_step}], "
+                      f"Time (s): {time.time() - starttime:.1f}")
+            starttime = time.time()
+
+            loss, nce, kld, distill, accuracy = distiller(audio.to(opt.device))
+
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+
+            metrics.update(loss=loss[0], nce=nce[0], kld=kld[0], distill=distill[0], accuracy=accuracy[0])
+            epoch_metrics.update(loss=loss[0], nce=nce[0], kld=kld[0], distill=distill[0], accuracy=accuracy[0])
+
+            if step % print_idx == 0:
+                averages = metrics.flush(global_step, extra={'epoch': epoch})
+                for idx in range(nb_modules):
+                    print(f"\t \t Idx: {idx} \t \t Tot Loss: \t \t {averages['loss'][idx]:.4f} "
+                          f"\t \t Distill: {averages['distill'][idx]:.4f} \t \t NCE: {averages['nce'][idx]:.4f} "
+                          f"\t \t KLD: {averages['kld'][idx]:.4f}")
+
+            global_step += 1
+            if step >= total_step:
+                break
+
+        logs.append_train_loss(epoch_metrics.averages()["loss"])
+        epoch_metrics.reset()
+
+        if opt.validate:
+            validation_loss = validate(opt, distiller, test_loader)
+            logs.append_val_loss(validation_loss)
+            log_metrics(opt, {f"val_loss/val_loss_{i}": val_loss for i, val_loss in enumerate(validation_loss)},
+                        step=global_step)
+
+        if epoch % opt.log_every_x_epochs == 0 or epoch == num_epochs + start_epoch - 1:
+            logs.create_log(student, optimizer=optimizer, epoch=epoch)
+
+
+def _probe_config(opt: OptionsConfig) -> ClassifierConfig:
+    if opt.encoder_config.dataset.dataset == Dataset.DE_BOER:
+        return opt.syllables_classifier_config
+    return opt.speakers_classifier_config
+
+
+def probe_accuracy(opt: OptionsConfig, context_model) -> float:
+    """
+    Test accuracy of the linear probe of the dataset (syllables for De Boer, speakers for LibriSpeech) trained on the
+    representations of `context_model`, with the classifier configs of `opt`.
+    """
+    classifier_config = _probe_config(opt)
+    bias = classifier_config.bias
+    architecture = opt.encoder_config.architecture.modules[0]
+    n_features = architecture.regressor_hidden_dim if bias else architecture.cnn_hidden_dim
+    train_loader, _, test_loader, _ = get_dataloader.get_dataloader(classifier_config.dataset, device=opt.device)
+    logs = logger.Logger(opt)
+
+    set_seed(opt.seed)  # same initialization and order of the batches for both models
+    if opt.encoder_config.dataset.dataset == Dataset.DE_BOER:
+        num_classes = get_nb_classes(classifier_config.dataset.dataset, classifier_config.dataset.labels)
+        loss = Syllables_Loss(opt, n_features, calc_accuracy=True, num_syllables=num_classes, bias=bias)
+        optimizer = torch.optim.Adam(loss.parameters(), lr=classifier_config.learning_rate)
+        logistic_regression.train(opt, context_model, loss, logs, train_loader, optimizer, wandb_is_on=False,
+                                  bias=bias)
+        _, accuracy = logistic_regression.test(opt, context_model, loss, test_loader, wandb_is_on=False, bias=bias)
+    else:
+        loss = Speaker_Loss(opt, n_features, calc_accuracy=True, bias=bias)
+        optimizer = torch.optim.Adam(loss.parameters(), lr=classifier_config.learning_rate)
+        logistic_regression_speaker.train(opt, context_model, loss, logs, train_loader, optimizer, bias)
+        _, accuracy = logistic_regression_speaker.test(opt, context_model, loss, test_loader, bias)
+    return accuracy
+
+
+def _probe_options(model_opt: OptionsConfig, opt: OptionsConfig) -> OptionsConfig:
+    """Options of a model for its probe: the classifier configs of the student options (incl. the overrides)"""
+    probe_opt = copy.copy(model_opt)
+    probe_opt.model_type = ModelType.ONLY_DOWNSTREAM_TASK
+    probe_opt.syllables_classifier_config = opt.syllables_classifier_config
+    probe_opt.speakers_classifier_config = opt.speakers_classifier_config
+    probe_opt.use_wandb = False  # the probes of both models would be logged under the same keys
+    return probe_opt
+
+
+def report(opt: OptionsConfig, teacher_opt: OptionsConfig, student, teacher) -> dict:
+    config = opt.distillation_config
+    audio_length = get_audio_length(opt.encoder_config.dataset)
+    probe = "syllables" if opt.encoder_config.dataset.dataset == Dataset.DE_BOER else "speakers"
+
+    results = {}
+    for name, model_opt, model in [("teacher", teacher_opt, teacher), ("student", opt, student)]:
+        model.eval()
+        nb_params, size_mb = inference_size(model)
+        latency = measure_latency(model, audio_length, config.latency_batch_size, config.latency_steps)
+        accuracy = probe_accuracy(_probe_options(model_opt, opt), model)
+        results[name] = {"parameters": nb_params, "size_mb": size_mb, "latency_ms": 1000 * latency,
+                         f"{probe}_accuracy": accuracy}
+
+    teacher_results, student_results = results["teacher"], results["student"]
+    results["size_reduction"] = teacher_results["size_mb"] / student_results["size_mb"]
+    results["speed_up"] = teacher_results["latency_ms"] / student_results["latency_ms"]
+    results["accuracy_delta"] = student_results[f"{probe}_accuracy"] - teacher_results[f"{probe}_accuracy"]
+    results["latency"] = {"audio_length": audio_length, "batch_size": config.latency_batch_size, "device": "cpu"}
+
+    print(f"{'':<8} {'parameters':>11} {'size (MB)':>10} {'latency (ms)':>13} {f'{probe} acc.':>15}")
+    for name in ["teacher", "student"]:
+        row = results[name]
+        print(f"{name:<8} {row['parameters']:>11} {row['size_mb']:>10.2f} {row['latency_ms']:>13.1f} "
+              f"{row[f'{probe}_accuracy']:>15.4f}")
+    print(f"Size reduction: {results['size_reduction']:.2f}x, speed-up: {results['speed_up']:.2f}x "
+          f"(cpu, batch {config.latency_batch_size} x {audio_length} samples), "
+          f"accuracy delta: {results['accuracy_delta']:+.4f}")
+    return results
+
+
+def main():
+    opt: OptionsConfig = get_options()
+    assert opt.distillation_config is not None, "distillation_config is not set, use the config of a student"
+    config = opt.distillation_config
+    opt.model_type = ModelType.ONLY_ENCODER
+
+    arg_parser.create_log_path(opt)
+    set_seed(opt.seed)
+
+    if opt.use_wandb:
+        dataset = opt.encoder_config.dataset.dataset
+        project_name = f"SIM_distillation_{opt.wandb_project_name or dataset}"
+        run_name = f"student_distill={config.distill_weight}_nce={config.nce_weight}_{int(time.time())}"
+        initialize_wandb(opt, project_name, run_name)
+
+    teacher, teacher_opt = load_teacher(opt)
+    student, _ = model_utils.distribute_over_GPUs(opt, FullModel(opt, calc_accuracy=True), num_GPU=1)
+    distiller = Distiller(student, teacher, get_audio_length(opt.encoder_config.dataset),
+                          config.distill_weight, config.nce_weight).to(opt.device)
+    print(f"Matched modules (student: teacher): {distiller.matches}")
+
+    if opt.train:
+        logs = logger.Logger(opt)
+        optimizer = torch.optim.Adam(distiller.trainable_parameters(), lr=opt.encoder_config.learning_rate)
+        train_loader, _, test_loader, _ = get_dataloader.get_dataloader(config=opt.encoder_config.dataset,
+                                                                        device=opt.device)
+        try:
+            train(opt, logs, distiller, student, optimizer, train_loader, test_loader)
+        except KeyboardInterrupt:
+            print("Training got interrupted, saving log-files now.")
+            logs.create_log(student)
+    else:
+        model_path = os.path.join(opt.model_path, f"model_{_probe_config(opt).encoder_num}.ckpt")
+        print("Loading the student from ", model_path)
+        student.load_state_dict(torch.load(model_path, map_location=opt.device.type))
+
+    results = report(opt, teacher_opt, student, teacher)
+    with open(os.path.join(opt.log_path, "distillation_report.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved the report to {opt.log_path}")
+
+    if opt.use_wandb:
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main()
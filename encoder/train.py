@@ -3,6 +3,8 @@
 # for cpc: cpc_audio_de_boer
 
 import gc
+import itertools
+import os
 import time
 
 import torch
@@ -11,16 +13,35 @@ import wandb
 from arg_parser import arg_parser
 from config_code.config_classes import OptionsConfig, ModelType
 from data import get_dataloader
+from data.loader_profiler import LoaderProfiler, apply_loader_settings
+from data.resumable_sampler import set_loader_epoch
 from models import load_audio_model
 from models.full_model import FullModel
 # own modules
 from utils import logger
+from utils.hot_path_profiler import enable_hot_path_profiler, profile_region, profile_backward
+from utils.local_metrics import log_metrics, local_metrics_sink
+from utils.metrics_accumulator import MetricsAccumulator, wandb_sink
+from utils.resume_checkpoint import RESUME_CHECKPOINT, PreemptionHandler, TrainingPreempted, capture_rng_states, \
+    restore_rng_states, save_resume_checkpoint, load_resume_checkpoint, remove_resume_checkpoint
 from utils.utils import set_seed, initialize_wandb
+from validation.background_validation import BackgroundValidator, handle_validation_results
 from validation.val_by_InfoNCELoss import val_by_InfoNCELoss
 
 
 def train(opt: OptionsConfig, logs, model: FullModel, optimizer, train_loader, test_loader):
     '''Train the model'''
+    validator = BackgroundValidator(opt) if opt.validate and opt.validate_in_background else None
+    try:
+        with PreemptionHandler(enabled=opt.checkpoint_on_sigterm) as preemption:
+            _train(opt, logs, model, optimizer, train_loader, test_loader, preemption, validator)
+    finally:
+        if validator is not None:  # no-op if training finished, then the worker was already closed
+            validator.terminate()
+
+
+def _train(opt: OptionsConfig, logs, model: FullModel, optimizer, train_loader, test_loader,
+           preemption: PreemptionHandler, validator: BackgroundValidator = None):
     total_step = len(train_loader)
     limit_train_batches = opt.encoder_config.dataset.limit_train_batches  # value between 0 and 1
     if limit_train_batches < 1:
@@ -29,8 +50,8 @@ def train(opt: OptionsConfig, logs, model: FullModel, optimizer, train_loader, t
             f"Limiting validation to {int(opt.encoder_config.dataset.limit_validation_batches * 100)}% of the dataset!!!! \n")
         total_step = int(total_step * limit_train_batches)
 
-    # how often to output training values
-    print_idx = 100
+    # how often to output training values (averaged since the previous output)
+    print_idx = opt.log_every_x_steps
     # how often to validate training process by plotting latent representations of various speakers
     latent_val_idx = 1000
 
@@ -42,12 +63,52 @@ def train(opt: OptionsConfig, logs, model: FullModel, optimizer, train_loader, t
     start_epoch = opt.encoder_config.start_epoch
     num_epochs = opt.encoder_config.num_epochs
     global_step = 0
-    for epoch in range(start_epoch, num_epochs + start_epoch):
-
-        nb_modules = len(opt.encoder_config.architecture.modules)
-        loss_epoch = [0 for _ in range(nb_modules)]
-
-        for step, (audio, _, _, _) in enumerate(train_loader):
+    loader_profiler = LoaderProfiler()  # measures time waiting for data vs time spent on the training step
+    hot_path = enable_hot_path_profiler(opt.device) if opt.profile_hot_path else None
+
+    # running sums of the losses on the device, to avoid a host sync every step
+    nb_modules = len(opt.encoder_config.architecture.modules)
+    metric_names = ["loss", "nce", "kld", "accuracy"]
+    sinks = ([wandb_sink] if opt.use_wandb else []) + ([local_metrics_sink(opt)] if opt.use_local_metrics else [])
+    metrics = MetricsAccumulator(metric_names, nb_modules, opt.device, sinks=sinks)
+    epoch_metrics = MetricsAccumulator(metric_names, nb_modules, opt.device)
+
+    # the order of the training batches only depends on (data_seed, epoch), see data/resumable_sampler.py
+    data_seed = int(torch.randint(2 ** 31, ()).item())
+    resume_path = os.path.join(opt.log_path, RESUME_CHECKPOINT)
+    resume_state = load_resume_checkpoint(resume_path) if opt.resume_from_checkpoint else None
+    first_epoch, start_step = start_epoch, 0
+    if resume_state is not None:
+        model.load_state_dict(resume_state["model"])
+        optimizer.load_state_dict(resume_state["optimizer"])
+        scheduler.load_state_dict(resume_state["scheduler"])
+        metrics.load_state_dict(resume_state["metrics"])
+        epoch_metrics.load_state_dict(resume_state["epoch_metrics"])
+        logs.train_loss, logs.val_loss = resume_state["train_loss"], resume_state["val_loss"]
+        first_epoch, start_step = resume_state["epoch"], resume_state["step"]
+        global_step, data_seed = resume_state["global_step"], resume_state["data_seed"]
+        restore_rng_states(resume_state["rng"])
+        print(f"Resuming from {resume_path}: epoch {first_epoch + 1}, step {start_step}")
+
+    def save_checkpoint(epoch, step):
+        """`step`: nb of batches of `epoch` that were already trained on"""
+        save_resume_checkpoint(resume_path, {
+            "model": model.state_dict(), "optimizer": optimizer.state_dict(), "scheduler": scheduler.state_dict(),
+            "metrics": metrics.state_dict(), "epoch_metrics": epoch_metrics.state_dict(),
+            "train_loss": logs.train_loss, "val_loss": logs.val_loss,
+            "epoch": epoch, "step": step, "global_step": global_step, "data_seed": data_seed,
+            "rng": capture_rng_states(),
+        })
+
+    for epoch in range(first_epoch, num_epochs + start_epoch):
+        loader_profiler.reset()
+
+        # when resuming mid-epoch, skip the batches that were already trained on
+        start_batch = start_step if epoch == first_epoch else 0
+        nb_replay = set_loader_epoch(train_loader, epoch, data_seed, start_batch)
+        batches = itertools.islice(train_loader, nb_replay, None) if nb_replay > 0 else train_loader
+
+        for step, (audio, _, _, _) in enumerate(loader_profiler.wrap(batches), start=start_batch):
 
             # validate training progress by plotting latent representation of various speakers
             # TODO
@@ -55,69 +116,95 @@ def train(opt: OptionsConfig, logs, model: FullModel, optimizer, train_loader, t
             #     val_by_latent_syllables(opt.encoder_config.dataset, opt.device, test_loader, model, epoch, step)
 
             if step % print_idx == 0:
+                data_wait, compute = loader_profiler.last_step()
                 print(
-                    f"Epoch [{epoch + 1}/{num_epochs + start_epoch}], Step [{step}/{total_step}], Time (s): {time.time() - starttime:.1f}"
+                    f"Epoch [{epoch + 1}/{num_epochs + start_epoch}], Step [{step}/{total_step}], Time (s): {time.time() - starttime:.1f}, "
+                    f"Data wait (s): {data_wait:.3f}, Compute (s): {compute:.3f}"
                 )
 
             starttime = time.time()
+            if hot_path is not None:
+                hot_path.record("data_wait", loader_profiler.last_step()[0])
 
             # shape: (batch_size, 1, 8800)
-            model_input = audio.to(opt.device)
-            loss, nce, kld = model(model_input)  # loss for each module
+            model_input = audio.to(opt.device, non_blocking=opt.encoder_config.dataset.pin_memory)
+            loss, nce, kld, accuracy = model(model_input)  # loss for each module
 
             # Average over the losses from different GPUs
             loss = torch.mean(loss, 0)
             nce = torch.mean(nce, 0)
             kld = torch.mean(kld, 0)
+            accuracy = torch.mean(accuracy, 0)
 
             model.zero_grad()
             overall_loss = sum(loss)
-            overall_loss.backward()
-            optimizer.step()
-
-            for idx, cur_losses in enumerate(loss):
-                print_loss = cur_losses.item()
-                loss_epoch[idx] += print_loss
+            with profile_backward():
+                overall_loss.backward()
 
-                if step % print_idx == 0:
-                    if idx == 0:
-                        print("\n")
-                    print(f"\t \t Idx: {idx} \t \t Tot Loss: \t \t {print_loss:.4f} "
-                          f"\t \t NCE: {nce[idx]:.4f} \t \t KLD: {kld[idx]:.4f}")
+            with profile_region("optimizer_step"):
+                optimizer.step()
 
-            if opt.use_wandb:
-                for idx, cur_nce in enumerate(nce):
-                    wandb.log({f"nce/nce_{idx}": cur_nce}, step=global_step)
-                for idx, cur_kld in enumerate(kld):
-                    wandb.log({f"kld/kld_{idx}": cur_kld}, step=global_step)
-                for idx, cur_losses in enumerate(loss):
-                    wandb.log({f"loss/loss_{idx}": cur_losses}, step=global_step)
+            metrics.update(loss=loss, nce=nce, kld=kld, accuracy=accuracy)
+            epoch_metrics.update(loss=loss, nce=nce, kld=kld, accuracy=accuracy)
 
-                wandb.log({'epoch': epoch}, step=global_step)
+            # only synchronize with the device every print_idx steps, with a single transfer for all metrics
+            if step % print_idx == 0:
+                averages = metrics.flush(global_step, extra={'epoch': epoch})
+                print("\n")
+                for idx in range(nb_modules):
+                    print(f"\t \t Idx: {idx} \t \t Tot Loss: \t \t {averages['loss'][idx]:.4f} "
+                          f"\t \t NCE: {averages['nce'][idx]:.4f} \t \t KLD: {averages['kld'][idx]:.4f}")
 
             global_step += 1
 
+            if validator is not None:  # results of the previous epochs, validated in the background
+                handle_validation_results(opt, logs, validator.poll(), step=global_step)
+
             if step >= total_step:
                 print("Breaking training loop at step", step)
                 break
 
+            if preemption.requested or \
+                    (opt.checkpoint_every_x_steps > 0 and global_step % opt.checkpoint_every_x_steps == 0):
+                save_checkpoint(epoch, step + 1)
+                if preemption.requested:
+                    raise TrainingPreempted(f"Saved checkpoint at epoch {epoch + 1}, step {step + 1}")
+
         scheduler.step()
         print(f"LR: {scheduler.get_last_lr()}")
+        print(f"Input pipeline: {loader_profiler}")
+        if hot_path is not None:
+            hot_path.end_epoch(opt.log_path)
+        loader_summary = loader_profiler.summary()
+        log_metrics(opt, {"loader/data_wait_fraction": loader_summary["data_wait_fraction"],
+                          "loader/data_wait_per_step": loader_summary["data_wait_per_step"],
+                          "loader/compute_per_step": loader_summary["compute_per_step"]}, step=global_step)
 
-        logs.append_train_loss([x / total_step for x in loss_epoch])
+        logs.append_train_loss(epoch_metrics.averages()["loss"])
+        epoch_metrics.reset()
 
         # validate by testing the CPC performance on the validation set
-        if opt.validate:
+        if validator is not None:
+            validator.submit(model, epoch, global_step)
+        elif opt.validate:
             validation_loss = val_by_InfoNCELoss(opt, model, test_loader)
             logs.append_val_loss(validation_loss)
 
-            if opt.use_wandb:
-                for i, val_loss in enumerate(validation_loss):
-                    wandb.log({f"val_loss/val_loss_{i}": val_loss}, step=global_step)
+            log_metrics(opt, {f"val_loss/val_loss_{i}": val_loss for i, val_loss in enumerate(validation_loss)},
+                        step=global_step)
 
         if (epoch % opt.log_every_x_epochs == 0):
             logs.create_log(model, optimizer=optimizer, epoch=epoch)
 
+        if preemption.requested:  # received during the end of the epoch
+            save_checkpoint(epoch + 1, 0)
+            raise TrainingPreempted(f"Saved checkpoint at the end of epoch {epoch + 1}")
+
+    if validator is not None:
+        handle_validation_results(opt, logs, validator.close(), step=global_step)
+
+    remove_resume_checkpoint(resume_path)  # finished, a next run with the same save_dir starts from scratch
+
 
 def _main(options: OptionsConfig):
     USE_WANDB = options.use_wandb
@@ -148,9 +235,10 @@ def _main(options: OptionsConfig):
     # load model
     model, optimizer = load_audio_model.load_model_and_optimizer(options, None)
 
-    # get datasets and dataloaders
+    # get datasets and dataloaders (with the autotuned loader settings of this run, if any)
+    apply_loader_settings(options, options.encoder_config.dataset)
     train_loader, train_dataset, test_loader, test_dataset = get_dataloader.get_dataloader(
-        config=options.encoder_config.dataset)
+        config=options.encoder_config.dataset, device=options.device)
 
     try:
         # Train the model
@@ -160,6 +248,12 @@ def _main(options: OptionsConfig):
     except KeyboardInterrupt:
         print("Training got interrupted, saving log-files now.")
 
+    except TrainingPreempted as e:  # the step-level checkpoint contains everything, no need for the log-files
+        print(f"Training got preempted. {e}, start the same experiment again to resume.")
+        if USE_WANDB:
+            wandb.finish()
+        return
+
     logs.create_log(model)
 
     if USE_WANDB:
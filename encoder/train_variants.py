@@ -0,0 +1,415 @@
+# Example usage, a kld_weight/learning rate sweep in a single process, reading the dataset once:
+# python -m encoder.train_variants temp sim_audio_de_boer_distr_true --variants kld_weight=0.01 kld_weight=0.001 kld_weight=0.01,learning_rate=1e-3 deterministic=True --overrides encoder_config.num_epochs=100 use_wandb=False
+# Step time of the stacked variants vs training them one after the other, on synthetic audio:
+# python -m encoder.train_variants temp sim_audio_de_boer_distr_true --variants kld_weight=0.01 kld_weight=0.001 --benchmark_steps 5
+"""
+Trains N variants of the same FullModel (different kld_weight, learning_rate and/or deterministic) on the same batches.
+The parameters of the variants are stacked (torch.func.stack_module_state) and every CNN module of all variants runs
+as a single vmapped forward/backward. The autoregressor (nn.GRU has no vmap support) runs per variant, on the stacked
+parameters as well. With `--sequential`, the CNN modules also run per variant: the dataset is still read only once,
+but without the (grouped convolution) kernels of vmap, which are slower than the regular ones on some CPUs.
+
+deterministic=True trains like `encoder_config.deterministic`: the latents are the means (no sampling) and the KLD is
+not part of the loss. Each variant has its own log directory `<log_path>/<variant name>` with the same files as
+encoder/train.py (model_{epoch}.ckpt, train_loss.npy, val_loss.npy, ...), such that the classifiers and decoders can be
+trained on any of them. Optimizer states are not stored; a sweep cannot be continued with `start_epoch`.
+Only a single device is used (no DataParallel), without the negative memory bank (`negative_bank_size`).
+"""
+
+import argparse
+import copy
+import gc
+import math
+import sys
+import time
+from typing import List
+
+import torch
+import torch.nn as nn
+import wandb
+from torch.func import stack_module_state, functional_call, vmap
+
+from arg_parser import arg_parser
+from config_code.architecture_planner import get_audio_length
+from config_code.config_classes import OptionsConfig, ModelType
+from data import get_dataloader
+from data.loader_profiler import apply_loader_settings
+from models.full_model import FullModel
+from models.independent_module import IndependentModule
+from utils import logger
+from utils.local_metrics import log_metrics
+from utils.metrics_accumulator import MetricsAccumulator
+from utils.utils import set_seed, initialize_wandb
+
+
+class Variant:
+    def __init__(self, kld_weight, learning_rate, deterministic):
+        self.kld_weight = kld_weight
+        self.learning_rate = learning_rate
+        self.deterministic = deterministic
+
+    @property
+    def name(self):  # also the name of the log directory
+        return f"kld={self.kld_weight}_lr={self.learning_rate}" + ("_deterministic" if self.deterministic else "")
+
+    @staticmethod
+    def from_string(spec: str, opt: OptionsConfig) -> 'Variant':
+        """eg "kld_weight=0.01,learning_rate=1e-3", unspecified values are taken from the config"""
+        values = {"kld_weight": opt.encoder_config.kld_weight, "learning_rate": opt.encoder_config.learning_rate,
+                  "deterministic": opt.encoder_config.deterministic}
+        for item in spec.split(","):
+            key, value = item.split("=")
+            if key not in values:
+                raise ValueError(f"Unknown variant parameter {key}, must be one of {list(values)}")
+            values[key] = value.lower() == "true" if key == "deterministic" else float(value)
+        return Variant(**values)
+
+    def options(self, opt: OptionsConfig) -> OptionsConfig:
+        """Copy of the options of the sweep, with the values and log directory of this variant."""
+        variant_opt = copy.deepcopy(opt)
+        variant_opt.encoder_config.kld_weight = self.kld_weight
+        variant_opt.encoder_config.learning_rate = self.learning_rate
+        variant_opt.encoder_config.deterministic = self.deterministic
+        variant_opt.log_path = f"{opt.log_path}/{self.name}"
+        variant_opt.log_path_latent = f"{variant_opt.log_path}/latent_space"
+        variant_opt.model_path = variant_opt.log_path
+        return variant_opt
+
+
+class _ModuleStep(nn.Module):
+    """Loss terms of an IndependentModule, where sampling the latents can be switched off per variant."""
+
+    def __init__(self, module: IndependentModule):
+        super(_ModuleStep, self).__init__()
+        self.module = module
+
+    def forward(self, x, sample):  # sample: 1. to sample c and z, 0. to use the means (deterministic)
+        module = self.module
+        (c_mu, c_log_var), (z_mu, z_log_var) = module._get_latent_params(x)
+        if module.predict_distributions:
+            c = c_mu + sample * (module._reparameterize(c_mu, c_log_var) - c_mu)
+            z = z_mu + sample * (module._reparameterize(z_mu, z_log_var) - z_mu)
+            kld_loss = module._kld_loss(c_mu, c_log_var)
+        else:
+            c, z = c_mu, z_mu
+            kld_loss = torch.zeros((), device=c_mu.device)
+        nce_loss, _ = module.loss.get_loss(z, c)
+        return nce_loss, kld_loss, z
+
+
+class StackedAdam(torch.optim.Optimizer):
+    """
+    torch.optim.Adam (default betas and eps, no weight decay) for parameters that are stacked over the variants
+    (dim 0), with a learning rate per variant.
+    """
+
+    def __init__(self, params, lrs: torch.Tensor, betas=(0.9, 0.999), eps=1e-8):
+        super(StackedAdam, self).__init__(params, dict(betas=betas, eps=eps))
+        self.lrs = lrs  # (nb_variants,)
+
+    def decay_lrs(self, gamma):  # as ExponentialLR
+        self.lrs.mul_(gamma)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                state["step"] += 1
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+
+                exp_avg.lerp_(p.grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                step_size = (self.lrs / bias_correction1).view(-1, *[1] * (p.dim() - 1))
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group["eps"])
+                p.sub_(step_size * exp_avg / denom)
+
+
+class StackedFullModel:
+    """N FullModels (one per variant) of which the parameters and buffers are stacked along a new first dim."""
+
+    def __init__(self, opt: OptionsConfig, variants: List[Variant], vectorize=True):
+        if opt.encoder_config.negative_bank_size > 0:
+            # functional_call drops the reassigned bank buffer (InfoNCE_Loss.update_bank), the bank would stay zeros
+            raise ValueError("negative_bank_size is not supported with stacked variants, set it to 0")
+        self.opt = opt
+        self.variants = variants
+        self.vectorize = vectorize
+        # independently initialized, as in separate runs. Also used to export the checkpoints of the variants
+        self.models = [FullModel(opt).to(opt.device) for _ in variants]
+        self.base = copy.deepcopy(self.models[0])  # only its structure is used
+        self.params, self.buffers = stack_module_state(self.models)
+
+        predict_distributions = [not v.deterministic for v in variants]
+        self.sample = torch.tensor(predict_distributions, dtype=torch.float, device=opt.device)
+        # the KLD only counts for the variants that sample
+        self.kld_weights = torch.tensor([v.kld_weight for v in variants], device=opt.device) * self.sample
+
+        self.steps = []  # per module: (_ModuleStep or module, whether it is a _ModuleStep)
+        for idx, module in enumerate(self.base.fullmodel):
+            if isinstance(module, IndependentModule):
+                self.steps.append((_ModuleStep(module), True))
+            else:  # autoregressor and CPC modules: nn.GRU cannot be vmapped
+                self.steps.append((module, False))
+
+    def _module_state(self, idx, is_step):
+        prefix = f"fullmodel.{idx}."
+        rename = (lambda k: "module." + k[len(prefix):]) if is_step else (lambda k: k[len(prefix):])
+        params = {rename(k): v for k, v in self.params.items() if k.startswith(prefix)}
+        buffers = {rename(k): v for k, v in self.buffers.items() if k.startswith(prefix)}
+        return params, buffers
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def __call__(self, x):
+        """
+        :param x: batch of audio (B x 1 x L), shared by all variants
+        :return: loss, nce, kld: each of shape (nb_variants, nb_modules)
+        """
+        nce_losses, kld_losses = [], []
+        model_input, batched_input = x, False
+        for idx, (step, is_step) in enumerate(self.steps):
+            params, buffers = self._module_state(idx, is_step)
+            if is_step and self.vectorize:
+                fn = lambda p, b, inp, sample: functional_call(step, (p, b), (inp, sample))
+                nce, kld, z = vmap(fn, in_dims=(0, 0, 0 if batched_input else None, 0), randomness="different")(
+                    params, buffers, model_input, self.sample)
+            else:
+                outputs = []
+                for v in range(len(self.variants)):
+                    p = {k: value[v] for k, value in params.items()}
+                    b = {k: value[v] for k, value in buffers.items()}
+                    inp = model_input[v] if batched_input else model_input
+                    if is_step:
+                        outputs.append(functional_call(step, (p, b), (inp, self.sample[v])))
+                    else:
+                        _, _, z_v, nce_v, kld_v = functional_call(step, (p, b), (inp,))
+                        outputs.append((nce_v.squeeze(0), kld_v.squeeze(0), z_v))
+                nce, kld, z = [torch.stack(values) for values in zip(*outputs)]
+
+            nce_losses.append(nce)
+            kld_losses.append(kld)
+            model_input, batched_input = z.permute(0, 1, 3, 2).detach(), True  # (N, B, C, L)
+
+        nce, kld = torch.stack(nce_losses, 1), torch.stack(kld_losses, 1)
+        loss = nce + self.kld_weights.unsqueeze(1) * kld
+        return loss, nce, kld
+
+    def export(self, variant_idx) -> nn.Module:
+        """FullModel of the variant, wrapped in DataParallel such that the checkpoint keys match encoder/train.py"""
+        model = self.models[variant_idx]
+        with torch.no_grad():
+            for name, p in model.named_parameters():
+                p.copy_(self.params[name][variant_idx])
+            for name, b in model.named_buffers():
+                b.copy_(self.buffers[name][variant_idx])
+        return nn.DataParallel(model)
+
+
+def validate(opt: OptionsConfig, stacked: StackedFullModel, test_loader) -> torch.Tensor:
+    """
+    Same as val_by_InfoNCELoss, for all variants at once: in eval mode (the batchnorm statistics are not updated by the
+    validation data) and without autograd. Returns the losses, shape (nb_variants, nb_modules)
+    """
+    was_training = stacked.base.training  # the steps run the modules of the base on the stacked state
+    stacked.base.eval()
+    with torch.inference_mode():
+        validation_loss = _validate(opt, stacked, test_loader)
+    stacked.base.train(was_training)
+    return validation_loss
+
+
+def _validate(opt: OptionsConfig, stacked: StackedFullModel, test_loader) -> torch.Tensor:
+    total_step = len(test_loader)
+    if opt.encoder_config.dataset.limit_validation_batches < 1:
+        total_step = int(total_step * opt.encoder_config.dataset.limit_validation_batches)
+
+    loss_epoch = torch.zeros(len(stacked.variants), len(stacked.steps), device=opt.device)
+    for step, (audio, _, _, _) in enumerate(test_loader):
+        loss, _, _ = stacked(audio.to(opt.device))
+        loss_epoch += loss
+        if step >= total_step:
+            break
+    return loss_epoch / max(total_step, 1)
+
+
+def train(opt: OptionsConfig, stacked: StackedFullModel, variant_logs, train_loader, test_loader):
+    variants = stacked.variants
+    nb_modules = len(stacked.steps)
+    optimizer = StackedAdam(stacked.parameters(), torch.tensor([v.learning_rate for v in variants], device=opt.device))
+
+    total_step = len(train_loader)
+    if opt.encoder_config.dataset.limit_train_batches < 1:
+        total_step = int(total_step * opt.encoder_config.dataset.limit_train_batches)
+
+    metric_names = ["loss", "nce", "kld"]
+    metrics, epoch_metrics = [], []
+    for variant in variants:  # keys as in encoder/train.py, prefixed with the variant name, eg "kld=0.01_lr=0.0002/nce/nce_0"
+        sink = lambda values, step, name=variant.name: log_metrics(
+            opt, {f"{name}/{key}": value for key, value in values.items()}, step=step)
+        metrics.append(MetricsAccumulator(metric_names, nb_modules, opt.device, sinks=[sink]))
+        epoch_metrics.append(MetricsAccumulator(metric_names, nb_modules, opt.device))
+
+    start_epoch = opt.encoder_config.start_epoch
+    num_epochs = opt.encoder_config.num_epochs
+    global_step = 0
+    starttime = time.time()
+    for epoch in range(start_epoch, num_epochs + start_epoch):
+        for step, (audio, _, _, _) in enumerate(train_loader):
+            model_input = audio.to(opt.device, non_blocking=opt.encoder_config.dataset.pin_memory)
+            loss, nce, kld = stacked(model_input)  # (nb_variants, nb_modules)
+
+            optimizer.zero_grad()
+            loss.sum().backward()  # the variants do not share parameters, so each gets the gradient of its own loss
+            optimizer.step()
+
+            for v in range(len(variants)):
+                metrics[v].update(loss=loss[v], nce=nce[v], kld=kld[v])
+                epoch_metrics[v].update(loss=loss[v], nce=nce[v], kld=kld[v])
+
+            if step % opt.log_every_x_steps == 0:
+                print(f"Epoch [{epoch + 1}/{num_epochs + start_epoch}], Step [{step}/{total_step}], "
+                      f"Time (s): {time.time() - starttime:.1f}")
+                for v, variant in enumerate(variants):
+                    averages = metrics[v].flush(global_step, extra={f"{variant.name}/epoch": epoch})
+                    print(f"\t {variant.name}: " + " ".join(
+                        f"{idx}: {averages['nce'][idx]:.4f}/{averages['kld'][idx]:.4f}" for idx in range(nb_modules)))
+                starttime = time.time()
+
+            global_step += 1
+            if step >= total_step:
+                break
+
+        optimizer.decay_lrs(opt.encoder_config.decay_rate)
+
+        for v, logs in enumerate(variant_logs):
+            logs.append_train_loss(epoch_metrics[v].averages()["loss"])
+            epoch_metrics[v].reset()
+
+        if opt.validate:
+            validation_loss = validate(opt, stacked, test_loader).tolist()
+            for v, variant in enumerate(variants):
+                variant_logs[v].append_val_loss(validation_loss[v])
+                print(f"Validation loss {variant.name}: {validation_loss[v]}")
+                log_metrics(opt, {f"{variant.name}/val_loss/val_loss_{i}": value
+                                  for i, value in enumerate(validation_loss[v])}, step=global_step)
+
+        if epoch % opt.log_every_x_epochs == 0:
+            for v, logs in enumerate(variant_logs):
+                logs.create_log(stacked.export(v), epoch=epoch)
+
+
+def benchmark(opt: OptionsConfig, variants: List[Variant], nb_steps, warmup=1):
+    """Step time of the stacked variants (vmapped and sequential) vs the same variants as separate FullModels."""
+    audio_length = get_audio_length(opt.encoder_config.dataset)
+    x = torch.randn(opt.encoder_config.dataset.batch_size, 1, audio_length, device=opt.device)
+
+    def stacked_step_fn(vectorize):
+        stacked = StackedFullModel(opt, variants, vectorize=vectorize)
+        lrs = torch.tensor([v.learning_rate for v in variants], device=opt.device)
+        optimizer = StackedAdam(stacked.parameters(), lrs)
+
+        def stacked_step():
+            loss, _, _ = stacked(x)
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+        return stacked_step
+
+    separate = []
+    for variant in variants:
+        variant_opt = variant.options(opt)
+        model = FullModel(variant_opt).to(opt.device)
+        separate.append((model, torch.optim.Adam(model.parameters(), lr=variant.learning_rate)))
+
+    def separate_step():
+        for model, model_optimizer in separate:
+            loss, _, _, _ = model(x)
+            model_optimizer.zero_grad()
+            loss.sum().backward()
+            model_optimizer.step()
+
+    for name, fn in [("vmapped", stacked_step_fn(True)), ("sequential", stacked_step_fn(False)),
+                     ("separate", separate_step)]:
+        for _ in range(warmup):
+            fn()
+        if opt.device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(nb_steps):
+            fn()
+        if opt.device.type == "cuda":
+            torch.cuda.synchronize()
+        print(f"{name:>10}: {1000 * (time.perf_counter() - start) / nb_steps:.1f} ms per step for {len(variants)} variants")
+
+
+def _main(options: OptionsConfig, variants: List[Variant], vectorize=True, benchmark_steps=0):
+    options.model_type = ModelType.ONLY_ENCODER
+    print(f"Training {len(variants)} variants: {[v.name for v in variants]}")
+
+    if benchmark_steps > 0:
+        benchmark(options, variants, benchmark_steps)
+        return
+
+    if options.use_wandb:
+        dataset = options.encoder_config.dataset.dataset
+        project_name = f"SIM_{options.wandb_project_name if options.wandb_project_name else dataset}_{dataset}"
+        initialize_wandb(options, project_name, f"variants_{len(variants)}_{int(time.time())}")
+
+    # single device (set in model_utils.distribute_over_GPUs for encoder/train.py)
+    options.encoder_config.dataset.batch_size_multiGPU = options.encoder_config.dataset.batch_size
+
+    variant_logs = []
+    for variant in variants:
+        variant_opt = variant.options(options)
+        arg_parser.create_log_path(variant_opt)
+        variant_logs.append(logger.Logger(variant_opt))
+
+    stacked = StackedFullModel(options, variants, vectorize=vectorize)
+
+    apply_loader_settings(options, options.encoder_config.dataset)
+    train_loader, _, test_loader, _ = get_dataloader.get_dataloader(config=options.encoder_config.dataset,
+                                                                    device=options.device)
+
+    try:
+        if options.train:
+            train(options, stacked, variant_logs, train_loader, test_loader)
+    except KeyboardInterrupt:
+        print("Training got interrupted, saving log-files now.")
+
+    for v, logs in enumerate(variant_logs):
+        logs.create_log(stacked.export(v))
+
+    if options.use_wandb:
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train several variants of a config in a single process.")
+    parser.add_argument('--variants', type=str, nargs='+', required=True,
+                        help='eg: kld_weight=0.01 kld_weight=0.001,learning_rate=1e-3 deterministic=True')
+    parser.add_argument('--sequential', action='store_true', help='Run the CNN modules per variant instead of vmap')
+    parser.add_argument('--benchmark_steps', type=int, default=0, help='Only compare the step time, on fake data')
+    args, remaining = parser.parse_known_args()
+    sys.argv = [sys.argv[0]] + remaining  # experiment_name config_file --overrides ..., parsed by options.py
+
+    from options import get_options
+
+    opt = get_options()
+    torch.cuda.empty_cache()
+    gc.collect()
+    arg_parser.create_log_path(opt)
+    set_seed(opt.seed)
+
+    _main(opt, [Variant.from_string(spec, opt) for spec in args.variants], not args.sequential, args.benchmark_steps)
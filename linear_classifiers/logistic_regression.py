@@ -21,6 +21,7 @@ from models import load_audio_model
 from models.loss_supervised_syllables import Syllables_Loss
 from options import get_options
 from utils import logger
+from utils.local_metrics import log_metrics
 from utils.utils import retrieve_existing_wandb_run_id, set_seed, get_audio_classific_key, get_nb_classes, \
     get_classif_log_path
 
@@ -122,12 +123,12 @@ def train(opt: OptionsConfig, context_model, loss: Syllables_Loss, logs: logger.
             sample_loss = total_loss.item()
             accuracy = accuracies.item()
 
-            if wandb_is_on:
+            if wandb_is_on or opt.use_local_metrics:
                 wandb_section = get_audio_classific_key(opt, bias)
-                wandb.log({
+                log_metrics(opt, {
                     f"{wandb_section}/Loss classification": sample_loss,
                     f"{wandb_section}/Train accuracy": accuracy,
-                    f"{wandb_section}/Step": global_step})
+                    f"{wandb_section}/Step": global_step}, use_wandb=wandb_is_on)
             global_step += 1
 
             if i % print_idx == 0:
@@ -190,10 +191,10 @@ def test(opt, context_model, loss, data_loader, wandb_is_on: bool, bias: bool):
     print("Final Testing Accuracy: ", accuracy)
     print("Final Testing Loss: ", loss_epoch)
 
-    if wandb_is_on:
+    if wandb_is_on or opt.use_local_metrics:
         wandb_section = get_audio_classific_key(opt, bias)
-        wandb.log({f"{wandb_section}/FINAL Test accuracy": accuracy,
-                   f"{wandb_section}/FINAL Test loss": loss_epoch})
+        log_metrics(opt, {f"{wandb_section}/FINAL Test accuracy": accuracy,
+                          f"{wandb_section}/FINAL Test loss": loss_epoch}, use_wandb=wandb_is_on)
     return loss_epoch, accuracy
 
 
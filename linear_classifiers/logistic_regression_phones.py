@@ -10,6 +10,7 @@ from data import get_dataloader, phone_dict
 from utils import logger, utils
 from arg_parser import arg_parser
 from models import load_audio_model
+from utils.local_metrics import log_metrics
 from utils.utils import set_seed, retrieve_existing_wandb_run_id, get_audio_libri_classific_key
 import wandb
 
@@ -91,11 +92,11 @@ def train(opt: OptionsConfig, phone_dict, context_model, model, logs: logger.Log
             sample_loss = loss.item()
             loss_epoch += sample_loss
 
-            if opt.use_wandb:
+            if opt.use_wandb or opt.use_local_metrics:
                 wandb_section = get_audio_libri_classific_key(module_nb=-1, label_type="phones", layer_nb=-1, bias=True,
                                                               deterministic_encoder=opt.encoder_config.deterministic)
-                wandb.log({f"{wandb_section}/Train Loss": sample_loss,
-                           f"{wandb_section}/Train Accuracy": accuracy})
+                log_metrics(opt, {f"{wandb_section}/Train Loss": sample_loss,
+                                  f"{wandb_section}/Train Accuracy": accuracy})
 
             global_step += 1
 
@@ -170,10 +171,10 @@ def test(opt, phone_dict, context_model, model, test_dataset, n_features):
     accuracy = (correct / total)  # * 100, -->  0.8 = 80%
     print("Final Testing Accuracy: ", accuracy)
 
-    if opt.use_wandb:
+    if opt.use_wandb or opt.use_local_metrics:
         wandb_section = get_audio_libri_classific_key(module_nb=-1, label_type="phones", layer_nb=-1, bias=True,
                                                       deterministic_encoder=opt.encoder_config.deterministic)
-        wandb.log({f"{wandb_section}/Test Accuracy": accuracy})
+        log_metrics(opt, {f"{wandb_section}/Test Accuracy": accuracy})
 
     return accuracy
 
@@ -12,6 +12,7 @@ from data import get_dataloader
 from utils import logger
 from arg_parser import arg_parser
 from models import load_audio_model, loss_supervised_speaker
+from utils.local_metrics import log_metrics
 from utils.utils import set_seed, retrieve_existing_wandb_run_id, get_audio_libri_classific_key, get_classif_log_path
 import wandb
 
@@ -73,15 +74,15 @@ def train(opt: OptionsConfig, context_model, loss: Speaker_Loss, logs: logger.Lo
             loss_epoch += sample_loss
             acc_epoch += accuracy
 
-            if opt.use_wandb:
+            if opt.use_wandb or opt.use_local_metrics:
                 wandb_section = get_audio_libri_classific_key(
                     "speakers",
                     module_nb=opt.speakers_classifier_config.encoder_module,
                     layer_nb=opt.speakers_classifier_config.encoder_layer,
                     bias=opt.speakers_classifier_config.bias,
                     deterministic_encoder=opt.encoder_config.deterministic)
-                wandb.log({f"{wandb_section}/Train Loss": sample_loss,
-                           f"{wandb_section}/Train Accuracy": accuracy})
+                log_metrics(opt, {f"{wandb_section}/Train Loss": sample_loss,
+                                  f"{wandb_section}/Train Accuracy": accuracy})
 
             global_step += 1
 
@@ -126,14 +127,14 @@ def test(opt, context_model, loss, data_loader, bias):
     print("Final Testing Accuracy: ", accuracy)
     print("Final Testing Loss: ", loss_epoch)
 
-    if opt.use_wandb:
+    if opt.use_wandb or opt.use_local_metrics:
         wandb_section = get_audio_libri_classific_key(
             "speakers",
             module_nb=opt.speakers_classifier_config.encoder_module,
             layer_nb=opt.speakers_classifier_config.encoder_layer,
             bias=opt.speakers_classifier_config.bias,
             deterministic_encoder=opt.encoder_config.deterministic)
-        wandb.log({f"{wandb_section}/Test Accuracy": accuracy})
+        log_metrics(opt, {f"{wandb_section}/Test Accuracy": accuracy})
 
     return loss_epoch, accuracy
 
@@ -11,7 +11,11 @@ class AbstractModule(nn.Module, ABC):
         pass
 
     @abstractmethod
-    def forward(self, x) -> (Tensor, Tensor, Tensor, Tensor, Tensor):
+    def forward(self, x, lengths=None) -> (Tensor, Tensor, Tensor, Tensor, Tensor):
+        pass
+
+    @abstractmethod
+    def output_lengths(self, lengths: Tensor) -> Tensor:
         pass
 
     @abstractmethod
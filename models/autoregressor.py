@@ -1,7 +1,47 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from utils import utils
 
+# nb of time-steps of the GRU recurrence unrolled in a single compiled graph (see Autoregressor._forward_hoisted)
+SCAN_STEPS = 64
+_compiled_gru_scan = None  # shared by all autoregressors, compiled at the first call
+
+
+def _gru_cell(gi_t, h, w_hh, b_hh):
+    """
+    One step of nn.GRU with the input projection gi_t = x_t @ W_ih^T + b_ih (B x 3H) already computed. Same operations
+    as the GRU cell of ATen, such that the result is (nearly) bitwise identical.
+    """
+    gh = torch.addmm(b_hh, h, w_hh.t())
+    i_r, i_z, i_n = gi_t.chunk(3, 1)
+    h_r, h_z, h_n = gh.chunk(3, 1)
+    r = torch.sigmoid(h_r + i_r)
+    z = torch.sigmoid(h_z + i_z)
+    n = torch.tanh(i_n + h_n * r)
+    return (h - n) * z + n
+
+
+def _gru_scan(gi, h, w_hh, b_hh):
+    """Unrolled recurrence over gi (T x B x 3H): the hidden states (T x B x H) and the last one (B x H)"""
+    outputs = []
+    for t in range(gi.size(0)):
+        h = _gru_cell(gi[t], h, w_hh, b_hh)
+        outputs.append(h)
+    return torch.stack(outputs), h
+
+
+def _scan(gi, h, w_hh, b_hh):
+    global _compiled_gru_scan
+    if _compiled_gru_scan is None:
+        _compiled_gru_scan = torch.compile(_gru_scan)
+    try:
+        return _compiled_gru_scan(gi, h, w_hh, b_hh)
+    except Exception as e:  # eg no compiler available
+        print(f"torch.compile of the GRU scan failed, falling back to eager mode. {type(e).__name__}: {e}")
+        _compiled_gru_scan = _gru_scan
+        return _gru_scan(gi, h, w_hh, b_hh)
+
 
 class Autoregressor(nn.Module):
     def __init__(self, opt, input_size, hidden_dim):
@@ -14,6 +54,10 @@ class Autoregressor(nn.Module):
         )
 
         self.opt = opt
+        # on cpu, with the same weights as self.gru: input projections of all time-steps up front, recurrence in
+        # compiled blocks (see _forward_hoisted)
+        self.hoisted_gru = opt.encoder_config.hoisted_gru
+        self.hoisted_chunk_size = opt.encoder_config.hoisted_gru_chunk_size
 
     def forward(self, input):  # input: B x L x C: eg. (22, 55, 512)
 
@@ -21,12 +65,43 @@ class Autoregressor(nn.Module):
 
         regress_hidden_state = torch.zeros(
             1, input.size(0), self.hidden_dim, device=cur_device) # (1, 22, 256)
-        
+
+        if self.hoisted_gru and input.device.type == "cpu":
+            return self._forward_hoisted(input, regress_hidden_state[0])
+
         self.gru.flatten_parameters()
         output, regress_hidden_state = self.gru(input, regress_hidden_state)
 
         return output  # output: B x L x C: eg. (22, 55, 256)
 
+    def _forward_hoisted(self, input, h):
+        """
+        Same as self.gru(input, h): the input projections (x_t @ W_ih^T + b_ih) of all time-steps are computed in a
+        single matmul, only the recurrence over the hidden state runs step by step, in compiled blocks of SCAN_STEPS
+        unrolled steps (the remaining steps eager). With `hoisted_gru_chunk_size`, the projections are computed per
+        chunk of that many frames (rounded up to a multiple of SCAN_STEPS) to bound their memory for long inputs.
+        """
+        gru = self.gru
+        seq_len = input.size(1)
+        chunk_size = seq_len
+        if self.hoisted_chunk_size > 0:
+            chunk_size = -(-self.hoisted_chunk_size // SCAN_STEPS) * SCAN_STEPS
+
+        outputs = []
+        for start in range(0, seq_len, chunk_size):
+            gi = F.linear(input[:, start: start + chunk_size], gru.weight_ih_l0, gru.bias_ih_l0)
+            gi = gi.transpose(0, 1).contiguous()  # T x B x 3H
+
+            nb_scanned = gi.size(0) - gi.size(0) % SCAN_STEPS
+            for step in range(0, nb_scanned, SCAN_STEPS):
+                output, h = _scan(gi[step: step + SCAN_STEPS], h, gru.weight_hh_l0, gru.bias_hh_l0)
+                outputs.append(output)
+            for step in range(nb_scanned, gi.size(0)):
+                h = _gru_cell(gi[step], h, gru.weight_hh_l0, gru.bias_hh_l0)
+                outputs.append(h.unsqueeze(0))
+
+        return torch.cat(outputs).transpose(0, 1)  # B x L x H
+
 
 if __name__ == 'main':
     opt = {'device': 'cuda'}
@@ -2,6 +2,7 @@ from typing import List, Tuple
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 
 from config_code.config_classes import OptionsConfig
 
@@ -9,11 +10,12 @@ from config_code.config_classes import OptionsConfig
 class CNNEncoder(nn.Module):
     def __init__(self, opt: OptionsConfig, inp_nb_channels, out_nb_channels, kernel_sizes, strides, padding,
                  relus: List[bool],
-                 max_pool_k_size=None, max_pool_stride=None):
+                 max_pool_k_size=None, max_pool_stride=None, activation_checkpointing=False):
         super(CNNEncoder, self).__init__()
 
         self.opt = opt
         self.nb_channels = out_nb_channels
+        self.activation_checkpointing = activation_checkpointing
 
         assert (
                 len(kernel_sizes) == len(strides) == len(padding)
@@ -62,16 +64,53 @@ class CNNEncoder(nn.Module):
     def conv1d(in_dim, out_dim, kernel_size, stride, padding):
         return nn.Conv1d(in_dim, out_dim, kernel_size=kernel_size, stride=stride, padding=padding)
 
-    def forward(self, x) -> Tuple[Tensor, Tensor]:
-        # x is batch of audio files of shape [N x C x L]
+    def _forward_layers(self, x) -> Tensor:
         for layer in self.encoder:
             x = layer(x)
+        return x
+
+    def _forward_layers_recompute(self, x, state: dict) -> Tensor:
+        if not state["recompute"]:
+            state["recompute"] = True
+            return self._forward_layers(x)
+
+        # second call, during the backward pass: the batchnorm statistics were already updated in the forward pass
+        batch_norms = [m for m in self.encoder.modules() if isinstance(m, nn.BatchNorm1d)]
+        saved = [(m.momentum, m.num_batches_tracked.clone()) for m in batch_norms]
+        for m in batch_norms:
+            m.momentum = 0.0
+        try:
+            return self._forward_layers(x)
+        finally:
+            for m, (momentum, num_batches_tracked) in zip(batch_norms, saved):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+    def forward(self, x) -> Tuple[Tensor, Tensor]:
+        # x is batch of audio files of shape [N x C x L]
+        if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+            # only keep the input and output of the conv layers, recompute the rest during the backward pass
+            x = checkpoint(self._forward_layers_recompute, x, {"recompute": False}, use_reentrant=False)
+        else:
+            x = self._forward_layers(x)
         mu = self.encoder_mu(x)
         log_var = self.encoder_var(x)
 
-        assert mu.shape == log_var.shape == x.shape, f"mu shape: {mu.shape}, log_var shape: {log_var.shape}, result shape: {x.shape}"
+        # mu can have fewer channels than x after pruning collapsed latent dimensions (see latent_pruning.py)
+        assert mu.shape == log_var.shape and (mu.size(0), mu.size(2)) == (x.size(0), x.size(2)), f"mu shape: {mu.shape}, log_var shape: {log_var.shape}, result shape: {x.shape}"
         return mu, log_var
 
+    def output_lengths(self, lengths: Tensor) -> Tensor:
+        """Nb of output frames of inputs with `lengths` valid samples/frames (B), as computed by the conv/pool layers"""
+        for layer in self.encoder.modules():
+            if isinstance(layer, (nn.Conv1d, nn.MaxPool1d)):
+                kernel_size, stride, padding, dilation = [
+                    value[0] if isinstance(value, tuple) else value
+                    for value in (layer.kernel_size, layer.stride, layer.padding, layer.dilation)]
+                lengths = torch.div(lengths + 2 * padding - dilation * (kernel_size - 1) - 1, stride,
+                                    rounding_mode="floor") + 1
+        return lengths.clamp(min=0)
+
     def forward_intermediate_layer(self, x, layer_idx) -> Tuple[Tensor, Tensor]:
         """
         Forward pass until layer_idx and return the result. Returns 2 args due to plausible reparameterization trick.
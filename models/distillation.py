@@ -0,0 +1,191 @@
+"""
+Knowledge distillation of a trained FullModel (teacher) into a narrower and/or shallower FullModel (student), see
+encoder/distill.py.
+
+Every module of the student is matched to the module of the teacher of the same kind (cnn module or regressor) with
+the same nb of output frames (`match_modules`): a student with fewer channels matches every teacher module, a student
+with fewer layers/modules only the teacher modules at the same frame rate. Every student module is trained greedily,
+as in FullModel.forward (its input is detached), to predict the latents of its teacher module through a linear
+projection (student -> teacher channels, only used for training), optionally together with its own InfoNCE loss.
+The teacher latents are the means of its SIM modules (no sampling); SIM students keep their KLD term, otherwise
+nothing would constrain their variances. The matching loss is the MSE relative to the mean square of the teacher
+latents (1: as good as predicting zeros), such that it does not depend on the scale of the latents of a module.
+
+Only GIM/SIM models are supported: the single module of CPC has no intermediate latents to match.
+"""
+
+import copy
+import time
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from models.full_model import FullModel
+from models.independent_module import IndependentModule
+from models.independent_module_regressor import AutoregressorIndependentModule
+
+
+def _unwrap(model) -> FullModel:
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def module_output_lengths(model: FullModel, audio_length) -> List[int]:
+    """Nb of output frames of every module for inputs of `audio_length` samples"""
+    lengths, output_lengths = torch.tensor([audio_length]), []
+    for module in _unwrap(model).fullmodel:
+        lengths = module.output_lengths(lengths)
+        output_lengths.append(int(lengths))
+    return output_lengths
+
+
+def match_modules(student, teacher, audio_length) -> Dict[int, int]:
+    """
+    {student module idx: teacher module idx}: in order, every student module is matched to the next teacher module of
+    the same kind with the same nb of output frames. Student modules without a match only have their own losses.
+    """
+    student, teacher = _unwrap(student), _unwrap(teacher)
+    student_lengths = module_output_lengths(student, audio_length)
+    teacher_lengths = module_output_lengths(teacher, audio_length)
+
+    matches, next_teacher_idx = {}, 0
+    for idx, module in enumerate(student.fullmodel):
+        for teacher_idx in range(next_teacher_idx, len(teacher.fullmodel)):
+            if type(teacher.fullmodel[teacher_idx]) is type(module) and \
+                    teacher_lengths[teacher_idx] == student_lengths[idx]:
+                matches[idx] = teacher_idx
+                next_teacher_idx = teacher_idx + 1
+                break
+    return matches
+
+
+def _latent_dim(module) -> int:
+    if isinstance(module, IndependentModule):
+        return module.encoder.encoder_mu.out_channels  # fewer than nb_channels_cnn after pruning (latent_pruning.py)
+    return module.autoregressor.hidden_dim
+
+
+class Distiller(nn.Module):
+    """Student, frozen teacher and the projections of the matched student modules."""
+
+    def __init__(self, student, teacher, audio_length, distill_weight, nce_weight):
+        super(Distiller, self).__init__()
+        student, teacher = _unwrap(student), _unwrap(teacher)
+        for model in (student, teacher):
+            assert not model.opt.encoder_config.architecture.is_cpc, "Distillation is only supported for GIM/SIM"
+
+        self.student: FullModel = student
+        self.teacher: FullModel = teacher
+        self.teacher.requires_grad_(False)
+        self.teacher.eval()
+        self.distill_weight = distill_weight
+        self.nce_weight = nce_weight
+        self.kld_weight = student.opt.encoder_config.kld_weight
+
+        self.matches = match_modules(student, teacher, audio_length)
+        assert len(self.matches) > 0, "No module of the student has the same nb of output frames as a teacher module"
+        self.projections = nn.ModuleDict()
+        for idx, teacher_idx in self.matches.items():
+            in_dim, out_dim = _latent_dim(student.fullmodel[idx]), _latent_dim(teacher.fullmodel[teacher_idx])
+            self.projections[str(idx)] = nn.Linear(in_dim, out_dim) if in_dim != out_dim else nn.Identity()
+
+    def train(self, mode=True):
+        super(Distiller, self).train(mode)
+        self.teacher.eval()  # the teacher is never trained, eg keep its batchnorm statistics
+        return self
+
+    def trainable_parameters(self):
+        return list(self.student.parameters()) + list(self.projections.parameters())
+
+    def teacher_latents(self, x) -> List[Tensor]:
+        """Latents of the teacher modules (B x L x C) until the last matched one: the means for SIM modules"""
+        latents, model_input = [], x
+        for module in self.teacher.fullmodel[:max(self.matches.values()) + 1]:
+            if isinstance(module, IndependentModule):
+                (latent, _), _ = module._get_latent_params(model_input)
+                model_input = latent.permute(0, 2, 1)
+            else:  # regressor
+                latent, _ = module.get_latents(model_input)
+            latents.append(latent)
+        return latents
+
+    def _student_step(self, module, x) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """Latent (B x L x C, with gradients), nce loss, kld loss and accuracy of a student module"""
+        zero = torch.zeros((), device=x.device)
+        if isinstance(module, AutoregressorIndependentModule):
+            c, z = module.get_latents(x)
+            if self.nce_weight > 0:
+                nce_loss, accuracy = module.loss.get_loss(z, c)
+                return c, nce_loss, zero, accuracy
+            return c, zero, zero, zero
+
+        if self.nce_weight > 0:  # InfoNCE (and KLD) of the module itself
+            _, accuracy, z, nce_loss, kld_loss = module(x)
+            return z, nce_loss[0], kld_loss[0], accuracy[0]
+
+        (mu, log_var), _ = module._get_latent_params(x)
+        if module.predict_distributions:
+            return module._reparameterize(mu, log_var), zero, module._kld_loss(mu, log_var), zero
+        return mu, zero, zero, zero
+
+    def _matching_loss(self, idx, latent, target) -> Tensor:
+        prediction = self.projections[str(idx)](latent)
+        assert prediction.shape == target.shape, f"student module {idx}: {prediction.shape}, teacher: {target.shape}"
+        return F.mse_loss(prediction, target) / target.square().mean().clamp(min=1e-8)
+
+    def forward(self, x):
+        """
+        :param x: batch of audios, B x 1 x L
+        :return: loss, nce, kld, distill (matching loss) and accuracy (InfoNCE) of every student module, each of shape
+        (1, nb of student modules) as FullModel.forward. Modules without a match have a distill loss of 0
+        """
+        nb_modules = len(self.student.fullmodel)
+        loss, nce_loss, kld_loss, distill_loss, accuracy = [torch.zeros(1, nb_modules, device=x.device)
+                                                            for _ in range(5)]
+        with torch.no_grad():
+            teacher_latents = self.teacher_latents(x)
+
+        model_input = x
+        for idx, module in enumerate(self.student.fullmodel):
+            latent, nce_loss[:, idx], kld_loss[:, idx], accuracy[:, idx] = self._student_step(module, model_input)
+            if idx in self.matches:
+                distill_loss[:, idx] = self._matching_loss(idx, latent, teacher_latents[self.matches[idx]])
+
+            loss[:, idx] = self.distill_weight * distill_loss[:, idx] + self.nce_weight * nce_loss[:, idx] + \
+                           self.kld_weight * kld_loss[:, idx]
+            model_input = latent.permute(0, 2, 1).detach()
+
+        return loss, nce_loss, kld_loss, distill_loss, accuracy
+
+
+def inference_size(model) -> Tuple[int, float]:
+    """
+    Nb of parameters and size in MB (parameters and buffers, eg batchnorm statistics) needed for inference
+    (forward_through_*): without the InfoNCE heads and their negative memory banks
+    """
+    model = _unwrap(model)
+
+    def is_inference_tensor(name):
+        return name.split(".")[1] != "loss"  # eg "0.loss.predictor.weight", "0.loss.bank"
+
+    parameters = [p for name, p in model.fullmodel.named_parameters() if is_inference_tensor(name)]
+    buffers = [b for name, b in model.fullmodel.named_buffers() if is_inference_tensor(name)]
+    size = sum(t.numel() * t.element_size() for t in parameters + buffers)
+    return sum(p.numel() for p in parameters), size / 2 ** 20
+
+
+def measure_latency(model, audio_length, batch_size, nb_steps, warmup=2) -> float:
+    """Mean latency (s) of forward_through_all_modules on cpu (a copy of the model) for random audios"""
+    model = copy.deepcopy(_unwrap(model)).cpu().eval()
+    model.opt.device = torch.device("cpu")  # the copy has its own options
+    x = torch.randn(batch_size, 1, audio_length)
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            model.forward_through_all_modules(x)
+        start = time.perf_counter()
+        for _ in range(nb_steps):
+            model.forward_through_all_modules(x)
+    return (time.perf_counter() - start) / nb_steps
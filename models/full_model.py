@@ -8,6 +8,7 @@ from config_code.architecture_config import ArchitectureConfig, ModuleConfig
 from models import independent_module, independent_module_regressor, independent_module_cpc
 from models.abstract_module import AbstractModule
 from utils import utils
+from utils.compile_utils import compile_modules
 
 
 class FullModel(nn.Module):
@@ -53,6 +54,12 @@ class FullModel(nn.Module):
                 indep_module = FullModel.cnn_module_from_config(opt, module_config, calc_accuracy, idx == 0)
                 self.fullmodel.append(indep_module)
 
+        for idx, module in enumerate(self.fullmodel):
+            module.profile_name = f"module_{idx}"  # region names of the hot path profiler
+
+        if opt.compile_modules:
+            compile_modules(opt, self.fullmodel)
+
     @staticmethod
     def cpc_module_from_config(opt, m: ModuleConfig, calc_accuracy) -> independent_module_cpc.CPCIndependentModule:
         cpc_module = independent_module_cpc.CPCIndependentModule(
@@ -67,6 +74,7 @@ class FullModel(nn.Module):
             max_pool_stride=m.max_pool_stride,
             calc_accuracy=calc_accuracy,
             prediction_step=m.prediction_step,
+            activation_checkpointing=m.activation_checkpointing,
         )
         return cpc_module
 
@@ -99,11 +107,20 @@ class FullModel(nn.Module):
             max_pool_stride=max_pool_stride,
             calc_accuracy=calc_accuracy,
             prediction_step=prediction_step,
-            predict_distributions=module_config.predict_distributions
+            predict_distributions=module_config.predict_distributions,
+            activation_checkpointing=module_config.activation_checkpointing,
         )
         return module
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        """
+        :param x: batch of audios, B x 1 x L
+        :param lengths: nb of valid samples of every audio of a zero-padded batch of variable-length audios (B, long
+        tensor), such that the padding is masked in the losses and the latents passed to the next module are zero in the
+        padding. None: all audios have length L. Not masked: the layers within an encoder (the last valid frame of a
+        module may see the padding through its receptive field) and, in train mode, the BatchNorm statistics, which
+        include the padded frames, so the valid frames depend on the amount of padding of the batch
+        """
         model_input = x
 
         cur_device = utils.get_device(self.opt, x)
@@ -115,10 +132,12 @@ class FullModel(nn.Module):
         accuracy = torch.zeros(1, len(self.fullmodel), device=cur_device)
 
         for idx, layer in enumerate(self.fullmodel):
-            loss[:, idx], accuracy[:, idx], z, nce_loss[:, idx], kld_loss[:, idx] = layer(model_input)
+            loss[:, idx], accuracy[:, idx], z, nce_loss[:, idx], kld_loss[:, idx] = layer(model_input, lengths)
             model_input = z.permute(0, 2, 1).detach()
+            if lengths is not None:
+                lengths = layer.output_lengths(lengths)
 
-        return loss, nce_loss, kld_loss
+        return loss, nce_loss, kld_loss, accuracy
 
     def forward_through_all_modules(self, x):
         model_input = x
@@ -153,6 +172,36 @@ class FullModel(nn.Module):
         """Foward through all modules until the target module (inclusive)"""
         return self._forward_through_module(x, idx)
 
+    def sample_latents(self, x, nb_samples, idx=-1, seed=None):
+        """
+        `nb_samples` Monte-Carlo samples of the latents after module `idx` (inclusive, -1: the last cnn module, as in
+        forward_through_module; the index of the regressor gives its context), with every module run only once.
+        The first stochastic module draws all S samples from (c_mu, c_log_var) in one op, the higher modules get the
+        S*B sampled paths as one batch and draw one sample per path. Until the first stochastic module (and for GIM
+        entirely), the batch is not repeated.
+        :param seed: if given, the noise comes from a generator seeded with it: the same seed gives the same noise,
+        eg to compare inputs or models with common random numbers. Default: the global RNG
+        :return: S x B x L x C
+        """
+        if idx == -1:  # take last cnn module
+            idx = (len(self.fullmodel) - 1) - 1  # skip the regressor
+
+        generator = torch.Generator(device=x.device).manual_seed(seed) if seed is not None else None
+        batch_size = x.size(0)
+        model_input, nb_paths = x, 1
+        for module in self.fullmodel[:idx + 1]:
+            if isinstance(module, independent_module.IndependentModule) and module.predict_distributions:
+                latents = module.sample_latents(model_input, nb_samples if nb_paths == 1 else 1, generator)
+                latents = latents.reshape(-1, latents.size(2), latents.size(3))  # (S*B) x L x C
+                nb_paths = nb_samples
+            else:
+                c, z = module.get_latents(model_input)
+                latents = c if module is self.fullmodel[-1] else z  # context of the regressor
+            model_input = latents.permute(0, 2, 1)
+
+        latents = latents.reshape(nb_paths, batch_size, latents.size(1), latents.size(2))
+        return latents.expand(nb_samples, -1, -1, -1)
+
     def forward_through_layer(self, x, module_idx, layer_idx):
         """
         Forward through a specific layer in a specific module
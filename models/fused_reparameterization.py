@@ -0,0 +1,64 @@
+"""
+Reparameterization and KL-divergence of the SIM modules in one pass, enabled with
+`encoder_config.fused_reparameterization=True` (see IndependentModule._loss_terms).
+
+Compared to `IndependentModule._reparameterize` + `_kld_loss`, a single sample is drawn and used for both c and z
+(instead of one sample each from the same distribution), std is computed once and reused as exp(log_var) in the KLD,
+and the intermediate tensors are updated in place. With `recompute=True`, a custom autograd function only keeps mu,
+log_var and the sample for the backward pass, the gradients are recomputed from these: eps * std = sample - mu.
+
+The KLD is the same as IndependentModule._kld_loss: summed over dim 1 and averaged over the other dims.
+"""
+
+from torch import Tensor
+import torch
+
+
+def _nb_averaged(mu: Tensor) -> int:
+    return mu.numel() // mu.size(1)
+
+
+def _reparameterize_with_kld_inplace(mu: Tensor, log_var: Tensor) -> (Tensor, Tensor):
+    """Without autograd: two full-size tensors, the sample and std, which is reused for the terms of the KLD."""
+    std = torch.mul(log_var, 0.5).exp_()
+    sample = torch.randn_like(mu).mul_(std).add_(mu)
+    terms = std.square_().sub_(log_var).addcmul_(mu, mu).sub_(1)  # exp(log_var) - log_var + mu^2 - 1
+    return sample, terms.sum() * (0.5 / _nb_averaged(mu))
+
+
+class _ReparameterizeKLD(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, mu: Tensor, log_var: Tensor):
+        sample, kld_loss = _reparameterize_with_kld_inplace(mu, log_var)
+        ctx.save_for_backward(mu, log_var, sample)
+        return sample, kld_loss
+
+    @staticmethod
+    def backward(ctx, grad_sample: Tensor, grad_kld: Tensor):
+        mu, log_var, sample = ctx.saved_tensors
+        scale = grad_kld * (1.0 / _nb_averaged(mu))
+
+        # d sample / d mu = 1, d kld / d mu = mu
+        grad_mu = torch.add(grad_sample, mu * scale)
+        # d sample / d log_var = 0.5 * eps * std, d kld / d log_var = 0.5 * (exp(log_var) - 1)
+        grad_log_var = (sample - mu).mul_(grad_sample)
+        grad_log_var.add_(log_var.exp().sub_(1).mul_(scale)).mul_(0.5)
+        return grad_mu, grad_log_var
+
+
+def reparameterize_with_kld(mu: Tensor, log_var: Tensor, recompute=False) -> (Tensor, Tensor):
+    """
+    Sample from N(mu, exp(log_var)) and the KL-divergence with N(0, 1).
+    :param recompute: custom autograd function that recomputes the gradients from the sample instead of storing
+    std and eps. Without gradients, the in-place version is always used
+    :return: sample (same shape as mu), KLD (scalar)
+    """
+    if not (torch.is_grad_enabled() and (mu.requires_grad or log_var.requires_grad)):
+        return _reparameterize_with_kld_inplace(mu, log_var)
+    if recompute:
+        return _ReparameterizeKLD.apply(mu, log_var)
+
+    std = torch.exp(0.5 * log_var)
+    sample = torch.randn_like(std) * std + mu
+    kld_loss = 0.5 * torch.sum(std * std - log_var + mu * mu - 1) / _nb_averaged(mu)
+    return sample, kld_loss
@@ -1,3 +1,5 @@
+import warnings
+
 from torch import Tensor
 import torch
 import torch.nn as nn
@@ -10,7 +12,9 @@ from models import (
     cnn_encoder,
     loss_InfoNCE
 )
+from models.fused_reparameterization import reparameterize_with_kld
 from models.abstract_module import AbstractModule
+from utils.hot_path_profiler import profile_region, mark_backward, is_hot_path_profiler_enabled
 
 
 class IndependentModule(AbstractModule):
@@ -18,7 +22,8 @@ class IndependentModule(AbstractModule):
             self, opt: OptionsConfig,
             enc_kernel_sizes, enc_strides, enc_paddings, enc_non_linearities,
             nb_channels_cnn, nb_channels_regress, predict_distributions,
-            enc_input=1, max_pool_k_size=None, max_pool_stride=None, calc_accuracy=False, prediction_step=12):
+            enc_input=1, max_pool_k_size=None, max_pool_stride=None, calc_accuracy=False, prediction_step=12,
+            activation_checkpointing=False):
         super(IndependentModule, self).__init__()
 
         self.opt = opt
@@ -26,6 +31,7 @@ class IndependentModule(AbstractModule):
         self.nb_channels_cnn = nb_channels_cnn
         self.nb_channels_regressor = nb_channels_regress
         # Check whether GIM or SIM
+        self.profile_name = "module"  # set by FullModel, eg "module_0"
         self.predict_distributions = predict_distributions and \
                                      not (opt.encoder_config.deterministic)
         # also in SIM has option to be deterministic via encoder_config.deterministic
@@ -42,8 +48,12 @@ class IndependentModule(AbstractModule):
             relus=enc_non_linearities,
             max_pool_k_size=max_pool_k_size,
             max_pool_stride=max_pool_stride,
+            activation_checkpointing=activation_checkpointing,
         )
 
+        # `_loss_terms` compiled with torch.compile, set by `enable_compile` (see utils/compile_utils.py)
+        self.compiled_loss_terms = None
+
         # hidden dim of the encoder is the input dim of the loss
         self.loss = loss_InfoNCE.InfoNCE_Loss(
             opt, hidden_dim=self.nb_channels_cnn, enc_hidden=self.nb_channels_cnn, calc_accuracy=calc_accuracy,
@@ -60,6 +70,20 @@ class IndependentModule(AbstractModule):
         # return [(mu, log_var), (mu, log_var)]
         return sample, sample
 
+    def sample_latents(self, x, nb_samples, generator=None) -> Tensor:
+        """
+        `nb_samples` samples of c for the same input, with a single pass through the encoder and a single draw of the
+        noise for all samples. Deterministic modules (GIM) return the mean, expanded (not copied) S times.
+        :param generator: torch.Generator for the noise, default: the global RNG
+        :return: S x B x L x C
+        """
+        (c_mu, c_log_var), _ = self._get_latent_params(x)
+        if not self.predict_distributions:
+            return c_mu.unsqueeze(0).expand(nb_samples, *c_mu.shape)
+
+        eps = torch.randn((nb_samples,) + c_mu.shape, generator=generator, device=c_mu.device, dtype=c_mu.dtype)
+        return eps * torch.exp(0.5 * c_log_var) + c_mu
+
     def _get_latent_params(self, x: Tensor) -> ((Tensor, Tensor), (Tensor, Tensor)):
         """
         Calculate the latent representation of the input (using both the encoder and the autoregressive model)
@@ -89,6 +113,12 @@ class IndependentModule(AbstractModule):
         eps = torch.randn_like(std)
         return eps * std + mu
 
+    @staticmethod
+    def _kld_loss(mu: Tensor, log_var: Tensor) -> Tensor:
+        """KL-divergence between N(mu, var) and N(0, 1), summed over dim 1 and averaged over the rest"""
+        kld_loss = torch.mean(-0.5 * torch.sum(1 + log_var - mu ** 2 - log_var.exp(), dim=1), dim=0)
+        return kld_loss.mean()
+
     def get_latents_of_intermediate_layers(self, x, layer_idx) -> (Tensor, Tensor):
         raise NotImplementedError(
             "This method is not implemented yet. It is implemented however in independent_module_cpc.py.")
@@ -99,20 +129,84 @@ class IndependentModule(AbstractModule):
 
         return (mu, log_var), (mu, log_var)
 
-    def forward(self, x) -> (Tensor, Tensor, Tensor, Tensor, Tensor):
+    def enable_compile(self):
+        """
+        Run the whole training step of the module (encoder, reparameterization, KLD and InfoNCE) as a single compiled
+        graph. The length of the input is marked dynamic, such that different audio lengths can share a graph.
+        If compiling fails, the module falls back to eager mode.
+        """
+        self.compiled_loss_terms = torch.compile(self._loss_terms)
+
+    def _compiled_or_eager_loss_terms(self, x, lengths=None):
+        # only the training step is compiled (validation would add graphs for eval mode/inference mode), and the
+        # profiler measures separate regions, which would break the graph
+        if self.compiled_loss_terms is None or not self.training or is_hot_path_profiler_enabled():
+            return self._loss_terms(x, lengths)
+
+        torch._dynamo.maybe_mark_dynamic(x, 2)
+        compile_errors = (torch._dynamo.exc.BackendCompilerFailed, torch._dynamo.exc.InternalTorchDynamoError,
+                          torch._dynamo.exc.Unsupported)
+        try:
+            return self.compiled_loss_terms(x, lengths)
+        except compile_errors as e:  # eg no compiler for the backend. Errors of the model itself are not caught
+            warnings.warn(f"{self.profile_name}: torch.compile failed, falling back to eager mode. "
+                          f"{type(e).__name__}: {e}")
+            self.compiled_loss_terms = None
+            return self._loss_terms(x, lengths)
+
+    def output_lengths(self, lengths):
+        """Nb of valid output frames for inputs of `lengths` valid frames (B)"""
+        return self.encoder.output_lengths(lengths)
+
+    def forward(self, x, lengths=None) -> (Tensor, Tensor, Tensor, Tensor, Tensor):
         """
         combines all the operations necessary for calculating the loss and accuracy of the network given the input
         :param x: batch with sampled audios (dimensions: B x C x L)
+        :param lengths: nb of valid samples/frames of every input of a padded batch (B), None: no padding
         :return: total_loss - average loss over all samples, timesteps and prediction steps in the batch
                 accuracies - average accuracies over all samples, timesteps and predictions steps in the batch
                 c - latent representation of the input (either the output of the autoregressor,
                 if use_autoregressor=True, or the output of the encoder otherwise)
         """
+        total_loss, accuracies, z, nce_loss, kld_loss = self._compiled_or_eager_loss_terms(x, lengths)
+
+        mark_backward(total_loss, f"{self.profile_name}/backward")
+
+        # for multi-GPU training
+        total_loss = total_loss.unsqueeze(0)
+        accuracies = accuracies.unsqueeze(0)
 
+        nce_loss = nce_loss.unsqueeze(0)
+        kld_loss = kld_loss.unsqueeze(0)
+
+        return total_loss, accuracies, z, nce_loss, kld_loss
+
+    def _loss_terms(self, x, lengths=None) -> (Tensor, Tensor, Tensor, Tensor, Tensor):
         # B x L x C = Batch size x #channels x length
-        (c_mu, c_log_var), (z_mu, z_log_var) = self._get_latent_params(x)  # B x L x C
+        with profile_region(f"{self.profile_name}/encoder"):
+            (c_mu, c_log_var), (z_mu, z_log_var) = self._get_latent_params(x)  # B x L x C
+        frames, padding = None, None
+        if lengths is not None:
+            frames = self.output_lengths(lengths)
+            padding = (torch.arange(c_mu.size(1), device=c_mu.device) >= frames.unsqueeze(1)).unsqueeze(2)
+            if self.predict_distributions:  # N(0, 1) in the padding: no contribution to the KLD
+                c_mu, c_log_var = c_mu.masked_fill(padding, 0), c_log_var.masked_fill(padding, 0)
+                z_mu, z_log_var = c_mu, c_log_var
+
+        if self.predict_distributions and self.opt.encoder_config.fused_reparameterization:
+            # single sample for c and z, together with the KLD (c and z come from the same params)
+            kld_weight = self.opt.encoder_config.kld_weight
+            with profile_region(f"{self.profile_name}/kld"):
+                c, kld_loss = reparameterize_with_kld(
+                    c_mu, c_log_var, recompute=self.opt.encoder_config.reparameterization_recompute)
+            z = c
 
-        if self.predict_distributions:
+            with profile_region(f"{self.profile_name}/info_nce"):
+                nce_loss, accuracies = self.loss.get_loss(z, c, frames)
+
+            total_loss = nce_loss + kld_weight * kld_loss
+
+        elif self.predict_distributions:
             c = self._reparameterize(c_mu, c_log_var)  # (B, L, 512)
             z = self._reparameterize(z_mu, z_log_var)
 
@@ -121,11 +215,12 @@ class IndependentModule(AbstractModule):
 
             # KL-divergence loss
             kld_weight = self.opt.encoder_config.kld_weight
-            kld_loss = torch.mean(-0.5 * torch.sum(1 + log_var - mu ** 2 - log_var.exp(), dim=1), dim=0)
-            kld_loss = kld_loss.mean()  # shape: (1)
+            with profile_region(f"{self.profile_name}/kld"):
+                kld_loss = self._kld_loss(mu, log_var)  # shape: (1)
 
             # reconstruction loss
-            nce_loss, accuracies = self.loss.get_loss(z, c)
+            with profile_region(f"{self.profile_name}/info_nce"):
+                nce_loss, accuracies = self.loss.get_loss(z, c, frames)
 
             # Combine the losses
             total_loss = nce_loss + kld_weight * kld_loss
@@ -135,15 +230,11 @@ class IndependentModule(AbstractModule):
             c = c_mu
             z = z_mu
 
-            nce_loss, accuracies = self.loss.get_loss(z, c)
+            with profile_region(f"{self.profile_name}/info_nce"):
+                nce_loss, accuracies = self.loss.get_loss(z, c, frames)
             kld_loss = torch.tensor(0.0, device=self.opt.device)
             total_loss = nce_loss
 
-        # for multi-GPU training
-        total_loss = total_loss.unsqueeze(0)
-        accuracies = accuracies.unsqueeze(0)
-
-        nce_loss = nce_loss.unsqueeze(0)
-        kld_loss = kld_loss.unsqueeze(0)
-
+        if padding is not None:  # z is the input of the next module: zeros in the padding, as the padded audio
+            z = z.masked_fill(padding, 0)
         return total_loss, accuracies, z, nce_loss, kld_loss
@@ -11,6 +11,7 @@ from models import (
     loss_InfoNCE
 )
 from models.abstract_module import AbstractModule
+from utils.hot_path_profiler import profile_region, mark_backward
 
 
 class CPCIndependentModule(AbstractModule):
@@ -18,13 +19,15 @@ class CPCIndependentModule(AbstractModule):
             self, opt: OptionsConfig,
             enc_kernel_sizes, enc_strides, enc_paddings, enc_non_linearities,
             nb_channels_cnn, nb_channels_regress,
-            max_pool_k_size=None, max_pool_stride=None, calc_accuracy=False, prediction_step=12):
+            max_pool_k_size=None, max_pool_stride=None, calc_accuracy=False, prediction_step=12,
+            activation_checkpointing=False):
         super(CPCIndependentModule, self).__init__()
 
         self.opt = opt
         self.calc_accuracy = calc_accuracy
         self.nb_channels_cnn = nb_channels_cnn
         self.nb_channels_regressor = nb_channels_regress
+        self.profile_name = "module"  # set by FullModel, eg "module_0"
 
         # encoder, out: B x L x C = (22, 55, 512)
         self.encoder: cnn_encoder.CNNEncoder = cnn_encoder.CNNEncoder(
@@ -37,6 +40,7 @@ class CPCIndependentModule(AbstractModule):
             relus=enc_non_linearities,
             max_pool_k_size=max_pool_k_size,
             max_pool_stride=max_pool_stride,
+            activation_checkpointing=activation_checkpointing,
         )
 
         self.autoregressor = autoregressor.Autoregressor(
@@ -60,10 +64,15 @@ class CPCIndependentModule(AbstractModule):
         return self.autoregressor(z), z
 
 
-    def forward(self, x):
+    def output_lengths(self, lengths):
+        """Nb of valid output frames for inputs of `lengths` valid samples (B)"""
+        return self.encoder.output_lengths(lengths)
+
+    def forward(self, x, lengths=None):
         """
         combines all the operations necessary for calculating the loss and accuracy of the network given the input
         :param x: batch with sampled audios (dimensions: B x C x L)
+        :param lengths: nb of valid samples/frames of every input of a padded batch (B), None: no padding
         :return: total_loss - average loss over all samples, timesteps and prediction steps in the batch
                 accuracies - average accuracies over all samples, timesteps and predictions steps in the batch
                 c - latent representation of the input (either the output of the autoregressor,
@@ -71,12 +80,17 @@ class CPCIndependentModule(AbstractModule):
         """
 
         # B x L x C = Batch size x #channels x length
-        c, z = self.get_latents(x)
+        with profile_region(f"{self.profile_name}/encoder"):
+            c, z = self.get_latents(x)
 
-        nce_loss, accuracies = self.loss.get_loss(z, c)
+        with profile_region(f"{self.profile_name}/info_nce"):
+            frames = self.output_lengths(lengths) if lengths is not None else None
+            nce_loss, accuracies = self.loss.get_loss(z, c, frames)
         kld_loss = torch.tensor(0.0, device=self.opt.device)
         total_loss = nce_loss
 
+        mark_backward(total_loss, f"{self.profile_name}/backward")
+
         # for multi-GPU training
         total_loss = total_loss.unsqueeze(0)
         accuracies = accuracies.unsqueeze(0)
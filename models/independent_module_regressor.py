@@ -5,6 +5,7 @@ from models import (
     loss_InfoNCE,
     autoregressor
 )
+from utils.hot_path_profiler import profile_region, mark_backward
 
 
 class AutoregressorIndependentModule(nn.Module):
@@ -21,6 +22,7 @@ class AutoregressorIndependentModule(nn.Module):
         self.calc_accuracy = calc_accuracy
         self.nb_channels_cnn = nb_channels_cnn
         self.nb_channels_regressor = nb_channels_regress
+        self.profile_name = "module"  # set by FullModel, eg "module_4"
 
         self.autoregressor = autoregressor.Autoregressor(
             opt=opt, input_size=self.nb_channels_cnn, hidden_dim=self.nb_channels_regressor
@@ -47,10 +49,15 @@ class AutoregressorIndependentModule(nn.Module):
         c = self.autoregressor(z)
         return c, z
 
-    def forward(self, x):
+    def output_lengths(self, lengths):
+        """The regressor keeps the nb of frames"""
+        return lengths
+
+    def forward(self, x, lengths=None):
         """
         combines all the operations necessary for calculating the loss and accuracy of the network given the input
         :param x: batch with sampled audios (dimensions: B x C x L)
+        :param lengths: nb of valid samples/frames of every input of a padded batch (B), None: no padding
         :return: total_loss - average loss over all samples, timesteps and prediction steps in the batch
                 accuracies - average accuracies over all samples, timesteps and predictions steps in the batch
                 c - latent representation of the input (either the output of the autoregressor,
@@ -58,9 +65,13 @@ class AutoregressorIndependentModule(nn.Module):
         """
 
         # B x L x C = Batch size x #channels x length
-        c, z = self.get_latents(x)  # B x L x C
+        with profile_region(f"{self.profile_name}/encoder"):
+            c, z = self.get_latents(x)  # B x L x C
+
+        with profile_region(f"{self.profile_name}/info_nce"):
+            total_loss, accuracies = self.loss.get_loss(z, c, lengths)
 
-        total_loss, accuracies = self.loss.get_loss(z, c)
+        mark_backward(total_loss, f"{self.profile_name}/backward")
 
         # for multi-GPU training
         total_loss = total_loss.unsqueeze(0)
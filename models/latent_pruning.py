@@ -0,0 +1,192 @@
+"""
+Detection and pruning of collapsed latent dimensions of the SIM modules. The KL term pushes channels of c towards the
+prior N(0, 1): such a channel carries (almost) no information about the input, but is still stored and fed to the
+next module and the downstream classifiers.
+
+`collect_latent_stats` computes for every SIM module the average KL-divergence with the prior and the variance of
+mu over a dataset, per channel. Channels with an average KL below a threshold are inactive. `prune_model` removes them
+from `encoder_mu`/`encoder_var` of the module and from the input of the next module (its first conv, or the GRU of the
+regressor). A removed channel is replaced by its average mu over the dataset, which is folded into the bias of the
+next layer (exact up to the zero-padded frames at the borders).
+
+The channel map, {module_idx: kept channels (indices of the original channels)}, is needed to load the weights of a
+pruned model: build the FullModel from the same config, `apply_channel_map`, then `load_state_dict`.
+The pruned model is meant for extracting representations (get_latents, forward_through_*), the InfoNCE heads are not
+pruned, so it cannot be trained further.
+See post_hoc_analysis/interpretability/main_latent_pruning.py.
+"""
+
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from models.independent_module import IndependentModule
+from models.independent_module_regressor import AutoregressorIndependentModule
+
+
+class LatentChannelStats:
+    """Per channel statistics of (mu, log_var) of a SIM module, accumulated over batches of B x L x C."""
+
+    def __init__(self, nb_channels, device):
+        self.count = 0
+        self.kl_sum = torch.zeros(nb_channels, dtype=torch.float64, device=device)
+        self.mu_sum = torch.zeros(nb_channels, dtype=torch.float64, device=device)
+        self.mu_sq_sum = torch.zeros(nb_channels, dtype=torch.float64, device=device)
+
+    def update(self, mu: Tensor, log_var: Tensor):
+        mu, log_var = mu.reshape(-1, mu.size(-1)).double(), log_var.reshape(-1, log_var.size(-1)).double()
+        self.count += mu.size(0)
+        self.kl_sum += (0.5 * (mu ** 2 + log_var.exp() - log_var - 1)).sum(dim=0)
+        self.mu_sum += mu.sum(dim=0)
+        self.mu_sq_sum += (mu ** 2).sum(dim=0)
+
+    @property
+    def kl(self) -> Tensor:
+        """Average KL-divergence between q(c|x) and N(0, 1) per frame, per channel (nats)"""
+        return self.kl_sum / self.count
+
+    @property
+    def mean(self) -> Tensor:
+        return self.mu_sum / self.count
+
+    @property
+    def variance(self) -> Tensor:
+        """Variance of mu over the dataset (0 for a channel that does not depend on the input)"""
+        return (self.mu_sq_sum / self.count - self.mean ** 2).clamp(min=0)
+
+    def active_channels(self, kl_threshold) -> Tensor:
+        """Indices of the channels with an average KL of at least `kl_threshold`, at least the one with the max KL"""
+        active = torch.nonzero(self.kl >= kl_threshold).flatten()
+        return active if active.numel() > 0 else self.kl.argmax().reshape(1)
+
+
+def _unwrap(model):
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def collect_latent_stats(model, data_loader, max_batches: Optional[int] = None) -> Dict[int, LatentChannelStats]:
+    """
+    Statistics of the SIM modules (see LatentChannelStats) over the batches of `data_loader`, with the higher modules
+    fed as in FullModel.forward_through_module. `model`: FullModel, possibly wrapped in DataParallel, in eval mode.
+    """
+    model = _unwrap(model)
+    modules_config = model.opt.encoder_config.architecture.modules
+    stats: Dict[int, LatentChannelStats] = {}
+
+    with torch.no_grad():
+        for batch_idx, (audio, _, _, _) in enumerate(data_loader):
+            if max_batches is not None and batch_idx >= max_batches:
+                break
+
+            model_input = audio.to(model.opt.device)
+            for idx, module in enumerate(model.fullmodel):
+                if not isinstance(module, IndependentModule):  # regressor or CPC
+                    break
+
+                (mu, log_var), _ = module._get_latent_params(model_input)  # B x L x C
+                if modules_config[idx].predict_distributions:
+                    if idx not in stats:
+                        stats[idx] = LatentChannelStats(mu.size(-1), mu.device)
+                    stats[idx].update(mu, log_var)
+
+                z = module._reparameterize(mu, log_var) if module.predict_distributions else mu
+                model_input = z.permute(0, 2, 1)
+
+    return stats
+
+
+def _select_output_channels(conv: nn.Conv1d, kept: Tensor) -> nn.Conv1d:
+    pruned = nn.Conv1d(conv.in_channels, len(kept), conv.kernel_size, conv.stride, conv.padding,
+                       conv.dilation, conv.groups, conv.bias is not None).to(conv.weight.device)
+    with torch.no_grad():
+        pruned.weight.copy_(conv.weight[kept])
+        if conv.bias is not None:
+            pruned.bias.copy_(conv.bias[kept])
+    return pruned
+
+
+def _select_input_channels(conv: nn.Conv1d, kept: Tensor, removed: Tensor,
+                           removed_mean: Optional[Tensor]) -> nn.Conv1d:
+    pruned = nn.Conv1d(len(kept), conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                       conv.dilation, conv.groups, True).to(conv.weight.device)
+    with torch.no_grad():
+        pruned.weight.copy_(conv.weight[:, kept])
+        bias = conv.bias.clone() if conv.bias is not None else torch.zeros_like(pruned.bias)
+        if removed_mean is not None:  # constant input of the removed channels
+            bias += conv.weight[:, removed].sum(dim=2) @ removed_mean.to(bias.dtype)
+        pruned.bias.copy_(bias)
+    return pruned
+
+
+def _select_gru_input(gru: nn.GRU, kept: Tensor, removed: Tensor, removed_mean: Optional[Tensor]) -> nn.GRU:
+    assert gru.bias, "GRU without bias is not supported"
+    pruned = nn.GRU(input_size=len(kept), hidden_size=gru.hidden_size, num_layers=gru.num_layers, bias=True,
+                    batch_first=gru.batch_first, bidirectional=gru.bidirectional).to(gru.weight_ih_l0.device)
+    with torch.no_grad():
+        for name, param in gru.named_parameters():
+            if name.startswith("weight_ih_l0"):  # input weights of the first layer (and its reverse direction)
+                getattr(pruned, name).copy_(param[:, kept])
+                if removed_mean is not None:
+                    bias_name = name.replace("weight", "bias")
+                    getattr(pruned, bias_name).copy_(
+                        getattr(gru, bias_name) + param[:, removed] @ removed_mean.to(param.dtype))
+            elif not name.startswith("bias_ih_l0") or removed_mean is None:
+                getattr(pruned, name).copy_(param)
+    return pruned
+
+
+def _prune_module(model, module_idx, kept: Tensor, removed_mean: Optional[Tensor] = None):
+    """
+    Keep only the channels `kept` of the output of module `module_idx`.
+    :param removed_mean: mean of all channels (C), the removed channels are folded into the bias of the next layer.
+    None: only change the shapes (when loading the weights of a pruned model)
+    """
+    module = model.fullmodel[module_idx]
+    assert isinstance(module, IndependentModule), "Only the output of cnn modules can be pruned"
+    encoder = module.encoder
+    nb_channels = encoder.encoder_mu.out_channels
+    kept = kept.to(device=encoder.encoder_mu.weight.device, dtype=torch.long)
+    mask = torch.ones(nb_channels, dtype=torch.bool, device=kept.device)
+    mask[kept] = False
+    removed = torch.nonzero(mask).flatten()
+    removed_mean = removed_mean[removed] if removed_mean is not None else None
+
+    encoder.encoder_mu = _select_output_channels(encoder.encoder_mu, kept)
+    encoder.encoder_var = _select_output_channels(encoder.encoder_var, kept)
+
+    if module_idx + 1 == len(model.fullmodel):
+        return
+    next_module = model.fullmodel[module_idx + 1]
+    if isinstance(next_module, IndependentModule):
+        first_block = next_module.encoder.encoder[0]  # conv, or Sequential(conv, [batchnorm,] relu)
+        if isinstance(first_block, nn.Sequential):
+            first_block[0] = _select_input_channels(first_block[0], kept, removed, removed_mean)
+        else:
+            next_module.encoder.encoder[0] = _select_input_channels(first_block, kept, removed, removed_mean)
+    elif isinstance(next_module, AutoregressorIndependentModule):
+        regressor = next_module.autoregressor
+        regressor.gru = _select_gru_input(regressor.gru, kept, removed, removed_mean)
+        regressor.input_size = len(kept)
+
+
+def prune_model(model, stats: Dict[int, LatentChannelStats], kl_threshold) -> Dict[int, List[int]]:
+    """
+    Remove the inactive channels (average KL < `kl_threshold`) of every module in `stats`, in place.
+    :return: channel map {module_idx: kept channels}
+    """
+    model = _unwrap(model)
+    channel_map = {}
+    for module_idx, module_stats in sorted(stats.items()):
+        kept = module_stats.active_channels(kl_threshold)
+        _prune_module(model, module_idx, kept, removed_mean=module_stats.mean.float())
+        channel_map[module_idx] = kept.tolist()
+    return channel_map
+
+
+def apply_channel_map(model, channel_map: Dict[int, List[int]]):
+    """Shapes of a model pruned with `channel_map`, such that its state dict can be loaded (in place)."""
+    model = _unwrap(model)
+    for module_idx, kept in sorted(channel_map.items()):
+        _prune_module(model, int(module_idx), torch.tensor(kept, dtype=torch.long))
@@ -1,6 +1,9 @@
+import math
+
 import torch.nn as nn
 import torch
 import numpy as np
+from torch.utils.checkpoint import checkpoint
 
 from config_code.config_classes import OptionsConfig
 from models import loss
@@ -18,18 +21,51 @@ class InfoNCE_Loss(loss.Loss):
         self.calc_accuracy = calc_accuracy
         self.prediction_step = prediction_step
 
-        self.predictor = nn.Linear(
-            self.hidden_dim, self.enc_hidden * self.prediction_step, bias=False
-        )
+        self.predictor_rank = self.opt.encoder_config.predictor_rank
+        if self.predictor_rank > 0:
+            # low-rank head: shared projection + per step transforms, W_k = predictor @ predictor_steps[k - 1]
+            self.predictor = nn.Linear(self.hidden_dim, self.predictor_rank, bias=False)
+            self.predictor_steps = nn.Parameter(torch.empty(self.prediction_step, self.predictor_rank, self.enc_hidden))
+            bound = 1 / math.sqrt(self.predictor_rank)  # same init as nn.Linear(rank, enc_hidden)
+            nn.init.uniform_(self.predictor_steps, -bound, bound)
+        else:
+            self.predictor = nn.Linear(
+                self.hidden_dim, self.enc_hidden * self.prediction_step, bias=False
+            )
 
         if self.opt.encoder_config.subsample:
             self.subsample_win = 128
+        self.nb_windows = self.opt.encoder_config.subsample_windows
 
         self.loss = nn.LogSoftmax(dim=1)
-
-    def get_loss(self, z, c):
-
+        self.chunk_size = self.opt.encoder_config.negative_chunk_size
+
+        # FIFO ring buffer with the (detached) encodings of the previous steps, scored as additional negatives.
+        # Every training step replaces bank_size / staleness entries, such that the bank holds the last `staleness`
+        # steps. Not persistent: the bank is refilled after loading a checkpoint.
+        self.bank_size = self.opt.encoder_config.negative_bank_size
+        if self.bank_size > 0 and torch.cuda.device_count() > 1:
+            # DataParallel replicates the buffers on every forward pass, updates of the replicas would be lost
+            print("The negative memory bank is not supported with multiple GPUs, disabling it.")
+            self.bank_size = 0
+        if self.bank_size > 0:
+            self.bank_insert = max(self.bank_size // self.opt.encoder_config.negative_bank_staleness, 1)
+            self.register_buffer("bank", torch.zeros(self.bank_size, self.enc_hidden), persistent=False)
+            # position of the next insert and nb of filled entries, as tensors to avoid host syncs
+            self.register_buffer("bank_ptr", torch.zeros((), dtype=torch.long), persistent=False)
+            self.register_buffer("bank_filled", torch.zeros((), dtype=torch.long), persistent=False)
+
+    def get_loss(self, z, c, lengths=None):
+        """
+        :param z, c: B x L x C
+        :param lengths: nb of valid frames of every sequence of a padded batch (B). The positive pairs whose future
+        falls in the padding are not counted and negatives from the padding are masked. None: all frames are valid
+        """
         full_z = z
+        valid = full_valid = None
+        if lengths is not None:
+            lengths = lengths.to(z.device)
+            valid = full_valid = torch.arange(z.size(1), device=z.device) < lengths.unsqueeze(1)  # B x L
 
         """
         Subsample: 
@@ -37,23 +73,91 @@ class InfoNCE_Loss(loss.Loss):
         negative samples can still come from any point of the input sequence (full_z)
         """
         if c.size(1) > self.subsample_win:
-            seq_begin = np.random.randint(
-                0, c.size(1) - self.subsample_win)
-            c = c[:, seq_begin: seq_begin + self.subsample_win, :]
-            z = z[:, seq_begin: seq_begin + self.subsample_win, :]
+            if self.nb_windows > 0 or lengths is not None:  # windows inside the valid frames of every sequence
+                c, z, valid = self.sample_windows(c, z, lengths)
+            elif torch.compiler.is_compiling():  # numpy's RNG would break the compiled graph, draw on the device
+                seq_begin = torch.randint(0, c.size(1) - self.subsample_win, (), device=c.device)
+                window = seq_begin + torch.arange(self.subsample_win, device=c.device)
+                c = c.index_select(1, window)
+                z = z.index_select(1, window)
+            else:
+                seq_begin = np.random.randint(
+                    0, c.size(1) - self.subsample_win)
+                c = c[:, seq_begin: seq_begin + self.subsample_win, :]
+                z = z[:, seq_begin: seq_begin + self.subsample_win, :]
 
         Wc = self.predictor(c)
-        total_loss, accuracies = self.calc_InfoNCE_loss(Wc, z, full_z)
+        total_loss, accuracies = self.calc_InfoNCE_loss(Wc, z, full_z, valid, full_valid)
+
+        if self.bank_size > 0 and self.training:  # after the loss, such that the batch is no negative of itself
+            self.update_bank(full_z, full_valid)
         return total_loss, accuracies
 
+    @torch.no_grad()
+    def update_bank(self, full_z, full_valid=None):
+        """Replace the oldest `bank_insert` entries by randomly selected (valid) encodings of full_z (B x L x C)."""
+        full_z = full_z.detach().reshape(-1, full_z.size(2))
+        if full_valid is None:
+            new = full_z[torch.randint(0, full_z.size(0), (self.bank_insert,), device=full_z.device)]
+        else:
+            new = full_z[torch.multinomial(full_valid.reshape(-1).float(), self.bank_insert, replacement=True)]
+        idx = (self.bank_ptr + torch.arange(self.bank_insert, device=full_z.device)) % self.bank_size
+        # out of place: the scores of this step still need the old bank for the backward pass
+        self.bank = self.bank.index_copy(0, idx, new.to(self.bank.dtype))
+        self.bank_ptr.copy_((self.bank_ptr + self.bank_insert) % self.bank_size)
+        self.bank_filled.copy_(torch.clamp(self.bank_filled + self.bank_insert, max=self.bank_size))
+
+    def get_bank_samples_f(self, Wc_k):
+        """
+        Scores of the predictions against all encodings of the memory bank, with a single matmul:
+        (B*L) x C @ C x bank_size. Entries that were not filled yet get -inf, such that they don't contribute.
+        """
+        f_k = torch.matmul(Wc_k, self.bank.t())
+        unfilled = torch.arange(self.bank_size, device=f_k.device) >= self.bank_filled
+        return f_k.masked_fill(unfilled, float("-inf"))
+
+    def sample_windows(self, c, z, lengths=None):
+        """
+        Up to `nb_windows` windows per sequence (fewer if they wouldn't fit in the sequence, at least one), each at an
+        offset drawn independently on the device, gathered in a single indexing operation. Windows may overlap.
+        With `lengths`, the windows start inside the valid frames (at 0 for sequences shorter than a window).
+        :return: c, z of shape (B*nb_windows) x subsample_win x C, and which frames of the windows are valid (None
+        without `lengths`)
+        """
+        batch_size, seq_len = c.size(0), c.size(1)
+        nb_windows = max(min(self.nb_windows, seq_len // self.subsample_win), 1)
+
+        if lengths is None:
+            offsets = torch.randint(0, seq_len - self.subsample_win + 1, (batch_size, nb_windows, 1), device=c.device)
+        else:
+            nb_offsets = (lengths - self.subsample_win).clamp(min=0) + 1
+            offsets = (torch.rand(batch_size, nb_windows, 1, device=c.device) * nb_offsets.view(-1, 1, 1)).long()
+        positions = (offsets + torch.arange(self.subsample_win, device=c.device)).view(batch_size, -1)
+        samples = torch.arange(batch_size, device=c.device).unsqueeze(1)
+
+        c = c[samples, positions].view(batch_size * nb_windows, self.subsample_win, c.size(2))
+        z = z[samples, positions].view(batch_size * nb_windows, self.subsample_win, z.size(2))
+        valid = None
+        if lengths is not None:
+            valid = (positions < lengths.unsqueeze(1)).view(batch_size * nb_windows, self.subsample_win)
+        return c, z, valid
+
+    def get_Wc_k(self, Wc, k):
+        """
+        Predictions for time-step t+k of all positions t that have a future at t+k: B x (L-k) x C.
+        For the low-rank head, Wc is the shared projection (B x L x rank), only the needed positions are transformed.
+        """
+        if self.predictor_rank > 0:
+            return torch.matmul(Wc[:, :-k, :], self.predictor_steps[k - 1])
+        return Wc[:, :-k, (k - 1) * self.enc_hidden: k * self.enc_hidden]
+
     def broadcast_batch_length(self, input_tensor):
         """
         broadcasts the given tensor in a consistent way, such that it can be applied to different inputs and
         keep their indexing compatible
-        :param input_tensor: tensor to be broadcasted, generally of shape B x L x C
+        :param input_tensor: tensor to be broadcasted, generally of shape B x L x C (or (B*nb_windows) x L x C)
         :return: reshaped tensor of shape (B*L) x C
         """
-        assert input_tensor.size(0) == self.opt.encoder_config.dataset.batch_size
         assert len(input_tensor.size()) == 3
 
         return input_tensor.reshape(-1, input_tensor.size(2))
@@ -76,7 +180,8 @@ class InfoNCE_Loss(loss.Loss):
         scramble z to retrieve negative samples, i.e. z values that should not be predicted by the model
         :param z: unshuffled z as output by the model
         :return: z_neg - shuffled z to be used for negative sampling
-                shuffling params rand_neg_idx, rand_offset for testing this function
+                shuffling params rand_neg_idx (the permutations, neg_samples x (B*L)), rand_offset for testing this
+                function
         """
 
         """ randomly selecting from all z values; 
@@ -85,26 +190,32 @@ class InfoNCE_Loss(loss.Loss):
             done once for all time-steps, much faster
         """
         z = self.broadcast_batch_length(z)
+        if torch.compiler.is_compiling():
+            # inductor fails to compile the randperm indexing with dynamic lengths, same permutations through argsort
+            rand_perms = torch.rand(self.neg_samples, z.size(0), device=cur_device).argsort(dim=1)
+            z_neg = z[rand_perms].permute(1, 2, 0)
+            return z_neg, rand_perms, None
+
+        rand_neg_idx = [torch.randperm(z.size(0), device=cur_device) for i in range(self.neg_samples)]
         z_neg = torch.stack(
             [
-                torch.index_select(
-                    z, 0, torch.randperm(z.size(0), device=cur_device)
-                )
-                for i in range(self.neg_samples)
+                torch.index_select(z, 0, perm)
+                for perm in rand_neg_idx
             ],
             2,
         )
-        rand_neg_idx = None
+        rand_neg_idx = torch.stack(rand_neg_idx)
         rand_offset = None
 
         return z_neg, rand_neg_idx, rand_offset
 
-    def get_neg_samples_f(self, Wc_k, z_neg=None, k=None):
+    def get_neg_samples_f(self, Wc_k, z_neg=None, k=None, neg_valid=None):
         """
         calculate the output of the log-bilinear model for the negative samples. For this, we get z_k_neg from z_k
         by randomly shuffling the indices.
         :param Wc_k: prediction of the network for the encoded future at time-step t+k (dimensions: (B*L) x C)
         :param z_k: encoded future at time-step t+k (dimensions: (B*L) x C)
+        :param neg_valid: which negatives are valid (dimensions: (B*L) x neg_samples), the others get the lowest score
         :return: f_k, output of the log-bilinear model (without exp, as this is part of the log-softmax function)
         """
         Wc_k = Wc_k.unsqueeze(1)
@@ -119,60 +230,181 @@ class InfoNCE_Loss(loss.Loss):
         z_k_neg = z_neg[z_neg.size(0) - Wc_k.size(0):, :, :]
 
         f_k = torch.squeeze(torch.matmul(Wc_k, z_k_neg), 1)
+        if neg_valid is not None:  # shortened in the same way as z_neg
+            f_k = f_k.masked_fill(~neg_valid[neg_valid.size(0) - Wc_k.size(0):], torch.finfo(f_k.dtype).min)
 
         return f_k
 
-    def calc_InfoNCE_loss(self, Wc, z, full_z=None):
+    def calc_InfoNCE_loss(self, Wc, z, full_z=None, valid=None, full_valid=None):
         """
         calculate the loss based on the model outputs Wc (the prediction) and z (the encoded future)
-        :param Wc: output of the predictor, where W are the weights for the different timesteps and
+        :param Wc: output of the predictor (see get_Wc_k), where W are the weights for the different timesteps and
         c the latent representation (either from the autoregressor, if use_autoregressor=True,
         or from the encoder otherwise) - dimensions: (B, L, C*self.prediction_step)
         :param z: encoded future - output of the encoder - dimensions: (B, L, C)
-        :return: total_loss - average loss over all samples, timesteps and prediction steps in the batch
+        :param valid, full_valid: which frames of z and full_z are not padding (B x L), None: all
+        :return: total_loss - average loss over all (valid) samples, timesteps and prediction steps in the batch
                     accuracies - average accuracies over all samples, timesteps and predictions steps in the batch
         """
+        if self.chunk_size > 0:
+            return self.calc_InfoNCE_loss_chunked(Wc, z, full_z, valid, full_valid)
+
         seq_len = z.size(1)
 
         cur_device = utils.get_device(self.opt, Wc)
 
         total_loss = 0
-        batch_size = self.opt.encoder_config.dataset.batch_size
+        batch_size = z.size(0)  # B, or B * nb of windows per sequence with subsample_windows
 
-        accuracies = torch.zeros(self.prediction_step, 1)
+        accuracies = torch.zeros(self.prediction_step, 1, device=cur_device)  # on device, to avoid host syncs
         true_labels = torch.zeros(
             (seq_len * batch_size,), device=cur_device
         ).long()
 
-        z_neg, _, _ = self.get_neg_z(full_z, cur_device)
+        z_neg = neg_valid = None
+        if self.neg_samples > 0:
+            z_neg, rand_neg_idx, _ = self.get_neg_z(full_z, cur_device)
+            if full_valid is not None:
+                neg_valid = full_valid.reshape(-1)[rand_neg_idx].t()  # (B*L) x neg_samples
 
         for k in range(1, self.prediction_step + 1):
             z_k = z[:, k:, :]
-            Wc_k = Wc[:, :-k, (k - 1) * self.enc_hidden: k * self.enc_hidden]
+            Wc_k = self.get_Wc_k(Wc, k)
 
             z_k = self.broadcast_batch_length(z_k)
             Wc_k = self.broadcast_batch_length(Wc_k)
 
             pos_samples = self.get_pos_sample_f(Wc_k, z_k)
-            neg_samples = self.get_neg_samples_f(Wc_k, z_neg, k)
+            samples = [pos_samples]
+            if z_neg is not None:
+                samples.append(self.get_neg_samples_f(Wc_k, z_neg, k, neg_valid))
+            if self.bank_size > 0:
+                samples.append(self.get_bank_samples_f(Wc_k))
 
             # concatenate positive and negative samples
-            results = torch.cat((pos_samples, neg_samples), 1)
+            results = torch.cat(samples, 1)
             loss = self.loss(results)[:, 0]
 
-            total_samples = (seq_len - k) * batch_size
+            pos_valid = valid[:, k:].reshape(-1) if valid is not None else None
+            total_samples = (seq_len - k) * batch_size if valid is None else pos_valid.sum().clamp(min=1)
+            if pos_valid is not None:
+                loss = loss.masked_fill(~pos_valid, 0)
             loss = -loss.sum() / total_samples
             total_loss += loss
 
             # calculate accuracy
             if self.calc_accuracy:
                 predicted = torch.argmax(results, 1)
-                correct = (
-                    (predicted == true_labels[: (seq_len - k) * batch_size])
-                    .sum()
-                    .item()
-                )
-                accuracies[k - 1] = correct / total_samples
+                correct = predicted == true_labels[: (seq_len - k) * batch_size]
+                if pos_valid is not None:
+                    correct = correct & pos_valid
+                accuracies[k - 1] = correct.sum().float() / total_samples
+
+        total_loss /= self.prediction_step
+        accuracies = torch.mean(accuracies)
+
+        return total_loss, accuracies
+
+    def get_neg_idx(self, full_z, cur_device):
+        """
+        Same permutations as `get_neg_z`, but as indices into the (B*L) encodings instead of a copy of them
+        :return: neg_samples x (B*L)
+        """
+        nb_encodings = full_z.size(0) * full_z.size(1)
+        if torch.compiler.is_compiling():  # randperm breaks the compiled graph, see get_neg_z
+            return torch.rand(self.neg_samples, nb_encodings, device=cur_device).argsort(dim=1)
+        return torch.stack(
+            [torch.randperm(nb_encodings, device=cur_device) for i in range(self.neg_samples)]
+        )
+
+    @staticmethod
+    def _neg_chunk_scores(Wc_k, z_flat, neg_idx, valid_flat=None):
+        """
+        scores of the predictions (N x C) against the in-batch negatives neg_idx (J x N): J x N. Negatives that are not
+        valid_flat (padding) get the lowest finite value
+        """
+        scores = (z_flat[neg_idx] * Wc_k.unsqueeze(0)).sum(2)
+        if valid_flat is not None:
+            scores = scores.masked_fill(~valid_flat[neg_idx], torch.finfo(scores.dtype).min)
+        return scores
+
+    @staticmethod
+    def _bank_chunk_scores(Wc_k, bank, bank_filled, bank_idx):
+        """scores against the bank entries bank_idx (J), unfilled entries get the lowest finite value: J x N"""
+        scores = torch.matmul(bank[bank_idx], Wc_k.t())
+        unfilled = (bank_idx >= bank_filled).unsqueeze(1)
+        return scores.masked_fill(unfilled, torch.finfo(scores.dtype).min)
+
+    def _chunk_logsumexp(self, scores_fn, *args):
+        """
+        logsumexp over the negatives of a chunk. The scores are recomputed in the backward pass instead of stored,
+        such that only one chunk of scores is in memory at a time. Also returns the max score, for the accuracy.
+        """
+        if torch.is_grad_enabled():
+            lse = checkpoint(lambda *a: torch.logsumexp(scores_fn(*a), 0), *args, use_reentrant=False)
+        else:
+            lse = torch.logsumexp(scores_fn(*args), 0)
+
+        max_score = None
+        if self.calc_accuracy:
+            with torch.no_grad():
+                max_score = scores_fn(*args).max(0).values
+        return lse, max_score
+
+    def calc_InfoNCE_loss_chunked(self, Wc, z, full_z, valid=None, full_valid=None):
+        """
+        Same loss as `calc_InfoNCE_loss`, without materializing the (B*L) x C x neg_samples negatives or the
+        (B*L) x (1 + neg_samples) scores: the negatives are scored in chunks of `negative_chunk_size`, of which only
+        the log-sum-exp is kept. The chunks are combined with the positive sample in a final log-sum-exp.
+        """
+        seq_len = z.size(1)
+        cur_device = utils.get_device(self.opt, Wc)
+
+        total_loss = 0
+        batch_size = z.size(0)  # B, or B * nb of windows per sequence with subsample_windows
+        accuracies = torch.zeros(self.prediction_step, 1, device=cur_device)
+
+        z_flat = self.broadcast_batch_length(full_z)
+        valid_flat = full_valid.reshape(-1) if full_valid is not None else None
+        neg_idx = self.get_neg_idx(full_z, cur_device) if self.neg_samples > 0 else None
+        # the bank is updated after this step, the recomputation in the backward pass needs the current one
+        bank = self.bank if self.bank_size > 0 else None
+        bank_filled = self.bank_filled.clone() if self.bank_size > 0 else None
+
+        for k in range(1, self.prediction_step + 1):
+            z_k = self.broadcast_batch_length(z[:, k:, :])
+            Wc_k = self.broadcast_batch_length(self.get_Wc_k(Wc, k))
+
+            pos_samples = self.get_pos_sample_f(Wc_k, z_k).squeeze(1)
+            chunks = []
+            if neg_idx is not None:
+                # shortened from the front, as in get_neg_samples_f
+                neg_idx_k = neg_idx[:, neg_idx.size(1) - Wc_k.size(0):]
+                for start in range(0, self.neg_samples, self.chunk_size):
+                    chunks.append(self._chunk_logsumexp(
+                        self._neg_chunk_scores, Wc_k, z_flat, neg_idx_k[start: start + self.chunk_size], valid_flat))
+            if bank is not None:
+                for start in range(0, self.bank_size, self.chunk_size):
+                    bank_idx = torch.arange(start, min(start + self.chunk_size, self.bank_size), device=cur_device)
+                    chunks.append(self._chunk_logsumexp(self._bank_chunk_scores, Wc_k, bank, bank_filled, bank_idx))
+
+            lse = torch.logsumexp(torch.stack([pos_samples] + [chunk_lse for chunk_lse, _ in chunks]), 0)
+
+            pos_valid = valid[:, k:].reshape(-1) if valid is not None else None
+            total_samples = (seq_len - k) * batch_size if valid is None else pos_valid.sum().clamp(min=1)
+            loss = lse - pos_samples
+            if pos_valid is not None:
+                loss = loss.masked_fill(~pos_valid, 0)
+            loss = loss.sum() / total_samples
+            total_loss += loss
+
+            # the positive sample wins ties, as argmax returns the first index
+            if self.calc_accuracy:
+                correct = pos_samples >= torch.stack([max_score for _, max_score in chunks]).max(0).values \
+                    if len(chunks) > 0 else torch.ones_like(pos_samples, dtype=torch.bool)
+                if pos_valid is not None:
+                    correct = correct & pos_valid
+                accuracies[k - 1] = correct.sum().float() / total_samples
 
         total_loss /= self.prediction_step
         accuracies = torch.mean(accuracies)
@@ -0,0 +1,104 @@
+"""
+Detects the collapsed latent dimensions of the SIM modules, prunes them (see models/latent_pruning.py) and compares the
+accuracy of the syllable/vowel probe (linear_classifiers/logistic_regression.py) before and after pruning.
+
+Example usage (probe on the output of the last cnn module, the representations of the pruned channels are replaced by
+their mean, so compare with a deterministic encoder):
+    python -m post_hoc_analysis.interpretability.main_latent_pruning final_bart/bart_full_audio_distribs_distr=true_kld=0 sim_audio_de_boer_distr_true --overrides encoder_config.deterministic=True syllables_classifier_config.encoder_num=9999 syllables_classifier_config.bias=False
+
+Writes to `<log_path>/latent_pruning/`:
+    channel_map_<encoder_num>.json: kept channels, average KL and variance per channel of every SIM module, and the
+        probe accuracies
+    model_pruned_<encoder_num>.ckpt: weights of the pruned model, load with models.latent_pruning.apply_channel_map
+"""
+
+import copy
+import json
+import os
+
+import torch
+
+from arg_parser import arg_parser
+from config_code.config_classes import OptionsConfig, ModelType, ClassifierConfig
+from data import get_dataloader
+from linear_classifiers.logistic_regression import train, test
+from models import load_audio_model
+from models.latent_pruning import collect_latent_stats, prune_model
+from models.loss_supervised_syllables import Syllables_Loss
+from options import get_options
+from utils import logger
+from utils.utils import set_seed, get_nb_classes
+
+KL_THRESHOLD = 0.01  # average KL per frame (nats) below which a channel is inactive
+MAX_STATS_BATCHES = 200  # nb of training batches for the statistics of the latents
+
+
+def probe_accuracy(opt: OptionsConfig, context_model, n_features, train_loader, test_loader) -> float:
+    """Test accuracy of a linear probe trained on the representations of `context_model`."""
+    classifier_config: ClassifierConfig = opt.syllables_classifier_config
+    bias = classifier_config.bias
+    num_classes = get_nb_classes(classifier_config.dataset.dataset, classifier_config.dataset.labels)
+
+    set_seed(opt.seed)  # same initialization and order of the batches for both models
+    loss = Syllables_Loss(opt, n_features, calc_accuracy=True, num_syllables=num_classes, bias=bias)
+    optimizer = torch.optim.Adam(loss.parameters(), lr=classifier_config.learning_rate)
+    train(opt, context_model, loss, logger.Logger(opt), train_loader, optimizer, wandb_is_on=False, bias=bias)
+    _, accuracy = test(opt, context_model, loss, test_loader, wandb_is_on=False, bias=bias)
+    return accuracy
+
+
+def main():
+    opt: OptionsConfig = get_options()
+    classifier_config: ClassifierConfig = opt.syllables_classifier_config
+    opt.model_type = ModelType.ONLY_DOWNSTREAM_TASK
+
+    arg_parser.create_log_path(opt, add_path_var="latent_pruning")
+    set_seed(opt.seed)
+
+    context_model, _ = load_audio_model.load_model_and_optimizer(
+        opt, classifier_config, reload_model=True, calc_accuracy=True, num_GPU=1)
+    context_model.eval()
+
+    train_loader, _, test_loader, _ = get_dataloader.get_dataloader(classifier_config.dataset)
+
+    stats = collect_latent_stats(context_model, train_loader, max_batches=MAX_STATS_BATCHES)
+    if len(stats) == 0:
+        print("No module predicts distributions (GIM or CPC), nothing to prune.")
+        return
+
+    pruned_model = copy.deepcopy(context_model)
+    channel_map = prune_model(pruned_model, stats, KL_THRESHOLD)
+    for module_idx, kept in channel_map.items():
+        print(f"Module {module_idx}: {len(kept)}/{len(stats[module_idx].kl)} active channels "
+              f"(KL >= {KL_THRESHOLD}), total KL: {stats[module_idx].kl.sum():.2f} nats per frame")
+
+    # representation of the probe: output of the regressor (bias), or of a cnn module
+    nb_modules = len(context_model.module.fullmodel)
+    probed_module = classifier_config.encoder_module if classifier_config.encoder_module >= 0 else nb_modules - 2
+    regr_hidden_dim = opt.encoder_config.architecture.modules[0].regressor_hidden_dim
+    cnn_hidden_dim = opt.encoder_config.architecture.modules[0].cnn_hidden_dim
+    n_features = regr_hidden_dim if classifier_config.bias else cnn_hidden_dim
+    n_features_pruned = n_features if classifier_config.bias else len(channel_map.get(probed_module, range(n_features)))
+    print(f"Features of the probe: {n_features} -> {n_features_pruned} channels per frame")
+
+    accuracy = probe_accuracy(opt, context_model, n_features, train_loader, test_loader)
+    accuracy_pruned = probe_accuracy(opt, pruned_model, n_features_pruned, train_loader, test_loader)
+    print(f"Probe accuracy: {accuracy:.4f} (all channels) -> {accuracy_pruned:.4f} (pruned)")
+
+    encoder_num = classifier_config.encoder_num
+    torch.save(pruned_model.state_dict(), os.path.join(opt.log_path, f"model_pruned_{encoder_num}.ckpt"))
+    with open(os.path.join(opt.log_path, f"channel_map_{encoder_num}.json"), "w") as f:
+        json.dump({
+            "kl_threshold": KL_THRESHOLD,
+            "channel_map": channel_map,
+            "stats": {module_idx: {"kl": module_stats.kl.tolist(), "variance": module_stats.variance.tolist()}
+                      for module_idx, module_stats in stats.items()},
+            "probe": {"module": probed_module, "bias": classifier_config.bias,
+                      "n_features": n_features, "n_features_pruned": n_features_pruned,
+                      "accuracy": accuracy, "accuracy_pruned": accuracy_pruned},
+        }, f, indent=2)
+    print(f"Saved the pruned model and channel map to {opt.log_path}")
+
+
+if __name__ == "__main__":
+    main()
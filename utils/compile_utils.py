@@ -0,0 +1,52 @@
+"""
+torch.compile of the training step of the IndependentModules (encoder, reparameterization, KLD and InfoNCE as one
+graph, see IndependentModule.enable_compile), enabled with `compile_modules`. Eg:
+    python -m encoder.train temp sim_audio_de_boer_distr_true --overrides compile_modules=true
+
+The length dimension of the input is marked dynamic, such that a new audio length doesn't trigger a recompile, unless
+it changes the control flow of a module (eg the output of the module becomes shorter than the subsample window of
+InfoNCE_Loss, as for the last module with the 8800 samples of De Boer syllables). The compiled kernels are cached on
+disk per config in `<root_logs>/compile_cache/<config_file>`, such that only the first run of a config pays the full
+compile time.
+A module whose compilation fails (eg no C++ compiler available) falls back to eager mode with a warning.
+
+Compiling is skipped with multiple GPUs, as DataParallel replicates the modules on every forward pass.
+Compiled vs eager: see `--compile` in benchmarks/full_model_benchmark.py
+"""
+
+import os
+
+import torch
+import torch._inductor.config
+from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+
+from config_code.config_classes import OptionsConfig
+
+COMPILE_CACHE_DIR = "compile_cache"
+
+
+def set_compile_cache_dir(opt: OptionsConfig) -> str:
+    """Must be called before the first compilation. A cache dir set by the user (environment variable) is kept."""
+    root_logs = os.path.dirname(opt.log_path)
+    cache_dir = os.path.abspath(os.path.join(root_logs, COMPILE_CACHE_DIR, os.path.splitext(opt.config_file)[0]))
+    # inductor sets the variable to its default (in /tmp) when imported
+    if os.environ.get("TORCHINDUCTOR_CACHE_DIR", default_cache_dir()) == default_cache_dir():
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    cache_dir = os.environ["TORCHINDUCTOR_CACHE_DIR"]
+    os.makedirs(cache_dir, exist_ok=True)
+    torch._inductor.config.fx_graph_cache = True
+    return cache_dir
+
+
+def compile_modules(opt: OptionsConfig, modules):
+    if torch.cuda.device_count() > 1:
+        print("compile_modules is not supported with DataParallel over multiple GPUs, using eager mode.")
+        return
+
+    cache_dir = set_compile_cache_dir(opt)
+    compiled = 0
+    for module in modules:
+        if hasattr(module, "enable_compile"):
+            module.enable_compile()
+            compiled += 1
+    print(f"Compiling {compiled} modules, cache: {cache_dir}")
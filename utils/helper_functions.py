@@ -1,5 +1,6 @@
 import os
 import time
+from functools import lru_cache
 from typing import Any
 
 import IPython.display as ipd
@@ -333,10 +334,16 @@ def save_audio(audio, dir, file, sample_rate=16000):
     sf.write(f"{dir}/{file}.wav", audio, sample_rate)
 
 
+@lru_cache(maxsize=None)
+def get_resampler(curr_samplerate, new_samplerate, device='cpu') -> torchaudio.transforms.Resample:
+    ''' Resample transform of which the sinc kernel is computed once per (samplerates, device) (and per process) '''
+    return torchaudio.transforms.Resample(orig_freq=curr_samplerate, new_freq=new_samplerate).to(device)
+
+
 def resample(audio, curr_samplerate=22050, new_samplerate=16000):
-    audio = torchaudio.functional.resample(
-        audio, orig_freq=curr_samplerate, new_freq=new_samplerate)
-    return audio
+    # works on single clips (C x L) and on batches (B x C x L)
+    resampler = get_resampler(curr_samplerate, new_samplerate, str(audio.device))
+    return resampler(audio)
 
 
 def translate_syllable_to_number(syllable):
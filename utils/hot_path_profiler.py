@@ -0,0 +1,160 @@
+"""
+Opt-in per-module profiler of the training step (`profile_hot_path=True`). Records wall-clock time and allocated
+device memory of every region of the hot path, per module:
+    module_{idx}/encoder    (CNN encoder / autoregressor forward)
+    module_{idx}/kld        (KL-divergence term, SIM only)
+    module_{idx}/info_nce   (InfoNCE_Loss.get_loss)
+    module_{idx}/backward
+    optimizer_step, data_wait
+After every epoch a summary table is printed and the timeline is written to `<log_path>/hot_path_trace.json`, which
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+The modules are trained with a single backward pass over the sum of their losses. The backward time per module is
+measured with a gradient hook on the loss of each module (`mark_backward`): the time from that hook until the hook of
+the next module (or the end of the backward pass) is attributed to the module. Autograd handles the (disjoint) graphs
+of the modules one after the other, from the last module to the first.
+
+On cuda, the device is synchronized at the start and end of every region such that the timings are exact; this slows
+down training, so only enable it to profile. Memory is only reported on cuda (torch.cuda.memory_allocated).
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class HotPathProfiler:
+    def __init__(self, device):
+        self.device = device
+        self.is_cuda = device.type == "cuda"
+        self.origin = time.perf_counter()
+        self.events = []  # chrome trace events of the whole run
+        self.epoch_stats = defaultdict(lambda: {"count": 0, "time": 0.0, "mem_delta": 0.0, "mem_peak": 0.0})
+        self._backward_marks = None  # [(name, time, memory)] during a backward pass
+
+    def _memory(self):
+        return torch.cuda.memory_allocated(self.device) if self.is_cuda else 0
+
+    def _sync(self):
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def region(self, name):
+        self._sync()
+        mem_start = self._memory()
+        if self.is_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            end = time.perf_counter()
+            mem_end = self._memory()
+            mem_peak = torch.cuda.max_memory_allocated(self.device) if self.is_cuda else 0
+            self.record(name, end - start, end=end, mem_delta=mem_end - mem_start, mem_peak=mem_peak - mem_start)
+
+    @contextmanager
+    def backward(self):
+        self._sync()
+        self._backward_marks = [("backward_other", time.perf_counter(), self._memory())]
+        try:
+            yield
+        finally:
+            self._sync()
+            marks = self._backward_marks + [(None, time.perf_counter(), self._memory())]
+            self._backward_marks = None
+            for (name, start, mem_start), (_, end, mem_end) in zip(marks[:-1], marks[1:]):
+                if end > start:
+                    self.record(name, end - start, end=end, mem_delta=mem_end - mem_start)
+
+    def mark_backward(self, tensor, name):
+        """From the moment the gradient of `tensor` is computed, attribute the backward pass to region `name`."""
+        def hook(grad):
+            if self._backward_marks is not None:
+                self._sync()
+                self._backward_marks.append((name, time.perf_counter(), self._memory()))
+
+        if tensor.requires_grad:
+            tensor.register_hook(hook)
+
+    def record(self, name, duration, end=None, mem_delta=0, mem_peak=0):
+        """Add a region that was measured elsewhere (eg the data wait of the LoaderProfiler), ending at `end`."""
+        end = end if end is not None else time.perf_counter()
+        stats = self.epoch_stats[name]
+        stats["count"] += 1
+        stats["time"] += duration
+        stats["mem_delta"] += mem_delta
+        stats["mem_peak"] = max(stats["mem_peak"], mem_peak)
+
+        self.events.append({
+            "name": name, "ph": "X", "pid": 0, "tid": threading.get_ident(),
+            "ts": (end - duration - self.origin) * 1e6, "dur": duration * 1e6,  # in microseconds
+            "args": {"mem_delta_mb": mem_delta / 2 ** 20, "mem_peak_mb": mem_peak / 2 ** 20},
+        })
+
+    def summary(self) -> dict:
+        return {name: dict(stats) for name, stats in self.epoch_stats.items()}
+
+    def summary_table(self) -> str:
+        total = sum(stats["time"] for stats in self.epoch_stats.values())
+        lines = [f"{'region':<28} {'calls':>7} {'total (s)':>10} {'mean (ms)':>10} {'%':>6} "
+                 f"{'mem delta (MB)':>15} {'mem peak (MB)':>14}"]
+        for name, stats in sorted(self.epoch_stats.items()):
+            count = max(stats["count"], 1)
+            lines.append(f"{name:<28} {stats['count']:>7} {stats['time']:>10.2f} {1000 * stats['time'] / count:>10.2f} "
+                         f"{100 * stats['time'] / max(total, 1e-12):>6.1f} "
+                         f"{stats['mem_delta'] / count / 2 ** 20:>15.1f} {stats['mem_peak'] / 2 ** 20:>14.1f}")
+        return "\n".join(lines)
+
+    def end_epoch(self, log_path):
+        """Print the summary of this epoch, write the timeline so far and reset the per-epoch statistics."""
+        print(f"Hot path profile:\n{self.summary_table()}")
+        self.export_chrome_trace(os.path.join(log_path, "hot_path_trace.json"))
+        self.epoch_stats.clear()
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+_profiler: HotPathProfiler = None
+
+
+def enable_hot_path_profiler(device) -> HotPathProfiler:
+    global _profiler
+    _profiler = HotPathProfiler(device)
+    return _profiler
+
+
+def disable_hot_path_profiler():
+    global _profiler
+    _profiler = None
+
+
+def is_hot_path_profiler_enabled() -> bool:
+    return _profiler is not None
+
+
+def profile_region(name):
+    """Context manager for a region of the hot path. Does nothing unless the profiler is enabled."""
+    if _profiler is None:
+        return nullcontext()
+    return _profiler.region(name)
+
+
+def profile_backward():
+    if _profiler is None:
+        return nullcontext()
+    return _profiler.backward()
+
+
+def mark_backward(tensor, name):
+    if _profiler is not None:
+        _profiler.mark_backward(tensor, name)
@@ -0,0 +1,173 @@
+"""
+Local, append-only metrics log, as an offline alternative (or addition) to wandb. Enabled with `use_local_metrics=True`.
+All metrics of a run (encoder, classifiers, decoder) are appended to `<model_path>/metrics.jsonl` with the same keys as
+the wandb sections, one json record per line: {"step": 100, "time": 1700000000.0, "nce/nce_0": 1.23, ...}.
+Writing happens in a background thread, such that the training loop never blocks on file I/O.
+
+Query/plot tool, eg to compare two runs:
+    python -m utils.local_metrics ./sim_logs/run_a ./sim_logs/run_b                      # list the keys
+    python -m utils.local_metrics ./sim_logs/run_a ./sim_logs/run_b --keys nce/nce_0 kld/kld_0 --plot nce.png
+"""
+
+import argparse
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+import matplotlib.pyplot as plt
+import wandb
+
+from config_code.config_classes import OptionsConfig
+
+METRICS_FILE = "metrics.jsonl"
+
+
+class LocalMetricsWriter:
+    def __init__(self, path, flush_every_s=5.0):
+        self.path = path
+        self.flush_every_s = flush_every_s
+        self._queue = queue.Queue()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def log(self, metrics: Dict[str, float], step: Optional[int] = None):
+        """Non-blocking: the record is only queued here."""
+        record = {"step": step, "time": time.time()}
+        record.update({key: _to_json_value(value) for key, value in metrics.items()})
+        self._queue.put(record)
+
+    def _write_loop(self):
+        with open(self.path, "a") as f:
+            last_flush = time.time()
+            while True:
+                try:
+                    record = self._queue.get(timeout=self.flush_every_s)
+                except queue.Empty:
+                    record = False  # nothing new, only flush
+
+                if record is None:  # sentinel from close()
+                    break
+                if record:
+                    f.write(json.dumps(record) + "\n")
+
+                if time.time() - last_flush >= self.flush_every_s:
+                    f.flush()
+                    last_flush = time.time()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _to_json_value(value):
+    if hasattr(value, "item"):  # tensor or numpy scalar
+        return value.item()
+    return value
+
+
+_writers: Dict[str, LocalMetricsWriter] = {}
+
+
+def get_local_metrics_writer(opt: OptionsConfig) -> LocalMetricsWriter:
+    """A single writer per run (metrics file), shared by the whole process."""
+    os.makedirs(opt.model_path, exist_ok=True)
+    path = os.path.join(opt.model_path, METRICS_FILE)
+    if path not in _writers:
+        _writers[path] = LocalMetricsWriter(path)
+    return _writers[path]
+
+
+@atexit.register
+def close_local_metrics_writers():
+    for writer in _writers.values():
+        writer.close()
+
+
+def log_metrics(opt: OptionsConfig, metrics: Dict[str, float], step: Optional[int] = None,
+                use_wandb: Optional[bool] = None):
+    """
+    Log to wandb and/or the local metrics file, depending on `use_wandb` (None: `opt.use_wandb`) and
+    `opt.use_local_metrics`.
+    """
+    if use_wandb if use_wandb is not None else opt.use_wandb:
+        wandb.log(metrics, step=step)
+    if opt.use_local_metrics:
+        get_local_metrics_writer(opt).log(metrics, step)
+
+
+def local_metrics_sink(opt: OptionsConfig):
+    """Sink for `MetricsAccumulator`."""
+    writer = get_local_metrics_writer(opt)
+    return lambda metrics, step: writer.log(metrics, step)
+
+
+def read_metrics(run_dir_or_file) -> List[dict]:
+    path = run_dir_or_file
+    if os.path.isdir(path):
+        path = os.path.join(path, METRICS_FILE)
+
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_series(records: List[dict], key) -> (List[int], List[float]):
+    """(steps, values) of a key. Records without a step get their index in the file as x value."""
+    steps, values = [], []
+    for idx, record in enumerate(records):
+        if key in record:
+            steps.append(record["step"] if record["step"] is not None else idx)
+            values.append(record[key])
+    return steps, values
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Query and plot local metrics files (metrics.jsonl) of runs.")
+    parser.add_argument('runs', type=str, nargs='+', help='Run directories (eg ./sim_logs/temp) or metrics files')
+    parser.add_argument('--keys', type=str, nargs='*', help='Metrics to show, eg nce/nce_0. Default: list all keys')
+    parser.add_argument('--plot', type=str, default=None, help='Save a plot of the keys over the steps to this file')
+    args = parser.parse_args()
+
+    runs = {run: read_metrics(run) for run in args.runs}
+
+    if not args.keys:
+        for run, records in runs.items():
+            keys = sorted({key for record in records for key in record} - {"step", "time"})
+            print(f"{run} ({len(records)} records):")
+            for key in keys:
+                print(f"\t{key}")
+        return
+
+    print(f"{'run':<40} {'key':<50} {'last':>10} {'min':>10} {'max':>10}")
+    for run, records in runs.items():
+        for key in args.keys:
+            _, values = get_series(records, key)
+            if len(values) == 0:
+                print(f"{run:<40} {key:<50} {'-':>10}")
+                continue
+            print(f"{run:<40} {key:<50} {values[-1]:>10.4f} {min(values):>10.4f} {max(values):>10.4f}")
+
+    if args.plot is not None:
+        fig, axes = plt.subplots(len(args.keys), 1, figsize=(8, 3 * len(args.keys)), squeeze=False)
+        for ax, key in zip(axes[:, 0], args.keys):
+            for run, records in runs.items():
+                steps, values = get_series(records, key)
+                ax.plot(steps, values, label=run)
+            ax.set_title(key)
+            ax.set_xlabel("step")
+            ax.legend(loc="upper right")
+        fig.tight_layout()
+        fig.savefig(args.plot)
+        print(f"Saved plot to {args.plot}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,62 @@
+from typing import Callable, Dict, List
+
+import torch
+import wandb
+
+# A sink receives the averaged metrics ({"nce/nce_0": 1.23, ...}) and the global step
+Sink = Callable[[Dict[str, float], int], None]
+
+
+class MetricsAccumulator:
+    """
+    Keeps running sums of per-module metrics (eg loss, nce, kld, accuracy) as tensors on the training device, such
+    that the training loop never has to wait for the device (no `.item()` per step). `flush` copies all averages to
+    the host in a single transfer and hands them to the sinks (console, wandb, local file, ...).
+    """
+
+    def __init__(self, metric_names: List[str], nb_modules: int, device, sinks: List[Sink] = None):
+        self.metric_names = metric_names
+        self.nb_modules = nb_modules
+        self.device = device
+        self.sinks: List[Sink] = sinks if sinks is not None else []
+        self.sums = torch.zeros(len(metric_names), nb_modules, device=device)
+        self.count = 0
+
+    def update(self, **metrics: torch.Tensor):
+        """eg: update(loss=loss, nce=nce, kld=kld), each tensor of shape (nb_modules,)"""
+        values = torch.stack([metrics[name].detach().float() for name in self.metric_names])
+        self.sums += values.to(self.sums.device)
+        self.count += 1
+
+    def averages(self) -> Dict[str, List[float]]:
+        """Average of every metric since the last reset, eg {"nce": [1.2, 1.5, 1.3, 0.9]}. Single device->host copy."""
+        values = (self.sums / max(self.count, 1)).tolist()
+        return {name: values[idx] for idx, name in enumerate(self.metric_names)}
+
+    def reset(self):
+        self.sums.zero_()
+        self.count = 0
+
+    def state_dict(self) -> dict:
+        return {"sums": self.sums.cpu(), "count": self.count}
+
+    def load_state_dict(self, state: dict):
+        self.sums.copy_(state["sums"])
+        self.count = state["count"]
+
+    def flush(self, step: int, extra: Dict[str, float] = None) -> Dict[str, List[float]]:
+        """Send the averages since the last flush to the sinks (keys as in wandb: "nce/nce_0") and reset."""
+        averages = self.averages()
+        flat = {f"{name}/{name}_{idx}": value for name, values in averages.items() for idx, value in enumerate(values)}
+        if extra is not None:
+            flat.update(extra)
+
+        for sink in self.sinks:
+            sink(flat, step)
+
+        self.reset()
+        return averages
+
+
+def wandb_sink(metrics: Dict[str, float], step: int):
+    wandb.log(metrics, step=step)  # a single call for all modules and metrics
@@ -0,0 +1,101 @@
+"""
+Step-level checkpoints of the encoder training loop (encoder/train.py), such that a preempted run loses seconds instead
+of up to a full epoch. The checkpoint (`<log_path>/resume.ckpt`) holds everything the loop needs to continue exactly:
+model, optimizer and scheduler state, the position in the epoch (epoch, step, global step), the seed of the training
+loader (see data/resumable_sampler.py), the running metric sums and the Python, NumPy and torch (cpu + cuda) RNG states,
+which are used by the random cropping of the datasets and the subsampling in InfoNCE_Loss.
+
+A checkpoint is written every `checkpoint_every_x_steps` steps and when the process receives SIGTERM (or SIGUSR1, as
+sent by slurm's --signal before the time limit): the current step is finished, the checkpoint is written and training
+stops. Starting the same experiment again (same save_dir) continues from the checkpoint, if `resume_from_checkpoint`.
+
+With the map-style datasets (ResumableSampler) and num_workers=0, a resumed run is identical to an uninterrupted one.
+With workers, the random crops of the datasets are drawn in the workers, whose RNGs restart from the seed of the epoch
+after resuming: the order of the batches is the same, the crop offsets within the files are not.
+The iterable datasets (LibriSpeech with crops_per_file > 1 or tar shards) replay the skipped batches after the RNG
+states were restored: the order of the files (and shards) only depends on (seed, epoch) and is the same, but the crop
+offsets and the mixing of the shuffle buffer are drawn again and differ from an uninterrupted run.
+"""
+
+import os
+import random
+import signal
+from typing import Optional
+
+import numpy as np
+import torch
+
+RESUME_CHECKPOINT = "resume.ckpt"
+
+
+def capture_rng_states() -> dict:
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def restore_rng_states(states: dict):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if torch.cuda.is_available() and len(states["cuda"]) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def save_resume_checkpoint(path, state: dict):
+    """Written to a temporary file first, such that a kill during saving never leaves a corrupt checkpoint."""
+    tmp_path = f"{path}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_resume_checkpoint(path) -> Optional[dict]:
+    """
+    Loaded on the cpu: the RNG states must stay cpu ByteTensors, the load_state_dict of the model, optimizer and
+    metrics copy their tensors to the device.
+    """
+    if not os.path.exists(path):
+        return None
+    # contains the RNG states and numpy arrays, so not loadable with weights_only
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def remove_resume_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class PreemptionHandler:
+    """
+    Context manager that, instead of killing the process, sets `requested` on SIGTERM/SIGUSR1. The training loop
+    checks the flag after every step. The previous handlers are restored on exit.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.requested = False
+        self.signals = [signal.SIGTERM] + ([signal.SIGUSR1] if hasattr(signal, "SIGUSR1") else [])
+        self._previous_handlers = {}
+
+    def _handle(self, signum, frame):
+        print(f"Received signal {signum}, saving a checkpoint after the current step.")
+        self.requested = True
+
+    def __enter__(self):
+        if self.enabled:
+            for sig in self.signals:
+                self._previous_handlers[sig] = signal.signal(sig, self._handle)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for sig, handler in self._previous_handlers.items():
+            signal.signal(sig, handler)
+        self._previous_handlers = {}
+
+
+class TrainingPreempted(Exception):
+    """Raised by the training loop after the checkpoint of a preemption signal was written."""
+    pass
@@ -1,4 +1,5 @@
 import os
+import random
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
@@ -115,6 +116,7 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     np.random.seed(seed)
+    random.seed(seed)  # eg random cropping of the librispeech datasets
 
 
 def rescale_between_neg1_and_1(x, axis=0):
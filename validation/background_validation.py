@@ -0,0 +1,147 @@
+"""
+Validation of the encoder in a separate worker process, such that training does not stop at every epoch boundary.
+Enabled with `validate_in_background=True`, eg:
+    python -m encoder.train temp sim_audio_de_boer_distr_true --overrides validate_in_background=true
+
+At the end of every epoch, the training loop writes a snapshot of the weights to `<log_path>/validation/` and
+continues immediately. The worker has its own model and validation loader, and validates the snapshots in the order
+they were written (see val_by_InfoNCELoss), after which the snapshot is removed. The results are sent back and picked
+up by the training loop after every step, which appends them to the val losses of the logger and logs them with the
+training step at which they arrived; `val_loss/trained_steps` is the step of the weights that were validated.
+
+The worker uses the same device as training. Its RNGs are independent of the training process, so validating in
+the background changes the random stream of training compared to `validate_in_background=False`.
+"""
+
+import copy
+import multiprocessing
+import os
+import queue
+import traceback
+from typing import List, Optional
+
+import torch
+
+from config_code.config_classes import OptionsConfig
+from data import get_dataloader
+from models.full_model import FullModel
+from utils.local_metrics import log_metrics
+from utils.utils import set_seed
+from validation.val_by_InfoNCELoss import val_by_InfoNCELoss
+
+SNAPSHOT_DIR = "validation"
+
+
+class ValidationResult:
+    def __init__(self, epoch, global_step, validation_loss: Optional[List[float]], error: Optional[str] = None):
+        self.epoch = epoch
+        self.global_step = global_step  # step of the training loop at which the snapshot was taken
+        self.validation_loss = validation_loss
+        self.error = error
+
+
+def _validation_worker(opt: OptionsConfig, jobs, results):
+    set_seed(opt.seed)
+    model = FullModel(opt, calc_accuracy=False).to(opt.device)
+    _, _, test_loader, _ = get_dataloader.get_dataloader(config=opt.encoder_config.dataset, device=opt.device)
+
+    while True:
+        job = jobs.get()
+        if job is None:  # sentinel from BackgroundValidator.close()
+            break
+
+        epoch, global_step, path = job
+        try:
+            model.load_state_dict(torch.load(path, map_location=opt.device))
+            results.put(ValidationResult(epoch, global_step, val_by_InfoNCELoss(opt, model, test_loader)))
+        except Exception:
+            results.put(ValidationResult(epoch, global_step, None, traceback.format_exc()))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class BackgroundValidator:
+    def __init__(self, opt: OptionsConfig):
+        self.snapshot_dir = os.path.join(opt.log_path, SNAPSHOT_DIR)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+        # the worker validates a single, unwrapped model on one device
+        worker_opt = copy.deepcopy(opt)
+        worker_opt.encoder_config.dataset.batch_size_multiGPU = worker_opt.encoder_config.dataset.batch_size
+        worker_opt.compile_modules = False
+
+        context = multiprocessing.get_context("spawn")  # cuda cannot be used in forked processes
+        self._jobs = context.Queue()
+        self._results = context.Queue()
+        self._nb_pending = 0
+        self._closed = False
+        self.process = context.Process(target=_validation_worker, args=(worker_opt, self._jobs, self._results))
+        self.process.start()
+
+    def submit(self, model, epoch, global_step):
+        """Snapshot the weights of `model` (FullModel, possibly wrapped in DataParallel) for validation."""
+        model = model.module if isinstance(model, torch.nn.DataParallel) else model
+        state_dict = {name: tensor.detach().cpu() for name, tensor in model.state_dict().items()}
+
+        # written to a temporary file first, such that the worker never reads a partial snapshot
+        path = os.path.join(self.snapshot_dir, f"snapshot_epoch_{epoch}.pt")
+        torch.save(state_dict, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+        self._jobs.put((epoch, global_step, path))
+        self._nb_pending += 1
+
+    def poll(self) -> List[ValidationResult]:
+        """Results that arrived since the last call, without blocking."""
+        results = []
+        while self._nb_pending > 0:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+            self._nb_pending -= 1
+        return results
+
+    def close(self) -> List[ValidationResult]:
+        """Wait for the pending snapshots to be validated and stop the worker."""
+        results = []
+        if self._closed:
+            return results
+        self._closed = True
+
+        self._jobs.put(None)
+        while self._nb_pending > 0:
+            try:
+                results.append(self._results.get(timeout=5))
+                self._nb_pending -= 1
+            except queue.Empty:
+                if not self.process.is_alive():
+                    print(f"Validation worker stopped with exit code {self.process.exitcode}, "
+                          f"{self._nb_pending} snapshots were not validated.")
+                    break
+        self.process.join()
+        return results
+
+    def terminate(self):
+        """Stop the worker without waiting for the pending snapshots, eg when training got interrupted."""
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._closed = True
+
+
+def handle_validation_results(opt: OptionsConfig, logs, results: List[ValidationResult], step):
+    """Append the results to the logger and log them at training step `step`."""
+    for result in results:
+        if result.error is not None:
+            print(f"Validation of epoch {result.epoch + 1} failed:\n{result.error}")
+            continue
+
+        print(f"Validation loss of epoch {result.epoch + 1} (step {result.global_step}): "
+              f"{[round(float(val_loss), 4) for val_loss in result.validation_loss]}")
+
+        logs.append_val_loss(result.validation_loss)
+        metrics = {f"val_loss/val_loss_{i}": val_loss for i, val_loss in enumerate(result.validation_loss)}
+        metrics["val_loss/trained_steps"] = result.global_step
+        log_metrics(opt, metrics, step=step)
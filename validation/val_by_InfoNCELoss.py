@@ -5,6 +5,19 @@ from config_code.config_classes import OptionsConfig
 
 
 def val_by_InfoNCELoss(opt: OptionsConfig, model, test_loader):
+    """
+    Average loss per module over the validation set. Runs in eval mode (batchnorm uses its running statistics and is
+    not updated by the validation data) and without autograd. The previous mode of the model is restored afterwards.
+    """
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        validation_loss = _val_by_InfoNCELoss(opt, model, test_loader)
+    model.train(was_training)
+    return validation_loss
+
+
+def _val_by_InfoNCELoss(opt: OptionsConfig, model, test_loader):
     total_step = len(test_loader)
     limit_validation_batches = opt.encoder_config.dataset.limit_validation_batches  # value between 0 and 1
     if limit_validation_batches < 1:
@@ -18,7 +31,7 @@ def val_by_InfoNCELoss(opt: OptionsConfig, model, test_loader):
     for step, (audio, _, _, _) in enumerate(test_loader):
         model_input = audio.to(opt.device)
 
-        loss, nce, kld = model(model_input)
+        loss, nce, kld, _ = model(model_input)
         loss = torch.mean(loss, 0)
 
         loss_epoch += loss.data.cpu().numpy()